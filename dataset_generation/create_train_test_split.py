@@ -1,8 +1,10 @@
 import argparse
 import json
 from pathlib import Path
+from typing import Iterable
 
 import numpy as np
+from numpy.lib.format import open_memmap
 
 
 def _create_train_test_names(orig_path: str) -> tuple[str, str]:
@@ -16,35 +18,138 @@ def _write_json(data: list[dict], save_path: str) -> None:
         json.dump(data, f, indent=2)
 
 
-def _save_array(arr: np.array, filename: str) -> None:
-    np.save(filename, arr)
+def _is_jsonl(data_path: str) -> bool:
+    """A JSON dataset is a list, a JSONL one has an object per line."""
+    with open(data_path, "r") as f:
+        while char := f.read(1):
+            if not char.isspace():
+                return char != "["
+    return True
+
+
+def _iter_jsonl(data_path: str) -> Iterable[dict]:
+    with open(data_path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_test_mask(
+    names: list[str],
+    split: str = "index",
+    split_index: int | None = None,
+    test_fraction: float | None = None,
+    seed: int = 0,
+) -> np.ndarray:
+    """Whether each row goes to the test set.
+
+    Parameters
+    ----------
+    names : list[str]
+        Entity name of each row
+    split : str
+        "index": the rows from `split_index` are test rows. "random": a random
+        `test_fraction` of the rows. "entity": the rows of a random set of entities,
+        about `test_fraction` of the rows, so the rows of an entity are on one side.
+    split_index : int | None
+        Index of the first test row for the "index" split
+    test_fraction : float | None
+        Fraction of test rows for the "random" and "entity" splits
+    seed : int
+        Seed of the random splits
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the test rows
+    """
+    num_rows = len(names)
+    is_test = np.zeros(num_rows, dtype=bool)
+    if split == "index":
+        if split_index is None:
+            raise ValueError("The index split needs a split_index")
+        is_test[split_index:] = True
+        return is_test
+    if test_fraction is None or not 0 <= test_fraction <= 1:
+        raise ValueError(f"The {split} split needs a test_fraction in [0, 1]")
+    rng = np.random.default_rng(seed)
+    num_test = round(test_fraction * num_rows)
+    if split == "random":
+        is_test[rng.permutation(num_rows)[:num_test]] = True
+    elif split == "entity":
+        entity_ids, row_entities = np.unique(names, return_inverse=True)
+        entity_sizes = np.bincount(row_entities, minlength=len(entity_ids))
+        shuffled_entities = rng.permutation(len(entity_ids))
+        # Smallest prefix of the shuffled entities with at least num_test rows
+        cumulative_rows = np.cumsum(entity_sizes[shuffled_entities])
+        num_test_entities = np.searchsorted(cumulative_rows, num_test) + (num_test > 0)
+        is_test = np.isin(row_entities, shuffled_entities[:num_test_entities])
+    else:
+        raise ValueError(f"Split {split} not supported.")
+    return is_test
+
+
+def _check_num_rows(rows: list, num_rows: int) -> None:
+    if len(rows) != num_rows:
+        raise ValueError(f"The dataset has {len(rows)} rows, the embeddings {num_rows}")
+
+
+def _copy_rows(
+    source_path: str, row_indices: np.ndarray, save_path: str, chunk_size: int
+) -> None:
+    """Copies the rows of a memory-mapped `.npy` file as float32, a chunk at a time."""
+    source = np.load(source_path, mmap_mode="r")
+    output = open_memmap(
+        save_path, "w+", np.float32, (len(row_indices),) + source.shape[1:]
+    )
+    for start in range(0, len(row_indices), chunk_size):
+        indices = row_indices[start : start + chunk_size]
+        if len(indices) and indices[-1] - indices[0] == len(indices) - 1:
+            # Contiguous rows, a slice avoids the copy of fancy indexing
+            output[start : start + len(indices)] = source[indices[0] : indices[-1] + 1]
+        else:
+            output[start : start + len(indices)] = source[indices]
+    output.flush()
 
 
 def create_train_test_split(
     data_path: str,
     embedding_keys_path: str,
     embeddings_values_path: str,
-    split_index: int,
+    split_index: int | None,
     output_path: str,
+    split: str = "index",
+    test_fraction: float | None = None,
+    seed: int = 0,
+    chunk_size: int = 65536,
 ) -> None:
     """Split data into training and test sets and save the results.
 
-    This function loads data from the specified paths, creates a train-test split at the given index,
-    and saves the resulting splits to the output path.
+    The dataset is read once if it is a JSON list, and streamed twice if it is JSONL.
+    The embedding files are memory-mapped and the split rows are copied a chunk at a
+    time, so the memory use does not grow with the size of the embeddings.
 
     Parameters
     ----------
     data_path : str
-        Path to the main data file to be split
+        Path to the main data file to be split, in JSON or JSONL format
     embedding_keys_path : str
         Path to the file containing embedding keys
     embeddings_values_path : str
         Path to the file containing embedding values
-    split_index : int
+    split_index : int | None
         Index at which to split the data into train and test sets.
         Data before this index will be training, after will be test.
     output_path : str
         Directory path where the split datasets will be saved
+    split : str
+        How to split the rows, "index", "random" or "entity", see `get_test_mask`
+    test_fraction : float | None
+        Fraction of test rows for the "random" and "entity" splits
+    seed : int
+        Seed of the random splits
+    chunk_size : int
+        Number of embedding rows copied at once
 
     Returns
     -------
@@ -53,31 +158,47 @@ def create_train_test_split(
 
     """
 
+    num_rows = np.load(embedding_keys_path, mmap_mode="r").shape[0]
+    if np.load(embeddings_values_path, mmap_mode="r").shape[0] != num_rows:
+        raise ValueError("The key and value embeddings have different numbers of rows")
+
     output_p = Path(output_path)
     output_p.mkdir(exist_ok=True, parents=True)
-
-    train_dataset = json.load(open(data_path))[:split_index]
-
-    train_key_embds = np.load(embedding_keys_path).astype("float32")[:split_index]
-    train_value_embds = np.load(embeddings_values_path).astype("float32")[:split_index]
-
-    test_dataset = json.load(open(data_path))[split_index:]
-
-    test_key_embds = np.load(embedding_keys_path).astype("float32")[split_index:]
-    test_value_embds = np.load(embeddings_values_path).astype("float32")[split_index:]
-
     train_dataset_name, test_dataset_name = _create_train_test_names(data_path)
-    train_keys_name, test_keys_name = _create_train_test_names(embedding_keys_path)
-    train_values_name, test_values_name = _create_train_test_names(
-        embeddings_values_path
-    )
 
-    _write_json(train_dataset, output_p / train_dataset_name)
-    _write_json(test_dataset, output_p / test_dataset_name)
-    _save_array(train_key_embds, output_p / train_keys_name)
-    _save_array(train_value_embds, output_p / train_values_name)
-    _save_array(test_key_embds, output_p / test_keys_name)
-    _save_array(test_value_embds, output_p / test_values_name)
+    if _is_jsonl(data_path):
+        names = [row["name"] for row in _iter_jsonl(data_path)]
+        _check_num_rows(names, num_rows)
+        is_test = get_test_mask(names, split, split_index, test_fraction, seed)
+        with open(output_p / train_dataset_name, "w") as train_file, open(
+            output_p / test_dataset_name, "w"
+        ) as test_file:
+            for row, row_is_test in zip(_iter_jsonl(data_path), is_test):
+                (test_file if row_is_test else train_file).write(json.dumps(row) + "\n")
+    else:
+        with open(data_path, "r") as f:
+            dataset = json.load(f)
+        _check_num_rows(dataset, num_rows)
+        is_test = get_test_mask(
+            [row["name"] for row in dataset], split, split_index, test_fraction, seed
+        )
+        _write_json(
+            [row for row, t in zip(dataset, is_test) if not t],
+            output_p / train_dataset_name,
+        )
+        _write_json(
+            [row for row, t in zip(dataset, is_test) if t],
+            output_p / test_dataset_name,
+        )
+
+    for embeddings_path in [embedding_keys_path, embeddings_values_path]:
+        train_name, test_name = _create_train_test_names(embeddings_path)
+        _copy_rows(
+            embeddings_path, np.flatnonzero(~is_test), output_p / train_name, chunk_size
+        )
+        _copy_rows(
+            embeddings_path, np.flatnonzero(is_test), output_p / test_name, chunk_size
+        )
 
 
 def parser_args():
@@ -87,6 +208,20 @@ def parser_args():
     parser.add_argument("--embeddings_values_path", type=str)
     parser.add_argument("--output_path", type=str)
     parser.add_argument("--split_index", type=int)
+    parser.add_argument(
+        "--split",
+        type=str,
+        default="index",
+        choices=["index", "random", "entity"],
+        help="Split at split_index, split random rows, or split random entities",
+    )
+    parser.add_argument(
+        "--test_fraction",
+        type=float,
+        default=None,
+        help="Fraction of test rows for the random and entity splits",
+    )
+    parser.add_argument("--seed", type=int, default=0)
 
     args = parser.parse_args()
     return args
@@ -100,4 +235,7 @@ if __name__ == "__main__":
         args.embeddings_values_path,
         args.split_index,
         args.output_path,
+        args.split,
+        args.test_fraction,
+        args.seed,
     )
@@ -1,14 +1,25 @@
 import argparse
+import asyncio
 import json
 import os
 import re
+from dataclasses import replace
 from itertools import product
 
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM
 
-from kblam.gpt_session import GPT
-from kblam.utils.data_utils import DataPoint, Entity, save_entity
+from kblam.gpt_session import GPT, AsyncGPT
+from kblam.utils.cache_utils import ResponseCache
+from kblam.utils.data_utils import DataPoint, Entity
+from kblam.utils.pipeline_utils import PipelineNode, Stage, run_pipeline
+
+
+def parse_augmented_QA(data: DataPoint, gpt_output: str) -> DataPoint:
+    """Data point with the extended Q and A of a "Q: ...\nA: ..." response."""
+    extended_q = re.findall(r"Q: (.*)", gpt_output)[0]
+    extended_a = re.findall(r"A: (.*)", gpt_output)[0]
+    return replace(data, extended_Q=extended_q, extended_A=extended_a)
 
 
 def construct_prompts(entity: DataPoint) -> tuple[str, str, str]:
@@ -45,6 +56,13 @@ class SyntheticDataGenerator(GPT):
             + " Do **NOT** generate anything else."
         )
 
+        self.augmentation_system_prompt = """You are given a question and answer pair, please extend the question to be open-ended and generate a short answer. 
+                                For example, you could generate "What is the objective of xxx and what do you think of it?"
+                                Make sure the answer is **only** based on information provided from the QA pair. In addition, please generate in the format of:
+                                Q: ...
+                                A: ... 
+                            """
+
         self.idea_sources = [
             "software companies",
             "tech companies",
@@ -167,100 +185,204 @@ class SyntheticDataGenerator(GPT):
             for (name_type, idea_type) in product(self.idea_sources, self.data_types)
         ]
 
-    def generate_entity(self, instruction: str) -> Entity:
-        prompt = [
-            {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": instruction},
-        ]
-        gpt_output = self.api_call_chat(prompt)
-
+    def _get_entity_messages(
+        self, instruction: str, gpt_output: str | None = None
+    ) -> list[dict]:
+        """Asks for a name, then for the properties of the entity given the name."""
         messages = [
             {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": instruction},
-            {"role": "assistant", "content": gpt_output},
-            {"role": "user", "content": self.prompt_2nd_phase},
         ]
-        gpt_output = self.api_call_chat(messages)
-
-        gpt_output = self.api_call_chat(messages)
-        entity = Entity(**json.loads(gpt_output))
-        return entity
-
-    def generate_related_data(self, entity: Entity) -> Entity:
+        if gpt_output is not None:
+            messages += [
+                {"role": "assistant", "content": gpt_output},
+                {"role": "user", "content": self.prompt_2nd_phase},
+            ]
+        return messages
+
+    def _get_related_data_messages(self, entity: Entity) -> list[dict]:
         instruction = f"Generate a person name related to the entity {entity.name} with description {entity.description}."
         instruction += "The person needs to be associated with the entity in some way. e.g. they work in the company or they are a character in the book."
         instruction += (
             f"Make sure the entity is in the format of {self.entity_format_prompt}"
         )
-
-        prompt = [
+        return [
             {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": instruction},
         ]
 
-        gpt_output = self.api_call_chat(prompt)
-        entity = Entity(**json.loads(gpt_output))
+    def _get_augmentation_messages(self, data: DataPoint) -> list[dict]:
+        prompt = (
+            "Generate an extended Q and an A for this pair: "
+            + f"Q: {data.Q}\nA: {data.A}"
+        )
+        return [
+            {"role": "system", "content": self.augmentation_system_prompt},
+            {"role": "user", "content": prompt},
+        ]
 
-        return entity
+    def _get_perturbation_prompt(self, data: DataPoint) -> str:
+        prompt = f"Perturb the names in the queries of the dataset (e.g. Margaret Thatcher -> Maggie Thatcher or Microsoft Research to MSR) for data point with name {data.name}."
+        prompt += f"Return the question {data.Q} with the perturbed name. Make sure the perturbation is valid. Do NOT generate anything else."
+        return prompt
 
-    def post_process_data(self, entity_list: list[Entity]) -> list[DataPoint]:
-        dataset = []
-        keywords = {"description", "objectives", "purpose"}
-
-        for entity in entity_list:
-            for keyword in keywords:
-                datapoint = DataPoint(
-                    name=entity.name,
-                    description_type=keyword.lower(),
-                    description=getattr(entity, keyword),
-                )
-                datapoint.Q, datapoint.A, datapoint.key_string = construct_prompts(
-                    datapoint
-                )
-                dataset.append(datapoint)
+    def generate_entity(self, instruction: str) -> Entity:
+        gpt_output = self.api_call_chat(self._get_entity_messages(instruction))
+        gpt_output = self.api_call_chat(
+            self._get_entity_messages(instruction, gpt_output)
+        )
+        return Entity(**json.loads(gpt_output))
 
+    def generate_related_data(self, entity: Entity) -> Entity:
+        gpt_output = self.api_call_chat(self._get_related_data_messages(entity))
+        return Entity(**json.loads(gpt_output))
+
+    def make_datapoints(self, entity: Entity) -> list[DataPoint]:
+        """One question-answer pair per property of the entity."""
+        dataset = []
+        for keyword in ["description", "objectives", "purpose"]:
+            datapoint = DataPoint(
+                name=entity.name,
+                description_type=keyword,
+                description=getattr(entity, keyword),
+            )
+            datapoint.Q, datapoint.A, datapoint.key_string = construct_prompts(
+                datapoint
+            )
+            dataset.append(datapoint)
         return dataset
 
-    def augmenta_data_with_synthetic_QA(
-        self, dataset: list[DataPoint]
-    ) -> list[DataPoint]:
-        self.system_prompt = """You are given a question and answer pair, please extend the question to be open-ended and generate a short answer. 
-                                For example, you could generate "What is the objective of xxx and what do you think of it?"
-                                Make sure the answer is **only** based on information provided from the QA pair. In addition, please generate in the format of:
-                                Q: ...
-                                A: ... 
-                            """
+    def augment_QA(self, data: DataPoint) -> DataPoint:
+        """Extends the question to be open-ended, with a short answer."""
+        gpt_output = self.api_call_chat(self._get_augmentation_messages(data))
+        return parse_augmented_QA(data, gpt_output)
 
-        for data in dataset:
-            try:
-                prompt = (
-                    "Generate an extended Q and an A for this pair: "
-                    + f"Q: {data.Q}\nA: {data.A}"
-                )
-                gpt_output = self.generate_response(prompt)
-                extended_q = re.findall(r"Q: (.*)", gpt_output)[0]
-                extended_a = re.findall(r"A: (.*)", gpt_output)[0]
-                data.extended_Q = extended_q
-                data.extended_A = extended_a
-            except Exception as e:
-                print("Error augmenting Q&A.")
-                print(e)
-                continue
-        return dataset
+    def perturb_name(self, data: DataPoint) -> DataPoint:
+        """Rewrites the question with a perturbed name of the entity."""
+        gpt_output = self.generate_response(self._get_perturbation_prompt(data))
+        return replace(data, Q=gpt_output)
 
-    def perturb_names(self, dataset: list[DataPoint]):
-        for data in dataset:
-            try:
-                prompt = f"Perturb the names in the queries of the dataset (e.g. Margaret Thatcher -> Maggie Thatcher or Microsoft Research to MSR) for data point with name {data.name}."
-                prompt += f"Return the question {data.Q} with the perturbed name. Make sure the perturbation is valid. Do NOT generate anything else."
-                gpt_output = self.generate_response(prompt)
-                data.Q = gpt_output
-
-            except Exception as e:
-                print("Error perturbing the names in the queries.")
-                print(e)
-                continue
-        return dataset
+
+class AsyncSyntheticDataGenerator(SyntheticDataGenerator, AsyncGPT):
+    """`SyntheticDataGenerator` with coroutine generation methods, see `AsyncGPT`."""
+
+    async def generate_entity(self, instruction: str) -> Entity:
+        gpt_output = await self.api_call_chat(self._get_entity_messages(instruction))
+        gpt_output = await self.api_call_chat(
+            self._get_entity_messages(instruction, gpt_output)
+        )
+        return Entity(**json.loads(gpt_output))
+
+    async def generate_related_data(self, entity: Entity) -> Entity:
+        gpt_output = await self.api_call_chat(self._get_related_data_messages(entity))
+        return Entity(**json.loads(gpt_output))
+
+    async def augment_QA(self, data: DataPoint) -> DataPoint:
+        gpt_output = await self.api_call_chat(self._get_augmentation_messages(data))
+        return parse_augmented_QA(data, gpt_output)
+
+    async def perturb_name(self, data: DataPoint) -> DataPoint:
+        gpt_output = await self.generate_response(self._get_perturbation_prompt(data))
+        return replace(data, Q=gpt_output)
+
+
+def build_pipeline(
+    data_generator: SyntheticDataGenerator,
+    output_path: str,
+    raw_output_file: str,
+    output_file: str,
+    perturbed_output_file: str,
+    augmented_output_file: str,
+    journal_dir: str = "journals",
+    generate_related_people: bool = True,
+    num_workers: int = 1,
+) -> list[PipelineNode]:
+    """
+    The generation DAG: entity -> related person, the entities and the related people
+    are saved and get per-property QA pairs, each pair is then perturbed and augmented.
+    An entity is kept when its related person fails, only the related person is
+    retried by the next run. The stages are journaled in `journal_dir`.
+    """
+    journal_dir = os.path.join(output_path, journal_dir)
+
+    def make_stage(name, func, output_type, output_file=None):
+        if output_file is not None:
+            output_file = os.path.join(output_path, output_file)
+        journal_path = os.path.join(journal_dir, f"{name}.jsonl")
+        return Stage(name, func, output_type, journal_path, output_file)
+
+    async def generate_related_person(entity: Entity) -> list[Entity]:
+        return [await data_generator.generate_related_data(entity)]
+
+    async def generate_entity(instruction: str) -> list[Entity]:
+        return [await data_generator.generate_entity(instruction)]
+
+    async def perturb_name(data: DataPoint) -> list[DataPoint]:
+        return [await data_generator.perturb_name(data)]
+
+    async def augment_QA(data: DataPoint) -> list[DataPoint]:
+        return [await data_generator.augment_QA(data)]
+
+    if not generate_related_people:
+        nodes = [
+            PipelineNode(
+                make_stage("entities", generate_entity, Entity, raw_output_file),
+                num_workers=num_workers,
+            )
+        ]
+    else:
+        nodes = [
+            PipelineNode(
+                make_stage("entities", generate_entity, Entity),
+                num_workers=num_workers,
+            ),
+            PipelineNode(
+                make_stage("related_person", generate_related_person, Entity),
+                "entities",
+                num_workers,
+            ),
+            # Saves the entities and the related people as they come
+            PipelineNode(
+                make_stage("raw", lambda entity: [entity], Entity, raw_output_file),
+                ("entities", "related_person"),
+            ),
+        ]
+    entity_stage_name = nodes[-1].stage.name
+    nodes += [
+        PipelineNode(
+            make_stage("QA", data_generator.make_datapoints, DataPoint, output_file),
+            entity_stage_name,
+        ),
+        PipelineNode(
+            make_stage("perturbation", perturb_name, DataPoint, perturbed_output_file),
+            "QA",
+            num_workers,
+        ),
+        PipelineNode(
+            make_stage("augmentation", augment_QA, DataPoint, augmented_output_file),
+            "QA",
+            num_workers,
+        ),
+    ]
+    return nodes
+
+
+async def run_generation(
+    data_generator: AsyncSyntheticDataGenerator,
+    nodes: list[PipelineNode],
+    queue_size: int = 64,
+) -> float:
+    """Runs the pipeline on every instruction, returns the duration in seconds."""
+    instructions = [
+        (str(i), instruction)
+        for i, instruction in enumerate(data_generator.get_instructions())
+    ]
+    async with data_generator:
+        try:
+            return await run_pipeline(tqdm(instructions), nodes, queue_size)
+        finally:
+            for node in nodes:
+                node.stage.close()
 
 
 def parser_args():
@@ -279,6 +401,49 @@ def parser_args():
     parser.add_argument(
         "--augmented_output_file", type=str, default="synthetic_data_QA_augmented.json"
     )
+    parser.add_argument(
+        "--journal_dir",
+        type=str,
+        default="journals",
+        help="Directory of the progress journals in output_path, to resume a run",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of requests in flight, and of items in each stage",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=64,
+        help="Maximum number of items waiting for each stage",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the requests per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the tokens per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default=None,
+        help="SQLite file caching the GPT responses across runs, no cache by default",
+    )
+    parser.add_argument(
+        "--cache_max_bytes",
+        type=int,
+        default=2**30,
+        help="Size above which the least recently used cache entries are evicted, "
+        "0 for no limit",
+    )
 
     args = parser.parse_args()
     return args
@@ -287,56 +452,37 @@ def parser_args():
 if __name__ == "__main__":
     args = parser_args()
 
-    data_generator = SyntheticDataGenerator(args.model_name, args.endpoint_url)
+    data_generator = AsyncSyntheticDataGenerator(
+        args.model_name,
+        args.endpoint_url,
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        cache=(
+            ResponseCache(args.cache_path, args.cache_max_bytes or None)
+            if args.cache_path
+            else None
+        ),
+    )
+    data_generator.set_seed(0)
 
     os.makedirs(args.output_path, exist_ok=True)
-
-    raw_output_file = os.path.join(args.output_path, args.raw_output_file)
-
-    if os.path.exists(raw_output_file):
-        # skip entities creation if it's already generated
-        with open(raw_output_file, "r") as file:
-            entity_list = [Entity(**json.loads(line)) for line in file]
-
-    else:
-        entity_list = []
-        for seed in range(1):
-            data_generator.set_seed(seed)
-            for instruction in tqdm(data_generator.get_instructions()):
-                try:
-                    entity = data_generator.generate_entity(instruction)
-                except Exception as e:
-                    print("Error generating entity.")
-                    print(e)
-                    continue
-                save_entity(entity, raw_output_file)
-                entity_list.append(entity)
-
-                if args.generate_related_people:
-                    try:
-                        response = data_generator.generate_related_data(entity)
-                    except Exception as e:
-                        print("Error generating entity.")
-                        print(e)
-                        continue
-                    save_entity(response, raw_output_file)
-                    entity_list.append(response)
-
-    QA_output_file = os.path.join(args.output_path, args.output_file)
-
-    if os.path.exists(QA_output_file):
-        with open(QA_output_file, "r") as file:
-            dataset = [DataPoint(**json.loads(line)) for line in file]
-    else:
-        dataset = data_generator.post_process_data(entity_list)
-        for data in dataset:
-            save_entity(data, QA_output_file)
-
-    perturbed_dataset = data_generator.perturbe_names(dataset)
-
-    for data in perturbed_dataset:
-        save_entity(data, os.path.join(args.output_path, args.perturbed_output_file))
-
-    dataset = data_generator.augmenta_data_with_synthetic_QA(dataset)
-    for data in dataset:
-        save_entity(data, os.path.join(args.output_path, args.augmented_output_file))
+    nodes = build_pipeline(
+        data_generator,
+        args.output_path,
+        args.raw_output_file,
+        args.output_file,
+        args.perturbed_output_file,
+        args.augmented_output_file,
+        args.journal_dir,
+        args.generate_related_people,
+        num_workers=args.max_concurrency,
+    )
+    duration_s = asyncio.run(run_generation(data_generator, nodes, args.queue_size))
+
+    print(f"Generated in {duration_s:.1f}s")
+    for node in nodes:
+        print(f"{node.stage.name}: {node.stage.stats.to_dict(duration_s)}")
+    print(data_generator.stats)
+    if data_generator.cache is not None:
+        print(f"Cache: {data_generator.cache.stats.to_dict()}")
@@ -1,12 +1,18 @@
 import argparse
+import asyncio
 import json
 import os
+from itertools import islice
+from typing import Awaitable, Callable, Iterator
 
 import numpy as np
+import torch
+from numpy.lib.format import open_memmap
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
-from kblam.gpt_session import GPT
+from kblam.gpt_session import AsyncGPT
+from kblam.utils.cache_utils import ResponseCache
 from kblam.utils.data_utils import DataPoint
 
 
@@ -24,59 +30,197 @@ def parser_args():
         "--dataset_path",
         type=str,
         required=False,
-        help="Path to the dataset in JSON format.",
+        help="Path to the dataset in JSONL format.",
     )
     parser.add_argument("--output_path", type=str, default="dataset")
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=10000,
+        help="Number of data points embedded and saved at once, a run resumes by chunk",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of embedding requests in flight",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        help="Maximum number of texts per embedding request",
+    )
+    parser.add_argument(
+        "--max_batch_tokens",
+        type=int,
+        default=100000,
+        help="Maximum number of tokens per embedding request",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the requests per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the tokens per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default=None,
+        help="SQLite file caching the GPT responses across runs, no cache by default",
+    )
+    parser.add_argument(
+        "--cache_max_bytes",
+        type=int,
+        default=2**30,
+        help="Size above which the least recently used cache entries are evicted, "
+        "0 for no limit",
+    )
 
     args = parser.parse_args()
     return args
 
 
-def compute_embeddings(
-    encoder_model_spec: str, dataset: list[DataPoint], part: str, batch_size: int = 100
-) -> np.array:
-    """Compute embeddings for the given dataset in batches using the encoder model spec."""
-    embeddings = []
-    all_elements = []
-    for entity in dataset:
-        if part == "key_string":
-            all_elements.append(entity.key_string)
-        elif part == "description":
-            all_elements.append(entity.description)
-        else:
-            raise ValueError(f"Part {part} not supported.")
-    chunks = [
-        all_elements[i : i + batch_size]
-        for i in range(0, len(all_elements), batch_size)
-    ]
-
-    model = SentenceTransformer(encoder_model_spec, device="cuda")
-    for chunk in tqdm(chunks):
-        embd = model.encode(chunk, convert_to_numpy=True)
-        embeddings.append(embd)
-
-    embeddings = np.concatenate(embeddings, 0)
-    assert len(embeddings) == len(all_elements)
-    return embeddings
+def count_lines(path: str) -> int:
+    with open(path, "rb") as file:
+        return sum(1 for _ in file)
+
+
+def iter_dataset(dataset_path: str, start: int = 0) -> Iterator[DataPoint]:
+    """Lazily reads the data points of a JSONL dataset, from line `start`."""
+    with open(dataset_path, "r") as file:
+        for line in islice(file, start, None):
+            yield DataPoint(**json.loads(line))
+
+
+def get_sentence_transformer_encoder(
+    model_name: str, batch_size: int = 100
+) -> Callable[[list[str]], Awaitable[np.ndarray]]:
+    """Encodes texts with a SentenceTransformer, loaded once."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = SentenceTransformer(model_name, device=device)
+
+    async def encode(texts: list[str]) -> np.ndarray:
+        return model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+
+    return encode
+
+
+def get_gpt_encoder(
+    gpt: AsyncGPT, batch_size: int = 256, max_batch_tokens: int = 100000
+) -> Callable[[list[str]], Awaitable[np.ndarray]]:
+    """Encodes texts with the GPT embedding API, the batches are sent concurrently."""
+
+    async def encode(texts: list[str]) -> np.ndarray:
+        embeddings = await gpt.generate_embeddings(texts, batch_size, max_batch_tokens)
+        failed = [i for i, e in enumerate(embeddings) if e is None]
+        if failed:
+            raise ValueError(f"{len(failed)} texts could not be embedded")
+        return np.array(embeddings, dtype=np.float32)
+
+    return encode
+
+
+def _load_progress(progress_path: str, num_rows: int, chunk_size: int) -> int:
+    """Number of chunks already written by a previous run."""
+    if not os.path.exists(progress_path):
+        return 0
+    with open(progress_path, "r") as file:
+        progress = json.load(file)
+    if progress["num_rows"] != num_rows or progress["chunk_size"] != chunk_size:
+        raise ValueError(
+            f"{progress_path} was written for {progress['num_rows']} rows in chunks of "
+            f"{progress['chunk_size']}, remove it and the embeddings to start over"
+        )
+    return progress["completed_chunks"]
+
+
+def _save_progress(
+    progress_path: str, num_rows: int, chunk_size: int, completed_chunks: int
+):
+    with open(progress_path + ".tmp", "w") as file:
+        json.dump(
+            {
+                "num_rows": num_rows,
+                "chunk_size": chunk_size,
+                "completed_chunks": completed_chunks,
+            },
+            file,
+        )
+    os.replace(progress_path + ".tmp", progress_path)
+
+
+async def embed_dataset(
+    dataset_path: str,
+    encode: Callable[[list[str]], Awaitable[np.ndarray]],
+    key_path: str,
+    value_path: str,
+    chunk_size: int = 10000,
+) -> tuple[np.memmap, np.memmap]:
+    """
+    Streams the dataset in chunks, the key strings and descriptions of a chunk are
+    encoded in one call to `encode`. The embeddings are written to `.npy` files
+    preallocated with `open_memmap`, so the memory use does not grow with the dataset.
+    The number of completed chunks is saved next to the keys, a new run resumes after
+    the last completed chunk.
+    """
+    num_rows = count_lines(dataset_path)
+    if num_rows == 0:
+        raise ValueError(f"{dataset_path} is empty")
+    progress_path = os.path.splitext(key_path)[0] + "_progress.json"
+    completed_chunks = _load_progress(progress_path, num_rows, chunk_size)
+    if completed_chunks > 0:
+        key_embeds = open_memmap(key_path, mode="r+")
+        value_embeds = open_memmap(value_path, mode="r+")
+    num_chunks = (num_rows + chunk_size - 1) // chunk_size
+
+    dataset = iter_dataset(dataset_path, start=completed_chunks * chunk_size)
+    for chunk_index in tqdm(
+        range(completed_chunks, num_chunks), total=num_chunks, initial=completed_chunks
+    ):
+        chunk = list(islice(dataset, chunk_size))
+        embeddings = await encode(
+            [data.key_string for data in chunk] + [data.description for data in chunk]
+        )
+        if chunk_index == 0:
+            shape = (num_rows, embeddings.shape[1])
+            key_embeds = open_memmap(key_path, "w+", np.float32, shape)
+            value_embeds = open_memmap(value_path, "w+", np.float32, shape)
+        start = chunk_index * chunk_size
+        key_embeds[start : start + len(chunk)] = embeddings[: len(chunk)]
+        value_embeds[start : start + len(chunk)] = embeddings[len(chunk) :]
+        key_embeds.flush()
+        value_embeds.flush()
+        _save_progress(progress_path, num_rows, chunk_size, chunk_index + 1)
+    return key_embeds, value_embeds
 
 
 if __name__ == "__main__":
     args = parser_args()
-    with open(args.dataset_path, "r") as file:
-        dataset = [DataPoint(**json.loads(line)) for line in file]
 
     if args.model_name == "all-MiniLM-L6-v2":
-        key_embeds = compute_embeddings(args.model_name, dataset, "key_string")
-        value_embeds = compute_embeddings(args.model_name, dataset, "description")
+        encode = get_sentence_transformer_encoder(args.model_name)
+        gpt = None
     elif args.model_name in ["ada-embeddings", "text-embedding-3-large"]:
-        gpt = GPT(args.model_name, args.endpoint_url)
-
-        key_embeds = []
-        value_embeds = []
-
-        for entity in tqdm(dataset):
-            key_embeds.append(gpt.generate_embedding(entity.key_string))
-            value_embeds.append(gpt.generate_embedding(entity.description))
+        gpt = AsyncGPT(
+            args.model_name,
+            args.endpoint_url,
+            max_concurrency=args.max_concurrency,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            cache=(
+                ResponseCache(args.cache_path, args.cache_max_bytes or None)
+                if args.cache_path
+                else None
+            ),
+        )
+        encode = get_gpt_encoder(gpt, args.batch_size, args.max_batch_tokens)
     else:
         raise ValueError(f"Model {args.model_name} not supported.")
 
@@ -89,11 +233,21 @@ if __name__ == "__main__":
     else:
         save_name = "BigOAI"
 
-    np.save(
-        f"{args.output_path}/{args.dataset_name}_{save_name}_embd_key.npy",
-        np.array(key_embeds),
-    )
-    np.save(
-        f"{args.output_path}/{args.dataset_name}_{save_name}_embd_value.npy",
-        np.array(value_embeds),
-    )
+    async def run():
+        try:
+            await embed_dataset(
+                args.dataset_path,
+                encode,
+                f"{args.output_path}/{args.dataset_name}_{save_name}_embd_key.npy",
+                f"{args.output_path}/{args.dataset_name}_{save_name}_embd_value.npy",
+                args.chunk_size,
+            )
+        finally:
+            if gpt is not None:
+                await gpt.close()
+
+    asyncio.run(run())
+    if gpt is not None:
+        print(gpt.stats)
+        if gpt.cache is not None:
+            print(f"Cache: {gpt.cache.stats.to_dict()}")
@@ -0,0 +1,297 @@
+"""
+Latency and memory benchmark of the KB attention against the in-context learning and zero-shot baselines. The models
+are tiny Llama / Phi-3 configurations with random weights and the KB embeddings are random, so that the benchmark
+runs on CPU and tracks the cost of the attention rather than the quality of the answers.
+
+Every configuration of the grid (LLM type x eval mode x KB size x batch size x KB layer frequency x top-k) measures:
+- prefill: median latency of the forward pass over a batch of prompts, and the prompt tokens per second
+- decode: median latency per generated token of greedy decoding from the prefill cache, and the tokens per second
+- memory: peak memory (CUDA allocations or the resident set size on CPU) and its increase over the memory in use
+  before the configuration
+
+In icl mode the KB is text in the prompt, `--tokens_per_kb_entry` tokens per entry ("{key} is {value}; "), the
+prompts longer than `--max_icl_tokens` are skipped. The KB size does not apply to the zeroshot mode and the top-k
+(dynamic sparsification, Llama only) only applies to the kb mode, the skipped configurations are in the results with
+the reason they are skipped. The results are written to a JSON file for regression tracking.
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import platform
+import tempfile
+from pathlib import Path
+
+import torch
+import transformers
+from transformers import LlamaConfig, LlamaForCausalLM, Phi3Config, Phi3ForCausalLM
+from transformers.cache_utils import DynamicCache
+
+from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.llama3_model import KblamLlamaForCausalLM
+from kblam.models.phi3_model import KBLaMPhi3ForCausalLM
+from kblam.utils.benchmark_utils import memory_in_use, peak_memory, reset_peak_memory, time_func
+
+EVAL_MODES = ("kb", "icl", "zeroshot")
+LLM_TYPES = ("llama3", "phi3")
+
+
+def build_tiny_model(
+    llm_type: str,
+    model_dir: str | Path,
+    hidden_size: int = 64,
+    num_layers: int = 6,
+    num_heads: int = 4,
+    vocab_size: int = 1024,
+    max_position_embeddings: int = 16384,
+) -> KblamLlamaForCausalLM | KBLaMPhi3ForCausalLM:
+    """KBLaM model with random weights, the base model is saved to `model_dir` to be loaded by the KBLaM class"""
+    config_kwargs = dict(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=num_heads,
+        max_position_embeddings=max_position_embeddings,
+        pad_token_id=0,
+    )
+    if llm_type == "llama3":
+        LlamaForCausalLM(LlamaConfig(**config_kwargs)).save_pretrained(model_dir)
+        return KblamLlamaForCausalLM.from_pretrained(model_dir).eval()
+    if llm_type == "phi3":
+        config_kwargs["original_max_position_embeddings"] = max_position_embeddings
+        Phi3ForCausalLM(Phi3Config(attention_bias=False, **config_kwargs)).save_pretrained(model_dir)
+        return KBLaMPhi3ForCausalLM.from_pretrained(model_dir).eval()
+    raise ValueError(f"Unknown LLM type {llm_type}, expected one of {LLM_TYPES}")
+
+
+def expand_grid(
+    llm_types: list[str],
+    eval_modes: list[str],
+    kb_sizes: list[int],
+    batch_sizes: list[int],
+    kb_layer_frequencies: list[int],
+    top_k_kbs: list[int],
+) -> list[dict]:
+    """Configurations to measure, the KB size is 0 in zeroshot mode and the top-k is -1 (no sparsification) unless
+    in kb mode, so that the configurations the parameter does not apply to are only measured once"""
+    configs = []
+    for llm_type, eval_mode, kb_size, batch_size, kb_layer_frequency, top_k_kb in itertools.product(
+        llm_types, eval_modes, kb_sizes, batch_sizes, kb_layer_frequencies, top_k_kbs
+    ):
+        config = {
+            "llm_type": llm_type,
+            "eval_mode": eval_mode,
+            "kb_size": 0 if eval_mode == "zeroshot" else kb_size,
+            "batch_size": batch_size,
+            "kb_layer_frequency": kb_layer_frequency,
+            "top_k_kb": top_k_kb if eval_mode == "kb" else -1,
+        }
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def get_skip_reason(config: dict, prompt_len: int, max_icl_tokens: int) -> str | None:
+    if config["eval_mode"] == "icl" and prompt_len > max_icl_tokens:
+        return f"The prompt has {prompt_len} tokens, more than --max_icl_tokens {max_icl_tokens}"
+    if config["top_k_kb"] > 0 and config["llm_type"] != "llama3":
+        return "Dynamic sparsification is only implemented for Llama"
+    if config["top_k_kb"] > config["kb_size"]:
+        return "top_k_kb is greater than the KB size"
+    return None
+
+
+def measure(
+    model: KblamLlamaForCausalLM | KBLaMPhi3ForCausalLM,
+    config: dict,
+    prompt_len: int,
+    num_decode_tokens: int,
+    repeats: int,
+    seed: int,
+) -> dict:
+    device = model.device
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(
+        1, model.config.vocab_size, (config["batch_size"], prompt_len), generator=generator
+    ).to(device)
+    kb_kvs = None
+    kb_config = KBLaMConfig(
+        kb_layer_frequency=config["kb_layer_frequency"],
+        dynamic_sparsify=config["top_k_kb"] > 0,
+        top_k_kb=config["top_k_kb"],
+    )
+    if config["eval_mode"] == "kb":
+        num_kb_layers = model.config.num_hidden_layers // config["kb_layer_frequency"] + 1
+        kb_dim = model.config.hidden_size * num_kb_layers
+        kb_kvs = tuple(
+            torch.randn(config["kb_size"], kb_dim, generator=generator, dtype=model.dtype).to(device) for _ in range(2)
+        )
+
+    def forward(input_ids, past_key_values):
+        # No padding, the mask covers the cached tokens and the new ones
+        attention_mask = input_ids.new_ones(input_ids.shape[0], past_key_values.get_seq_length() + input_ids.shape[1])
+        return model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            kb_kvs=kb_kvs,
+            kb_config=kb_config,
+        )
+
+    def decode(past_key_values, next_token):
+        for _ in range(num_decode_tokens):
+            outputs = forward(next_token, past_key_values)
+            next_token = outputs.logits[:, -1:].argmax(-1)
+
+    memory_before = memory_in_use(device)
+    reset_peak_memory(device)
+    with torch.no_grad():
+        prefill_outputs = forward(input_ids, DynamicCache())
+        first_token = prefill_outputs.logits[:, -1:].argmax(-1)
+        prefill_latency = time_func(lambda: forward(input_ids, DynamicCache()), device, repeats=repeats)
+        # Every decoding starts from a copy of the prefill cache
+        decode_latency = time_func(
+            decode,
+            device,
+            repeats=repeats,
+            setup=lambda: (copy.deepcopy(prefill_outputs.past_key_values), first_token),
+        )
+    memory_peak = peak_memory(device)
+    decode_latency_per_token = decode_latency / num_decode_tokens
+    return {
+        "prompt_len": prompt_len,
+        "prefill_latency_s": prefill_latency,
+        "prefill_tokens_per_s": config["batch_size"] * prompt_len / prefill_latency,
+        "decode_latency_per_token_s": decode_latency_per_token,
+        "decode_tokens_per_s": config["batch_size"] / decode_latency_per_token,
+        "peak_memory_bytes": memory_peak,
+        "peak_memory_increase_bytes": (
+            memory_peak - memory_before if memory_peak is not None and memory_before is not None else None
+        ),
+    }
+
+
+def run_benchmark(
+    configs: list[dict],
+    device: str = "cpu",
+    hidden_size: int = 64,
+    num_layers: int = 6,
+    num_heads: int = 4,
+    question_tokens: int = 24,
+    tokens_per_kb_entry: int = 12,
+    max_icl_tokens: int = 8192,
+    num_decode_tokens: int = 16,
+    repeats: int = 3,
+    seed: int = 1,
+) -> list[dict]:
+    """Measures every configuration, one model per LLM type. Returns the configurations with their measurements."""
+    results = []
+    models = {}
+    with tempfile.TemporaryDirectory() as model_root:
+        for config in configs:
+            prompt_len = question_tokens
+            if config["eval_mode"] == "icl":
+                prompt_len += config["kb_size"] * tokens_per_kb_entry
+            skip_reason = get_skip_reason(config, prompt_len, max_icl_tokens)
+            if skip_reason is not None:
+                results.append({**config, "skipped": skip_reason})
+                print(f"{config} skipped: {skip_reason}")
+                continue
+
+            llm_type = config["llm_type"]
+            if llm_type not in models:
+                torch.manual_seed(seed)
+                models[llm_type] = build_tiny_model(
+                    llm_type,
+                    Path(model_root) / llm_type,
+                    hidden_size=hidden_size,
+                    num_layers=num_layers,
+                    num_heads=num_heads,
+                    max_position_embeddings=max(max_icl_tokens, question_tokens) + num_decode_tokens + 1,
+                ).to(device)
+            result = {
+                **config,
+                **measure(models[llm_type], config, prompt_len, num_decode_tokens, repeats, seed),
+            }
+            results.append(result)
+            print(
+                f"{config}: prefill {result['prefill_latency_s'] * 1e3:.1f} ms, "
+                f"decode {result['decode_latency_per_token_s'] * 1e3:.2f} ms/token, "
+                f"peak memory {result['peak_memory_bytes']}"
+            )
+    return results
+
+
+def get_environment(device: str) -> dict:
+    environment = {
+        "device": device,
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+    }
+    if torch.device(device).type == "cuda":
+        environment["gpu"] = torch.cuda.get_device_name(device)
+    return environment
+
+
+parser = argparse.ArgumentParser(description="Latency and memory benchmark of KB attention vs ICL vs zero-shot")
+parser.add_argument("--output", type=str, required=True, help="JSON file to write the results to")
+parser.add_argument("--device", type=str, default="cpu")
+parser.add_argument("--llm_types", type=str, nargs="+", default=list(LLM_TYPES), choices=LLM_TYPES)
+parser.add_argument("--eval_modes", type=str, nargs="+", default=list(EVAL_MODES), choices=EVAL_MODES)
+parser.add_argument("--kb_sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4])
+parser.add_argument("--kb_layer_frequencies", type=int, nargs="+", default=[3])
+parser.add_argument(
+    "--top_k_kbs",
+    type=int,
+    nargs="+",
+    default=[-1, 32],
+    help="Number of KB entries attended with dynamic sparsification, -1 to attend over the whole KB",
+)
+parser.add_argument("--hidden_size", type=int, default=64)
+parser.add_argument("--num_layers", type=int, default=6)
+parser.add_argument("--num_heads", type=int, default=4)
+parser.add_argument("--question_tokens", type=int, default=24, help="Number of tokens of the prompt without the KB")
+parser.add_argument("--tokens_per_kb_entry", type=int, default=12, help="Number of tokens of a KB entry in icl mode")
+parser.add_argument("--max_icl_tokens", type=int, default=8192, help="Longest prompt measured in icl mode")
+parser.add_argument("--num_decode_tokens", type=int, default=16)
+parser.add_argument("--repeats", type=int, default=3, help="Number of timed runs, the median is reported")
+parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads of torch")
+parser.add_argument("--seed", type=int, default=1)
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    configs = expand_grid(
+        args.llm_types, args.eval_modes, args.kb_sizes, args.batch_sizes, args.kb_layer_frequencies, args.top_k_kbs
+    )
+    results = run_benchmark(
+        configs,
+        device=args.device,
+        hidden_size=args.hidden_size,
+        num_layers=args.num_layers,
+        num_heads=args.num_heads,
+        question_tokens=args.question_tokens,
+        tokens_per_kb_entry=args.tokens_per_kb_entry,
+        max_icl_tokens=args.max_icl_tokens,
+        num_decode_tokens=args.num_decode_tokens,
+        repeats=args.repeats,
+        seed=args.seed,
+    )
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"environment": get_environment(args.device), "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
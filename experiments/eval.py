@@ -1,15 +1,17 @@
 """Script for evaluating KB models"""
 
 import argparse
+import copy
+import csv
 import json
 import os
 import re
-import shutil
+import time
+from collections import defaultdict
+from contextlib import ExitStack
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
-import evaluate
-import nltk
 import numpy as np
 import torch
 import transformers
@@ -18,9 +20,20 @@ from transformers import AutoTokenizer, logging
 
 from kblam.kb_encoder import KBEncoder
 from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.kblam_hooks import (
+    AttentionWeightsSaver,
+    KBAttentionAccuracyObserver,
+    KBAttentionScoreObserver,
+    KBTopK,
+)
 from kblam.models.llama3_model import KblamLlamaForCausalLM
 from kblam.models.phi3_model import KBLaMPhi3ForCausalLM
-from kblam.utils.data_utils import aug_row, generate_multi_entity_qa
+from kblam.utils.benchmark_utils import peak_memory, reset_peak_memory, synchronize
+from kblam.utils.checkpoint_utils import (
+    LLM_TRAINABLE_FILE_NAME,
+    load_trainable_state_dict,
+)
+from kblam.utils.data_utils import augment_row, generate_multi_entity_qa
 from kblam.utils.eval_utils import (
     instruction_prompts,
     instruction_prompts_multi_entities,
@@ -30,16 +43,14 @@ from kblam.utils.eval_utils import (
     _format_Q_phi3,
     model_prune_format_mapping,
     answer_question,
-    softmax,
+    PromptPrefixCache,
 )
+from kblam.utils.metric_utils import StreamingRouge, background_bert_score
+from kblam.utils.prediction_utils import PredictionWriter
 from kblam.utils.train_utils import get_kb_embd
 
-nltk.download("wordnet")
 logging.set_verbosity_warning()
 
-rouge = evaluate.load("rouge")
-bert_score = evaluate.load("bertscore")
-
 
 class KBRetriever:
     def __init__(
@@ -80,6 +91,40 @@ class KBRetriever:
             return get_kb_embd(self.encoder, batch_indices, kb_dict=self.dataset)
 
 
+def _make_prediction_record(
+    question: str,
+    prediction: str,
+    reference: str,
+    kb_rows: list[dict],
+    kb_ids: np.ndarray,
+    latency_s: float,
+    kb_topk: dict[int, KBTopK],
+    kb_idx: np.ndarray,
+) -> dict:
+    """
+    Record of an answered question. `kb_ids` are the dataset indices of the KB entries
+    the question is about and `kb_topk` has, for every layer attending over the KB, the
+    dataset indices and scores of its best scored KB entries (empty without KB).
+    """
+    return {
+        "question": question,
+        "prediction": prediction,
+        "reference": reference,
+        "evidence": "; ".join(
+            f"{row['key_string']} is {row['description']}" for row in kb_rows
+        ),
+        "kb_ids": [int(i) for i in kb_ids],
+        "latency_s": latency_s,
+        "kb_topk": {
+            str(layer_idx): {
+                "kb_ids": kb_idx[top.indices[0].cpu().numpy()].tolist(),
+                "scores": top.scores[0].tolist(),
+            }
+            for layer_idx, top in kb_topk.items()
+        },
+    }
+
+
 def perform_eval(
     model: KBLaMPhi3ForCausalLM | KblamLlamaForCausalLM,
     tokenizer: transformers.PreTrainedTokenizer,
@@ -92,7 +137,17 @@ def perform_eval(
     topk_size: int = -1,
     multi_entites: int = -1,
     remove_sorry: bool = False,
+    bert_score: bool = True,
+    bert_score_batch_size: int = 64,
+    bert_score_workers: int = 1,
+    predictions_file: Optional[str | Path] = None,
+    record_topk: int = 5,
 ):
+    """
+    predictions_file: JSONL file receiving a record per question as it is answered,
+        see `_make_prediction_record`
+    record_topk: Number of best scored KB entries of every layer in the kb mode records
+    """
     np.random.seed(seed)
     kb_idx = np.random.randint(0, len(kb_retriever.dataset), kb_size)
     test_kb = [kb_retriever.dataset[idx] for idx in kb_idx]
@@ -107,7 +162,17 @@ def perform_eval(
 
     model_outputs = []
     answers = []
-    full_outputs = []
+    # The metrics are computed as the outputs arrive, BERTScore on background workers
+    rouge = StreamingRouge()
+    icl_prompt = (
+        instruction_prompts_multi_entities if multi_entites != -1 else instruction_prompts
+    ) + prompt_strs
+    # The instruction and the KB are the same for every question, they are prefilled once
+    prefix_cache = (
+        PromptPrefixCache(tokenizer, model, icl_prompt, kb_config)
+        if eval_mode == "icl"
+        else None
+    )
     # answer_question
     subset_size = min(
         400, len(test_kb)
@@ -116,97 +181,113 @@ def perform_eval(
         400, len(test_kb)
     )  # Regardless of KB size, always test 250 questions, otherwise it will be too slow
     # subset_size = 50
-    for row in tqdm(test_kb[:subset_size]):
-        if multi_entites == -1:
-            Q = row["Q"]
-            answer = row["A"]
-        else:
-            kb_subset_idx = np.random.randint(0, len(test_kb), multi_entites)
-            Q, A = generate_multi_entity_qa(
-                [test_kb[i]["name"] for i in kb_subset_idx],
-                [test_kb[i]["description_type"] for i in kb_subset_idx],
-                [test_kb[i]["description"] for i in kb_subset_idx],
+    with ExitStack() as stack:
+        writer = (
+            stack.enter_context(PredictionWriter(predictions_file))
+            if predictions_file
+            else None
+        )
+        bert_scorer = None
+        if bert_score:
+            bert_scorer = background_bert_score(
+                batch_size=bert_score_batch_size, num_workers=bert_score_workers
             )
-            answer = A
-
-        if eval_mode == "kb":
-            model_output = answer_question(
-                tokenizer,
-                model,
-                Q,
-                kb=kb_embedding,
-                topk_size=topk_size,
-                kb_config=kb_config,
-            ).split(Q)[1]
-        elif eval_mode == "icl":
-            if multi_entites != -1:
-                ins_prompt = instruction_prompts_multi_entities
+            # The workers are stopped whether the generation succeeds or not
+            stack.callback(bert_scorer.close)
+        for i, row in enumerate(tqdm(test_kb[:subset_size])):
+            if multi_entites == -1:
+                Q = row["Q"]
+                answer = row["A"]
+                kb_subset_idx = [i]
             else:
-                ins_prompt = instruction_prompts
-            model_output = answer_question(
-                tokenizer,
-                model,
-                ins_prompt + prompt_strs + Q,
-                kb=None,
-                kb_config=kb_config,
-            ).split(Q)[1]
-        elif eval_mode == "zeroshot":
-            if multi_entites != -1:
-                ins_prompt = zero_shot_prompt_multi_entities
+                kb_subset_idx = np.random.randint(0, len(test_kb), multi_entites)
+                Q, A = generate_multi_entity_qa(
+                    [test_kb[i]["name"] for i in kb_subset_idx],
+                    [test_kb[i]["description_type"] for i in kb_subset_idx],
+                    [test_kb[i]["description"] for i in kb_subset_idx],
+                )
+                answer = A
+
+            start_time = time.perf_counter()
+            score_observer = KBAttentionScoreObserver(first_pass_only=True)
+            if eval_mode == "kb":
+                with model.kb_hooks.observe(score_observer):
+                    model_output = answer_question(
+                        tokenizer,
+                        model,
+                        Q,
+                        kb=kb_embedding,
+                        topk_size=topk_size,
+                        kb_config=kb_config,
+                    ).split(Q)[1]
+            elif eval_mode == "icl":
+                model_output = answer_question(
+                    tokenizer,
+                    model,
+                    icl_prompt + Q,
+                    kb=None,
+                    kb_config=kb_config,
+                    prefix_cache=prefix_cache,
+                ).split(Q)[1]
+            elif eval_mode == "zeroshot":
+                if multi_entites != -1:
+                    ins_prompt = zero_shot_prompt_multi_entities
+                else:
+                    ins_prompt = zero_shot_prompt
+                model_output = answer_question(
+                    tokenizer, model, ins_prompt + Q, kb=None, kb_config=kb_config
+                ).split(Q)[1]
+            latency_s = time.perf_counter() - start_time
+            # print(model_output)
+            if remove_sorry:
+                if "sorry" in model_output:
+                    continue
+            if writer is not None:
+                writer.write(
+                    _make_prediction_record(
+                        Q,
+                        model_output,
+                        answer,
+                        [test_kb[j] for j in kb_subset_idx],
+                        kb_idx[kb_subset_idx],
+                        latency_s,
+                        score_observer.topk(record_topk),
+                        kb_idx,
+                    )
+                )
+            if multi_entites == -1:
+                pattern = r'The\s+\w+\s+of\s+[^"]+\s+is\s+(.+)'
+                match = re.search(pattern, model_output)
+                answers.append(row["description"])
+                if match:
+                    model_output = match.group(1)
             else:
-                ins_prompt = zero_shot_prompt
-            model_output = answer_question(
-                tokenizer, model, ins_prompt + Q, kb=None, kb_config=kb_config
-            ).split(Q)[1]
-        # print(model_output)
-        if remove_sorry:
-            if "sorry" in model_output:
-                continue
-        full_outputs.append((model_output, answer))
-        if multi_entites == -1:
-            pattern = r'The\s+\w+\s+of\s+[^"]+\s+is\s+(.+)'
-            match = re.search(pattern, model_output)
-            answers.append(row["description"])
-            if match:
-                model_output = match.group(1)
-        else:
-            pattern = r"(?:is|are) (.*?)(?:\.|;)"
-            matches = re.findall(pattern, model_output)
-            model_output = "; ".join(matches)
-            answers.append(";".join(re.findall(r"(?:is|are) (.*?);", answer)))
-        model_outputs.append(model_output)
+                pattern = r"(?:is|are) (.*?)(?:\.|;)"
+                matches = re.findall(pattern, model_output)
+                model_output = "; ".join(matches)
+                answers.append(";".join(re.findall(r"(?:is|are) (.*?);", answer)))
+            model_outputs.append(model_output)
+            rouge.add(model_output, answers[-1])
+            if bert_scorer is not None:
+                bert_scorer.add(model_output, answers[-1])
+        bertscore = bert_scorer.compute() if bert_scorer is not None else None
 
     print(f"KB size: {kb_size}, mode: {eval_mode}")
-    rouge = evaluate.load("rouge")
 
     for pred, gt in zip(model_outputs, answers):
         print(f"PREDICTION: {pred}")
         print(f"GT: {gt}")
-    rouge_scores = rouge.compute(predictions=model_outputs, references=answers)
+    rouge_scores = rouge.compute()
     print(rouge_scores)
 
-    results_dict = {k: float(v) for k, v in rouge_scores.items()}
+    results_dict = dict(rouge_scores)
 
-    bertscore = bert_score.compute(
-        predictions=model_outputs,
-        references=answers,
-        lang="en",
-        model_type="microsoft/deberta-xlarge-mnli",
-    )
-    # bert_scores = []
-    # bert_scores = {}
-    for k, v in bertscore.items():
-        if isinstance(v, list):
-            # bert_scores.append(np.mean(v))
-            results_dict[f"bert_score_{k}"] = float(np.mean(v))
-            print(k, np.mean(v))
-    results = ""
-    for a, A in full_outputs:
-        results += f"Model output: {a}\nTrue answer: {A}\n-------\n"
-    if eval_mode == "kb":
-        eval_mode = encoder_model_spec + eval_mode
-
-    return results, results_dict
+    if bertscore is not None:
+        for k, v in bertscore.items():
+            results_dict[f"bert_score_{k}"] = v
+            print(k, v)
+
+    return results_dict
 
 
 def perform_eval_refusal(
@@ -220,7 +301,10 @@ def perform_eval_refusal(
     outlier_ratio: float = 0.2,
     topk_size: int = -1,
     question_size: int = 100,
+    predictions_file: Optional[str | Path] = None,
+    record_topk: int = 5,
 ):
+    """See `perform_eval`, the records of the outlier questions have is_outlier set."""
     instruction_prompts = (
         'Please answer questions based on the given text with format: "The {property} of {name} is {description}",'
         ' if relevant information cannot be found in the text, please respond "I am sorry I cannot find relevant information in the KB".'
@@ -243,6 +327,13 @@ def perform_eval_refusal(
 
     model_outputs = []
     answers = []
+    prefix_cache = (
+        PromptPrefixCache(
+            tokenizer, model, instruction_prompts + prompt_strs, kb_config
+        )
+        if eval_mode == "icl"
+        else None
+    )
     # answer_question
     outlier_idx = np.arange(len(kb_retriever.dataset))
     outlier_idx = outlier_idx[~np.isin(outlier_idx, kb_idx)]
@@ -253,46 +344,68 @@ def perform_eval_refusal(
         kb_retriever.dataset[idx] for idx in outlier_idx
     ]
     change_point = int(question_size * (1 - outlier_ratio))
-    for i, row in tqdm(enumerate(test_kb)):
-        Q = row["Q"]
-        if eval_mode == "kb":
-            model_output = answer_question(
-                tokenizer,
-                model,
-                Q,
-                kb=kb_embedding,
-                topk_size=topk_size,
-                kb_config=kb_config,
-            ).split(Q)[1]
-
-        elif eval_mode == "icl":
-            model_output = answer_question(
-                tokenizer,
-                model,
-                instruction_prompts + prompt_strs + Q,
-                kb=None,
-                kb_config=kb_config,
-            ).split(Q)[1]
-        elif eval_mode == "zeroshot":
-            model_output = answer_question(
-                tokenizer,
-                model,
-                zero_shot_prompt + Q,
-                kb=None,
-                kb_config=kb_config,
-            ).split(Q)[1]
-        model_outputs.append(model_output)
-        if i < change_point:
-            answers.append(row["description"])
-        else:
-            answers.append("Cannot find relevant information in the KB")
+    # Dataset index of every question
+    question_idx = np.concatenate([kb_idx[:change_point], outlier_idx])
+    with ExitStack() as stack:
+        writer = (
+            stack.enter_context(PredictionWriter(predictions_file))
+            if predictions_file
+            else None
+        )
+        for i, row in tqdm(enumerate(test_kb)):
+            Q = row["Q"]
+            start_time = time.perf_counter()
+            score_observer = KBAttentionScoreObserver(first_pass_only=True)
+            if eval_mode == "kb":
+                with model.kb_hooks.observe(score_observer):
+                    model_output = answer_question(
+                        tokenizer,
+                        model,
+                        Q,
+                        kb=kb_embedding,
+                        topk_size=topk_size,
+                        kb_config=kb_config,
+                    ).split(Q)[1]
+
+            elif eval_mode == "icl":
+                model_output = answer_question(
+                    tokenizer,
+                    model,
+                    instruction_prompts + prompt_strs + Q,
+                    kb=None,
+                    kb_config=kb_config,
+                    prefix_cache=prefix_cache,
+                ).split(Q)[1]
+            elif eval_mode == "zeroshot":
+                model_output = answer_question(
+                    tokenizer,
+                    model,
+                    zero_shot_prompt + Q,
+                    kb=None,
+                    kb_config=kb_config,
+                ).split(Q)[1]
+            latency_s = time.perf_counter() - start_time
+            model_outputs.append(model_output)
+            if i < change_point:
+                answers.append(row["description"])
+            else:
+                answers.append("Cannot find relevant information in the KB")
+            if writer is not None:
+                record = _make_prediction_record(
+                    Q,
+                    model_output,
+                    answers[-1],
+                    [row],
+                    question_idx[i : i + 1],
+                    latency_s,
+                    score_observer.topk(record_topk),
+                    kb_idx,
+                )
+                writer.write({**record, "is_outlier": i >= change_point})
     true_label = [0] * change_point + [1] * int(question_size * outlier_ratio)
     prediction = [int("sorry" in model_output) for model_output in model_outputs]
     print(f"KB size: {kb_size}, mode: {eval_mode}, outlier ratio: {outlier_ratio}")
-    results = ""
-    for a, A in zip(model_outputs, answers):
-        results += f"Model output: {a}\nTrue answer: {A}\n-------\n"
-    return results, np.array([prediction, true_label])
+    return np.array([prediction, true_label])
 
 
 parser = argparse.ArgumentParser(description="Evaluation script")
@@ -422,6 +535,12 @@ acc_parser = subparsers.add_parser(
 acc_parser.add_argument(
     "--attn_save_dir", type=str, default="", help="Directory to save attention masks"
 )
+acc_parser.add_argument(
+    "--save_attention_weights",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Also dump the full attention weights of every KB layer as .npy files to attn_save_dir",
+)
 acc_parser.add_argument(
     "--exp_config_name",
     type=str,
@@ -438,7 +557,13 @@ acc_parser.add_argument(
     "--log_save_dir", type=str, help="Directory to save accuracy results"
 )
 acc_parser.add_argument(
-    "--test_batch_size", type=int, default=50, help="Batch size for testing"
+    "--test_batch_size", type=int, default=50, help="Number of questions to test"
+)
+acc_parser.add_argument(
+    "--micro_batch_size",
+    type=int,
+    default=50,
+    help="Number of questions per forward pass",
 )
 acc_parser.add_argument(
     "--use_shift_match",
@@ -451,6 +576,19 @@ acc_parser.add_argument(
 acc_results_parser = subparsers.add_parser(
     "acc_results", parents=[acc_parser], help="run accuracy eval", add_help=False
 )
+acc_results_parser.add_argument(
+    "--kb_sizes",
+    type=int,
+    nargs="+",
+    default=[50, 100, 200, 400, 800, 1600, 3200, 6400],
+    help="KB sizes to sweep, the largest KB is encoded once and the others are its prefixes",
+)
+acc_results_parser.add_argument(
+    "--num_queries",
+    type=int,
+    default=None,
+    help="Maximum number of questions asked for every KB size, one per KB entry by default",
+)
 
 
 # Create the parser for the refusal command
@@ -539,6 +677,12 @@ basic_parser.add_argument(
 basic_parser.add_argument(
     "--sample_size", default=5, type=int, help="Number of samples to process"
 )
+basic_parser.add_argument(
+    "--save_attention_weights",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Also dump the full attention weights of every KB layer as .npy files to save_dir",
+)
 basic_parser.add_argument(
     "--subset_size", default=100, type=int, help="Size of the data subset to use"
 )
@@ -588,7 +732,9 @@ def eval_generate():
         precomputed_embed_values_path=precomputed_embed_values_path,
     )
 
-    gen_results, score_results = perform_eval(
+    reset_peak_memory(model.device)
+    start_time = time.perf_counter()
+    score_results = perform_eval(
         model,
         tokenizer,
         kb_retriever,
@@ -599,15 +745,15 @@ def eval_generate():
         kb_size=kb_size,
         topk_size=args.topk_size,
         multi_entites=args.multi_entites,
+        predictions_file=Path(args.save_dir) / f"{exp_config}.jsonl",
     )
-    mem_cost = torch.cuda.max_memory_reserved("cuda")
-    score_results["mem_cost"] = mem_cost
+    score_results["duration_s"] = time.perf_counter() - start_time
+    # Peak memory allocated on CUDA, peak resident set size on CPU
+    score_results["mem_cost"] = peak_memory(model.device)
 
     (Path(args.save_dir) / exp_config).mkdir(exist_ok=True, parents=True)
     write_to_json(score_results, Path(args.save_dir) / f"{exp_config}.json")
     print(score_results)
-    text_file = open(os.path.join(args.save_dir, exp_config + ".txt"), "w")
-    text_file.write(gen_results)
 
 
 def _prepare_models(
@@ -619,35 +765,44 @@ def _prepare_models(
     query_head_path,
     kb_layer_frequency,
     kb_scale_factor,
+    device="cuda",
 ):
     tokenizer = AutoTokenizer.from_pretrained(
         llm_base_dir, trust_remote_code=True, padding_side="left"
     )
     tokenizer.pad_token = "^"
 
+    # Checkpoints written by train.py only contain the trainable weights,
+    # the frozen weights come from the base model
+    trainable_ckpt = os.path.join(model_path, LLM_TRAINABLE_FILE_NAME)
+    from_trainable_ckpt = os.path.isfile(trainable_ckpt)
+    pretrained_path = llm_base_dir if from_trainable_ckpt else model_path
+
     if llm_type == "llama3":
         if query_head_path:
             model = KblamLlamaForCausalLM.from_pretrained(
-                model_path,
-                device_map="cuda",
+                pretrained_path,
+                device_map=device,
                 torch_dtype="auto",
                 trust_remote_code=True,
             )
             model.load_query_head(query_head_path)
         else:
             model = KblamLlamaForCausalLM.from_pretrained(
-                model_path,
-                device_map="cuda",
+                pretrained_path,
+                device_map=device,
                 torch_dtype="auto",
                 trust_remote_code=True,
             )
     else:
         model = KBLaMPhi3ForCausalLM.from_pretrained(
-            model_path,
-            device_map="cuda",
+            pretrained_path,
+            device_map=device,
             torch_dtype="auto",
             trust_remote_code=True,
         )
+    if from_trainable_ckpt:
+        load_trainable_state_dict(model, trainable_ckpt)
     model.generation_config.pad_token_id = tokenizer.pad_token_id
     model.generation_config.eos_token_id = tokenizer.eos_token_id
     model.eval()
@@ -670,10 +825,10 @@ def _prepare_models(
         * (model.config.num_hidden_layers // kb_layer_frequency + 1),
         frozen_base_model=True,
         projector_kwargs={"mlp_depth": 1, "mlp_hidden_dim": 512},
-        device=torch.device("cuda"),
+        device=torch.device(device),
     )
 
-    encoder.load_state_dict(torch.load(encoder_path))
+    encoder.load_state_dict(torch.load(encoder_path, map_location=device))
     return tokenizer, encoder, model, kb_config
 
 
@@ -690,11 +845,13 @@ def eval_accuracy(
     test_batch_size,
     save_dir,
     attn_save_dir,
+    save_attention_weights=False,
+    micro_batch_size=50,
 ):
     """Evaluate accuracy using KB"""
 
     if kb_size == len(dataset):
-        dataset_subset_idx = range(len(dataset))
+        dataset_subset_idx = np.arange(len(dataset))
     elif kb_size > len(dataset):
         raise IndexError(
             f"The KB size {kb_size} is greater than the dataset size {len(dataset)}"
@@ -704,68 +861,42 @@ def eval_accuracy(
 
     dataset_subset = [dataset[i] for i in dataset_subset_idx]
 
-    kb_embedding_real = kb_retriever.get_key_embeddings(dataset_subset_idx)
-
-    format_func_map = {"llama3": _format_Q_llama, "phi3": _format_Q_phi3}
-
-    if not fancy_question:
-        input_strs_gen = (dataset_subset[i]["Q"] for i in range(test_batch_size))
-    else:
-        input_strs_gen = (aug_row(dataset_subset[i]) for i in range(test_batch_size))
-    input_strs = [format_func_map[llm_type](ex) for ex in input_strs_gen]
-
-    tokenizer_output = tokenizer(input_strs, return_tensors="pt", padding=True).to(
-        "cuda"
-    )
-    input_ids, attention_masks = (
-        tokenizer_output["input_ids"],
-        tokenizer_output["attention_mask"],
-    )
-
     with torch.autograd.no_grad():
-        outputs = model.generate(
-            input_ids=input_ids,
-            attention_mask=attention_masks,
-            kb_kvs=kb_embedding_real,
-            max_new_tokens=60,
-            tokenizer=tokenizer,
-            output_attentions=True,
-            save_attention_weights=True,
-            kb_config=kb_config,
-            attention_save_loc=attn_save_dir,
-            attention_file_base_name=exp_config,
+        kb_embedding_real = kb_retriever.get_key_embeddings(dataset_subset_idx)
+
+    format_func = {"llama3": _format_Q_llama, "phi3": _format_Q_phi3}[llm_type]
+    # The questions are about the first `test_batch_size` entries of the KB
+    labels = np.arange(min(test_batch_size, kb_size))
+    questions = [
+        format_func(
+            augment_row(dataset_subset[i]) if fancy_question else dataset_subset[i]["Q"]
         )
-        outputs = tokenizer.batch_decode(outputs.squeeze(), skip_special_tokens=False)
-
-    save_path = Path(save_dir)
-    save_path.mkdir(exist_ok=True, parents=True)
-
-    with open(save_path / f"{exp_config}_acc.txt", "w+") as text_file:
-        for output in outputs:
-            output_string = output.strip("^")
-            text_file.write(f"{str(output_string)}\n")
+        for i in labels
+    ]
 
-    accs = []
-    with torch.autograd.no_grad():
-        for idx in range(0, 32, kb_config.kb_layer_frequency):
-            weight = np.load(os.path.join(attn_save_dir, f"{exp_config}_{idx}.npy"))
-            weight = weight[..., :kb_size]
-            label = np.arange(test_batch_size)
-            weight = weight.reshape(test_batch_size, -1, kb_size)
-            acc = (weight.sum(1).argmax(1) == label).mean()
-            top_5_predictions = torch.topk(torch.from_numpy(weight.sum(1)), 5, dim=1)[1]
-            top_5_acc = (top_5_predictions.numpy() == label[:, None]).any(1).mean()
-            if idx == 15:
-                print(f"ACC & TOP 5 ACC: {idx} {(acc, top_5_acc)}")
-                print(f"min: {np.min(weight)}  max: {np.max(weight)}")
-            accs.append(
-                {
-                    "idx": idx,
-                    "acc": float(acc),
-                    "top5acc": float(top_5_acc),
-                }
+    observers = []
+    if save_attention_weights:
+        # Every pass overwrites the dumps, keep all the questions in a single pass
+        micro_batch_size = len(questions)
+        observers.append(AttentionWeightsSaver(attn_save_dir, exp_config))
+    accs = eval_retrieval_accuracy(
+        tokenizer,
+        model,
+        questions,
+        labels,
+        kb_embedding_real,
+        kb_config,
+        micro_batch_size,
+        observers=observers,
+    )
+    for layer_acc in accs:
+        if layer_acc["idx"] == 15:
+            print(
+                f"ACC & TOP 5 ACC: {layer_acc['idx']} {(layer_acc['acc'], layer_acc['top5acc'])}"
             )
 
+    save_path = Path(save_dir)
+    save_path.mkdir(exist_ok=True, parents=True)
     np.save(
         save_path / f"{exp_config}_acc.npy",
         np.array([(a["acc"], a["top5acc"]) for a in accs]),
@@ -774,6 +905,154 @@ def eval_accuracy(
     return accs
 
 
+def _prefill_position_ids(attention_mask: torch.Tensor) -> torch.Tensor:
+    """Position ids of a left padded batch, as computed by `generate` for the prefill pass"""
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    return position_ids.masked_fill(attention_mask == 0, 1)
+
+
+def eval_retrieval_accuracy(
+    tokenizer,
+    model,
+    questions,
+    labels,
+    kb_kvs,
+    kb_config,
+    micro_batch_size,
+    observers=(),
+):
+    """
+    Retrieval accuracy of every KB layer, the i-th question is about the KB entry `labels[i]`.
+    Only the prefill pass up to the last KB layer runs, nothing is generated. The questions go through it in
+    micro-batches of `micro_batch_size` and the accuracy is reduced after every micro-batch, so the memory does not
+    grow with the number of questions.
+    observers: Extra KB attention observers registered during the passes
+    The dynamic sparsification of `kb_config` is disabled, so that every KB entry is scored.
+
+    Returns one dictionary per KB layer with the top-1 accuracy, the top-5 accuracy and the confidence.
+    """
+    labels = np.asarray(labels)
+    if len(labels) != len(questions):
+        raise ValueError(f"Got {len(labels)} labels for {len(questions)} questions")
+    # The accuracy observer needs the KB columns in KB order, not the top-k
+    if kb_config.dynamic_sparsify:
+        kb_config = copy.copy(kb_config)
+        kb_config.dynamic_sparsify = False
+    # The layers after the last KB layer and the LM head do not change the KB attention
+    last_kb_layer = kb_config.get_kb_layer_indices(model.config.num_hidden_layers)[-1]
+    attention_observer = KBAttentionAccuracyObserver()
+    num_correct = defaultdict(lambda: np.zeros(2))
+    confidences = defaultdict(float)
+    with torch.autograd.no_grad(), model.kb_hooks.observe(attention_observer, *observers):
+        for start in range(0, len(questions), micro_batch_size):
+            batch_labels = labels[start : start + micro_batch_size]
+            tokenizer_output = tokenizer(
+                questions[start : start + micro_batch_size],
+                return_tensors="pt",
+                padding=True,
+            ).to(model.device)
+            model(
+                input_ids=tokenizer_output["input_ids"],
+                attention_mask=tokenizer_output["attention_mask"],
+                position_ids=_prefill_position_ids(tokenizer_output["attention_mask"]),
+                kb_kvs=kb_kvs,
+                kb_config=kb_config,
+                exit_after_layer=last_kb_layer,
+            )
+            for idx in attention_observer.kb_attention:
+                layer_acc = attention_observer.accuracy(batch_labels, layers=[idx], topk=5)
+                num_correct[idx] += len(batch_labels) * np.array(
+                    [layer_acc["acc"], layer_acc["topk_acc"]]
+                )
+                # The confidence is the largest probability over the questions
+                confidences[idx] = max(confidences[idx], layer_acc["confidence"])
+            attention_observer.reset()
+    return [
+        {
+            "idx": idx,
+            "acc": float(num_correct[idx][0] / len(labels)),
+            "top5acc": float(num_correct[idx][1] / len(labels)),
+            "confidence": confidences[idx],
+        }
+        for idx in sorted(num_correct)
+    ]
+
+
+def eval_accuracy_sweep(
+    tokenizer,
+    kb_retriever,
+    model,
+    dataset,
+    fancy_question,
+    kb_config,
+    kb_sizes,
+    llm_type,
+    num_queries,
+    micro_batch_size,
+):
+    """
+    Retrieval accuracy for every KB size in `kb_sizes`, from a single encoding of the largest KB.
+    The smaller KBs are nested prefixes of the largest one and the questions of a KB size are asked about its first
+    `min(kb_size, num_queries)` entries (all of them if `num_queries` is None), so the label of the i-th question
+    is i. See `eval_retrieval_accuracy`.
+
+    Returns the results as columns (one row per KB size and KB layer), with the latency of the prefill passes and
+    the peak memory of every KB size (see `peak_memory`).
+    """
+    kb_sizes = sorted(kb_sizes)
+    if kb_sizes[-1] > len(dataset):
+        raise IndexError(
+            f"The KB size {kb_sizes[-1]} is greater than the dataset size {len(dataset)}"
+        )
+    num_queries = num_queries or kb_sizes[-1]
+    dataset_subset_idx = np.random.permutation(len(dataset))[: kb_sizes[-1]]
+    with torch.autograd.no_grad():
+        key_embds, value_embds = kb_retriever.get_key_embeddings(dataset_subset_idx)
+
+    format_func = {"llama3": _format_Q_llama, "phi3": _format_Q_phi3}[llm_type]
+    questions = [
+        format_func(augment_row(dataset[i]) if fancy_question else dataset[i]["Q"])
+        for i in dataset_subset_idx[: min(kb_sizes[-1], num_queries)]
+    ]
+
+    device = model.device
+    columns = defaultdict(list)
+    for kb_size in kb_sizes:
+        print(f"kb_size {kb_size}")
+        labels = np.arange(min(kb_size, num_queries))
+        reset_peak_memory(device)
+        synchronize(device)
+        start_time = time.perf_counter()
+        accs = eval_retrieval_accuracy(
+            tokenizer,
+            model,
+            questions[: len(labels)],
+            labels,
+            (key_embds[:kb_size], value_embds[:kb_size]),
+            kb_config,
+            micro_batch_size,
+        )
+        synchronize(device)
+        latency = time.perf_counter() - start_time
+        peak_memory_bytes = peak_memory(device)
+
+        for layer_acc in accs:
+            columns["kb_size"].append(kb_size)
+            columns["num_queries"].append(len(labels))
+            for key in ["idx", "acc", "top5acc", "confidence"]:
+                columns[key].append(layer_acc[key])
+            columns["latency_s"].append(latency)
+            columns["peak_memory_bytes"].append(peak_memory_bytes)
+    return dict(columns)
+
+
+def write_columns_to_csv(columns: dict[str, list], filepath: str | Path):
+    with open(filepath, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*columns.values()))
+
+
 def eval_accuracy_cli():
     """Evaluate accuracy using KB"""
     args = parser.parse_args()
@@ -827,6 +1106,8 @@ def eval_accuracy_cli():
         test_batch_size,
         args.log_save_dir,
         args.attn_save_dir,
+        save_attention_weights=args.save_attention_weights,
+        micro_batch_size=args.micro_batch_size,
     )
 
 
@@ -902,30 +1183,23 @@ def run_accuracy_evalution():
         precomputed_embed_values_path=precomputed_embed_values_path,
     )
 
-    xs = [50, 100, 200, 400, 800, 1600, 3200, 6400]
-    accuracy_results = []
-    for x in xs:
-        print(f"kb_size {x}")
-
-        accs = eval_accuracy(
-            tokenizer,
-            kb_retriever,
-            model,
-            dataset,
-            exp_config,
-            fancy_question,
-            kb_config,
-            x,
-            llm_type,
-            min(x, 200),
-            args.log_save_dir,
-            args.attn_save_dir,
-        )
-        shutil.rmtree(args.attn_save_dir)
-        os.mkdir(args.attn_save_dir)
-        accuracy_results.append({"kb_size": x, "accuracy_results": accs})
-    write_to_json(
-        accuracy_results, os.path.join(args.log_save_dir, "accuracy_results.json")
+    if args.seed is not None:
+        np.random.seed(args.seed)
+    accuracy_results = eval_accuracy_sweep(
+        tokenizer,
+        kb_retriever,
+        model,
+        dataset,
+        fancy_question,
+        kb_config,
+        args.kb_sizes,
+        llm_type,
+        args.num_queries,
+        args.micro_batch_size,
+    )
+    Path(args.log_save_dir).mkdir(exist_ok=True, parents=True)
+    write_columns_to_csv(
+        accuracy_results, os.path.join(args.log_save_dir, f"{exp_config}.csv")
     )
 
 
@@ -969,7 +1243,7 @@ def eval_refusal():
         precomputed_embed_values_path=precomputed_embed_values_path,
     )
 
-    gen_results, refusal_results = perform_eval_refusal(
+    refusal_results = perform_eval_refusal(
         model,
         tokenizer,
         kb_retriever,
@@ -978,13 +1252,12 @@ def eval_refusal():
         kb_size=kb_size,
         topk_size=args.topk_size,
         kb_config=kb_config,
+        predictions_file=os.path.join(
+            args.save_dir, "OutLierTest" + exp_config + ".jsonl"
+        ),
     )
 
     np.save(os.path.join(args.save_dir, "OutLierTest" + exp_config), refusal_results)
-    text_file = open(
-        os.path.join(args.save_dir, "OutLierTest" + exp_config + ".txt"), "w"
-    )
-    text_file.write(gen_results)
 
 
 def eval():
@@ -1024,7 +1297,6 @@ def eval():
     torch.manual_seed(seed)
     np.random.seed(seed)
 
-    os.environ["ATTN_SAVE_DIR"] = output_dir
     os.environ["EVAL_MODE"] = "1"
 
     tokenizer, encoder, model, kb_config = _prepare_models(
@@ -1062,6 +1334,9 @@ def eval():
     no_kb_predictions = []
     predictions = []
     answer = []
+    rouge, rouge_no_kb = StreamingRouge(), StreamingRouge()
+    attention_observer = KBAttentionAccuracyObserver()
+    observers = [attention_observer]
 
     for _ in range(sample_size):
         print("******")
@@ -1090,6 +1365,8 @@ def eval():
         kb_embedding_real = (kb_embedding_real[0], kb_embedding_real[1])
 
         config_str = f"{exp_config_str}__kb_{subset_size}__seed_{seed}"
+        if args.save_attention_weights:
+            observers = [attention_observer, AttentionWeightsSaver(output_dir, config_str)]
         with torch.autograd.no_grad():
             outputs_no_kb = model.generate(
                 input_ids=input_ids,
@@ -1101,18 +1378,16 @@ def eval():
                 kb_config=kb_config,
             )
 
-            outputs_true_kb = model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_masks,
-                kb_kvs=kb_embedding_real,
-                max_new_tokens=40,
-                tokenizer=tokenizer,
-                output_attentions=True,
-                save_attention_weights=True,
-                attention_save_loc=output_dir,
-                attention_file_base_name=config_str,
-                kb_config=kb_config,
-            )
+            with model.kb_hooks.observe(*observers):
+                outputs_true_kb = model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_masks,
+                    kb_kvs=kb_embedding_real,
+                    max_new_tokens=40,
+                    tokenizer=tokenizer,
+                    output_attentions=True,
+                    kb_config=kb_config,
+                )
         print("decoding")
         outputs_no_kb = tokenizer.batch_decode(outputs_no_kb, skip_special_tokens=False)
 
@@ -1142,15 +1417,17 @@ def eval():
                 prune_str(outputs_true_kb[i]).split(dataset_subset[i]["Q"])[1]
             )
             answer.append(dataset_subset[i]["A"])
+            rouge.add(predictions[-1], answer[-1])
+            rouge_no_kb.add(no_kb_predictions[-1], answer[-1])
             print("--------------------")
         print("******")
 
-    rogue_score = rouge.compute(predictions=predictions, references=answer)
+    rogue_score = rouge.compute()
     np.savez(
         os.path.join(attn_summary_save_dir, f"{config_str}_rouge.npy"), **rogue_score
     )
 
-    rogue_score_no_kb = rouge.compute(predictions=no_kb_predictions, references=answer)
+    rogue_score_no_kb = rouge_no_kb.compute()
     np.savez(
         os.path.join(attn_summary_save_dir, f"{config_str}_rouge_no_kb.npy"),
         **rogue_score_no_kb,
@@ -1159,28 +1436,15 @@ def eval():
     # Start inspecting attention masks
     ranges = [(0, 6), (6, 12), (12, 18), (18, 24), (24, 30), (30, 32)]
 
-    save_dir = output_dir
     Path(args.save_dir).mkdir(exist_ok=True, parents=True)
 
     accs, confidences = [], []
     for left, right in ranges:
-        weights = []
-        kb_size = subset_size
-        for idx in range(32)[left:right]:
-            if idx % 3 == 0:
-                weight = np.load(os.path.join(save_dir, f"{config_str}_{idx}.npy"))
-                weights.append(weight[..., :kb_size].reshape(kb_size, -1, kb_size))
-        print(len(weights))
-        weights = np.stack(weights)
-        weights = weights.transpose(1, 0, 2, 3).reshape(kb_size, -1, kb_size)
-        acc = (weights.sum(1).argmax(1) == np.arange(kb_size)).mean()
-        top_5_predictions = torch.topk(torch.from_numpy(weights.sum(1)), 5, dim=1)[1]
-        top_5_acc = (
-            (top_5_predictions == torch.arange(kb_size)[:, None]).any(1).float().mean()
+        range_acc = attention_observer.accuracy(
+            np.arange(subset_size), layers=range(left, right), topk=5
         )
-        accs.append((acc, top_5_acc))
-        confidence = softmax(weights.mean(1), -1).max()
-        confidences.append(confidence)
+        accs.append((range_acc["acc"], range_acc["topk_acc"]))
+        confidences.append(range_acc["confidence"])
     np.save(
         os.path.join(attn_summary_save_dir, f"{config_str}_acc.npy"), np.array(accs)
     )
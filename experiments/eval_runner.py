@@ -0,0 +1,235 @@
+"""
+Runs a matrix of generation / refusal evaluations, e.g. every combination of seeds, KB sizes and eval modes.
+Each worker process loads the model once and runs the evaluations it is given, the results of all the evaluations are
+appended to a single JSONL store and the evaluations already in the store are skipped.
+
+The matrix spec is a JSON file:
+{
+    "command": "generation",  # or "refusal"
+    "bert_score": true,  # Optional, whether the generation evaluations compute BERTScore
+    "model": {  # How to load the model, the arguments of eval.py with the same names
+        "llm_type": "llama3", "llm_base_dir": ..., "model_dir": ..., "encoder_dir": ..., "encoder_spec": "OAI",
+        "kb_layer_frequency": 3, "dataset_dir": ..., "test_dataset": ...,
+        "precomputed_embed_keys_path": ..., "precomputed_embed_values_path": ...
+    },
+    "matrix": {  # Lists of values, any key of JOB_DEFAULTS
+        "seed": [1, 2], "kb_size": [100, 1000], "eval_mode": ["kb", "icl", "zeroshot"]
+    }
+}
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import torch
+
+from eval import KBRetriever, _prepare_models, perform_eval, perform_eval_refusal
+from kblam.models.kblam_config import KBLaMConfig
+
+# Parameters of a single evaluation, the model is the same for all of them
+JOB_DEFAULTS = {
+    "seed": 1,
+    "kb_size": 250,
+    "eval_mode": "kb",
+    "topk_size": -1,
+    "kb_scale_factor": None,
+    "multi_entites": -1,
+    "remove_sorry": False,
+}
+COMMANDS = ("generation", "refusal")
+
+# Set in every worker process by `_init_worker`
+_worker_state = {}
+
+
+def expand_matrix(matrix: dict[str, list]) -> list[dict]:
+    unknown_keys = set(matrix) - set(JOB_DEFAULTS)
+    if unknown_keys:
+        raise ValueError(f"Unknown matrix keys {sorted(unknown_keys)}, expected some of {list(JOB_DEFAULTS)}")
+    keys = sorted(matrix)
+    return [{**JOB_DEFAULTS, **dict(zip(keys, values))} for values in itertools.product(*(matrix[k] for k in keys))]
+
+
+def get_job_name(command: str, job: dict) -> str:
+    return "__".join([command] + [f"{key}_{job[key]}" for key in sorted(job)])
+
+
+class ResultStore:
+    """Append-only JSONL file with one record per evaluation, only written by the main process"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.names = set()
+        if self.path.exists():
+            with open(self.path) as f:
+                self.names = {json.loads(line)["name"] for line in f if line.strip()}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def append(self, record: dict):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.names.add(record["name"])
+
+
+def _init_worker(model_spec: dict, devices: mp.Queue, num_threads: int | None):
+    device = devices.get()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    tokenizer, encoder, model, _ = _prepare_models(
+        model_spec["encoder_spec"],
+        model_spec["encoder_dir"],
+        model_spec["llm_type"],
+        model_spec["llm_base_dir"],
+        model_spec["model_dir"],
+        model_spec.get("query_head_path"),
+        model_spec["kb_layer_frequency"],
+        None,
+        device=device,
+    )
+    dataset = json.load(open(os.path.join(model_spec["dataset_dir"], model_spec["test_dataset"])))
+    kb_retriever = KBRetriever(
+        encoder,
+        dataset,
+        precomputed_embed_keys_path=model_spec.get("precomputed_embed_keys_path"),
+        precomputed_embed_values_path=model_spec.get("precomputed_embed_values_path"),
+    )
+    _worker_state.update(
+        model_spec=model_spec, device=device, tokenizer=tokenizer, model=model, kb_retriever=kb_retriever
+    )
+
+
+def _run_job(command: str, job: dict, predictions_file: Path) -> dict:
+    model_spec, model = _worker_state["model_spec"], _worker_state["model"]
+    kb_config = KBLaMConfig(
+        sep_query_head=True,
+        kb_layer_frequency=model_spec["kb_layer_frequency"],
+        kb_scale_factor=job["kb_scale_factor"],
+    )
+    torch.manual_seed(job["seed"])
+    start_time = time.perf_counter()
+    if command == "generation":
+        scores = perform_eval(
+            model,
+            _worker_state["tokenizer"],
+            _worker_state["kb_retriever"],
+            model_spec["encoder_spec"],
+            kb_config,
+            eval_mode=job["eval_mode"],
+            kb_size=job["kb_size"],
+            seed=job["seed"],
+            topk_size=job["topk_size"],
+            multi_entites=job["multi_entites"],
+            remove_sorry=job["remove_sorry"],
+            bert_score=model_spec.get("bert_score", True),
+            predictions_file=predictions_file,
+        )
+    else:
+        refusal_results = perform_eval_refusal(
+            model,
+            _worker_state["tokenizer"],
+            _worker_state["kb_retriever"],
+            kb_config=kb_config,
+            eval_mode=job["eval_mode"],
+            kb_size=job["kb_size"],
+            seed=job["seed"],
+            topk_size=job["topk_size"],
+            predictions_file=predictions_file,
+        )
+        prediction, true_label = refusal_results
+        scores = {"prediction": prediction.tolist(), "true_label": true_label.tolist()}
+    scores["duration_s"] = time.perf_counter() - start_time
+    scores["device"] = _worker_state["device"]
+    scores["worker_pid"] = os.getpid()
+    return scores
+
+
+def run_matrix(
+    spec: dict, save_dir: str | Path, devices: list[str], num_workers: int | None = None
+) -> tuple[list[str], list[str]]:
+    """
+    Runs every evaluation of the matrix `spec` that is not in `{save_dir}/results.jsonl` yet. Each of the
+    `num_workers` processes (one per device by default) loads the model on one of `devices`, used in turn.
+    The prediction records are written to `{save_dir}/{name}.jsonl` as the questions are answered.
+
+    Returns the names of the evaluations that ran and of the ones that failed.
+    """
+    command = spec["command"]
+    if command not in COMMANDS:
+        raise ValueError(f"Unknown command {command}, expected one of {COMMANDS}")
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    store = ResultStore(save_dir / "results.jsonl")
+    jobs = {get_job_name(command, job): job for job in expand_matrix(spec["matrix"])}
+    pending = {name: job for name, job in jobs.items() if name not in store}
+    print(f"{len(pending)} evaluations to run, {len(jobs) - len(pending)} already in {store.path}")
+    if not pending:
+        return [], []
+
+    num_workers = min(num_workers or len(devices), len(pending))
+    context = mp.get_context("spawn")
+    worker_devices = context.Queue()
+    for i in range(num_workers):
+        worker_devices.put(devices[i % len(devices)])
+    # Share the CPU threads between the workers running on CPU
+    num_threads = max(1, os.cpu_count() // num_workers) if all(d == "cpu" for d in devices) else None
+
+    done, failed = [], []
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=({**spec["model"], "bert_score": spec.get("bert_score", True)}, worker_devices, num_threads),
+    ) as executor:
+        futures = {
+            executor.submit(_run_job, command, job, save_dir / f"{name}.jsonl"): name for name, job in pending.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                scores = future.result()
+            except Exception as e:
+                print(f"{name} failed: {e!r}")
+                failed.append(name)
+                continue
+            store.append({"name": name, "command": command, "config": pending[name], "scores": scores})
+            done.append(name)
+            print(f"[{len(done) + len(failed)}/{len(pending)}] {name}")
+    return done, failed
+
+
+parser = argparse.ArgumentParser(description="Run a matrix of evaluations with one model per worker process")
+parser.add_argument("--spec", type=str, required=True, help="JSON file with the matrix spec, see the module docstring")
+parser.add_argument("--save_dir", type=str, required=True, help="Directory of the result store and the outputs")
+parser.add_argument(
+    "--devices",
+    type=str,
+    nargs="+",
+    default=["cuda"],
+    help="Devices of the workers, e.g. cuda:0 cuda:1 or cpu, used in turn when there are more workers",
+)
+parser.add_argument(
+    "--num_workers", type=int, default=None, help="Number of worker processes, one per device by default"
+)
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.spec) as f:
+        spec = json.load(f)
+    _, failed = run_matrix(spec, args.save_dir, args.devices, args.num_workers)
+    if failed:
+        raise SystemExit(f"{len(failed)} evaluations failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()
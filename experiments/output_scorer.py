@@ -1,10 +1,15 @@
 import argparse
-import json
-from dataclasses import dataclass
+import asyncio
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
 import numpy as np
 
-from kblam.gpt_session import GPT
+from kblam.gpt_session import AsyncGPT
+from kblam.utils.cache_utils import ResponseCache, make_cache_key
+from kblam.utils.pipeline_utils import ProgressJournal, Stage, map_stage
+from kblam.utils.prediction_utils import read_predictions
 
 
 @dataclass
@@ -12,21 +17,44 @@ class EvalExample:
     text: str
     true_answer: str
     score: float
-
-
-def save_example(example: EvalExample, output_file: str) -> None:
-    try:
-        with open(output_file, "a+") as f:
-            json.dump(example.__dict__, f)
-            f.write("\n")
-    except Exception as e:
-        print("Error saving example.")
-        print(e)
-
-
-class Evaluator(GPT):
-    def __init__(self, model, endpoint_url, **kwargs) -> None:
-        self.system_msg = """You are an AI system that evaluates the quality of generated text. 
+    id: int | None = None
+
+
+def get_journal_path(output_file: str) -> str:
+    """Progress journal of the scoring, next to the output file."""
+    return str(Path(output_file).with_suffix(".journal.jsonl"))
+
+
+def parse_example(record: dict) -> tuple[str, str]:
+    """Model output and true answer of a prediction record."""
+    return record["prediction"], record["reference"]
+
+
+def iter_scoring_items(
+    records: Iterable[dict],
+    journal: ProgressJournal,
+    parse: Callable[[dict], tuple],
+) -> Iterator[tuple[str, dict]]:
+    """
+    Keys the prediction records by id and a hash of their scored fields, `parse`.
+    Raises a ValueError for a record whose id was scored with other fields, e.g.
+    after the predictions were regenerated, rather than replaying a stale score.
+    """
+    scored_keys = {key.rsplit("-", 1)[0]: key for key in journal.records}
+    for record in records:
+        digest = make_cache_key(fields=parse(record))[:16]
+        key = f"{record['id']}-{digest}"
+        if scored_keys.get(str(record["id"]), key) != key:
+            raise ValueError(
+                f"Prediction {record['id']} differs from the one scored in "
+                f"{journal.path}, score the new predictions into another output file"
+            )
+        yield key, record
+
+
+class Evaluator(AsyncGPT):
+    def __init__(self, model, endpoint_url, seed: int = 42, **kwargs) -> None:
+        system_msg = """You are an AI system that evaluates the quality of generated text. 
                                 You will be given a text and a ground truth answer, your goals is to return a score between 0 and 1."""
         self.prompt = """ Given a text and a ground truth answer, evaluate the quality of the text.
                             Return a score of 1 if the text is exactly the same as the ground truth answer,
@@ -54,42 +82,51 @@ class Evaluator(GPT):
         self.prompt += (
             "\n Score the following text: \n model prediction: {0}, \n true answer: {1}"
         )
-        self.seed = 42
-        super().__init__(model, endpoint_url, **kwargs)
+        super().__init__(
+            model, endpoint_url, system_msg=system_msg, seed=seed, **kwargs
+        )
 
-    def evaluate_output(self, prompt: str, text: str, true_answer: str) -> str:
+    async def evaluate_output(self, text: str, true_answer: str) -> EvalExample:
         prompt = self.prompt.format(text, true_answer)
-        score = self.generate_response(prompt)
-        example = EvalExample(text, true_answer, float(score))
-        return example
-
-    def evaluate_output_batch(self, examples: list[str]) -> list[str]:
-        eval_examples = []
-        for example in examples:
-            try:
-                text = (
-                    example.split("True answer:")[0]
-                    .replace("Model output:", "")
-                    .strip()
-                )
-                true_answer = example.split("True answer:")[1].strip()
-                eval_example = self.evaluate_output(self.prompt, text, true_answer)
-                eval_examples.append(eval_example)
-            except Exception as e:
-                print("Error evaluating example.")
-                print(e)
-        return eval_examples
+        score = await self.generate_response(prompt)
+        return EvalExample(text, true_answer, float(score))
+
+    async def evaluate_output_batch(
+        self, records: Iterable[dict], output_file: str
+    ) -> list[EvalExample | None]:
+        """
+        Scores the prediction records of `read_predictions` with up to
+        `max_concurrency` requests in flight, in the order of the records, None for
+        those that could not be scored. The records are consumed lazily, the scores
+        are appended to `output_file` as they come with the id of their record, and
+        journaled, see `iter_scoring_items`, so that a rerun only scores the records
+        missing from a previous run.
+        """
+
+        async def score(record: dict) -> list[EvalExample]:
+            example = await self.evaluate_output(*parse_example(record))
+            return [replace(example, id=record["id"])]
+
+        stage = Stage(
+            "scoring", score, EvalExample, get_journal_path(output_file), output_file
+        )
+        items = iter_scoring_items(records, stage.journal, parse_example)
+        try:
+            results = await map_stage(stage, items, self.max_concurrency)
+        finally:
+            stage.close()
+        return [outputs[0] if outputs else None for outputs in results]
 
 
 def parser_args():
     parser = argparse.ArgumentParser(description="GPT Session")
-    parser.add_argument("--model", type=str, default="GPT4", help="The model to use.")
+    parser.add_argument("--model", type=str, default="gpt-4o", help="The model to use.")
     parser.add_argument("--endpoint_url", type=str, help="The endpoint url.")
     parser.add_argument(
         "--predictions_file",
         type=str,
-        default="llama.txt",
-        help="The input file with examples.",
+        default="llama.jsonl",
+        help="The predictions of eval.py, JSONL or the legacy text format.",
     )
     parser.add_argument(
         "--output_file",
@@ -97,19 +134,68 @@ def parser_args():
         default="eval_examples1.json",
         help="The output file to save the examples.",
     )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of scoring requests in flight",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the requests per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the tokens per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default=None,
+        help="SQLite file caching the GPT responses across runs, no cache by default",
+    )
+    parser.add_argument(
+        "--cache_max_bytes",
+        type=int,
+        default=2**30,
+        help="Size above which the least recently used cache entries are evicted, "
+        "0 for no limit",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parser_args()
-    with open(args.predictions_file, "r") as f:
-        examples = f.read()
-        examples = examples.split("-------")
+    cache = (
+        ResponseCache(args.cache_path, args.cache_max_bytes or None)
+        if args.cache_path
+        else None
+    )
+    eval = Evaluator(
+        args.model,
+        args.endpoint_url,
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        cache=cache,
+    )
+
+    async def run():
+        async with eval:
+            return await eval.evaluate_output_batch(
+                read_predictions(args.predictions_file), args.output_file
+            )
 
-    eval = Evaluator(args.model, args.endpoint_url)
-    eval_examples = eval.evaluate_output_batch(examples)
-    for example in eval_examples:
-        save_example(example, args.output_file)
+    results = asyncio.run(run())
+    eval_examples = [example for example in results if example is not None]
+    print(f"Scored {len(eval_examples)} of {len(results)} examples")
 
     mean_score = np.mean([example.score for example in eval_examples])
     print(f"Mean score: {mean_score}")
+    print(eval.stats)
+    if cache is not None:
+        print(f"Cache: {cache.stats.to_dict()}")
@@ -1,11 +1,16 @@
 import argparse
-import json
+import asyncio
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from typing import Iterable
 
 import numpy as np
 
-from kblam.gpt_session import GPT
+from kblam.gpt_session import AsyncGPT
+from kblam.utils.cache_utils import ResponseCache
+from kblam.utils.pipeline_utils import Stage, map_stage
+from kblam.utils.prediction_utils import read_predictions
+from output_scorer import get_journal_path, iter_scoring_items
 
 
 @dataclass
@@ -15,21 +20,17 @@ class EvalExample:
     response: str
     score: float
     reason: str
+    id: int | None = None
 
 
-def save_example(example: EvalExample, output_file: str) -> None:
-    try:
-        with open(output_file, "a+") as f:
-            json.dump(example.__dict__, f)
-            f.write("\n")
-    except Exception as e:
-        print("Error saving example.")
-        print(e)
+def parse_example(record: dict) -> tuple[str, str, str]:
+    """Evidence, question and model output of a prediction record."""
+    return record["evidence"], record["question"], record["prediction"]
 
 
-class Evaluator(GPT):
-    def __init__(self, model, endpoint_url, seed, **kwargs) -> None:
-        self.system_msg = """You are an AI system that evaluates the quality of generated response. Your goals is to return a score between 0 and 5
+class Evaluator(AsyncGPT):
+    def __init__(self, model, endpoint_url, seed: int = 42, **kwargs) -> None:
+        system_msg = """You are an AI system that evaluates the quality of generated response. Your goals is to return a score between 0 and 5
                                     indicating how accurate and useful the response is. An accrate and useful response should get a high score of 5."""
         self.prompt_open_ended = """
         A model is given a question about some information and evidence.
@@ -94,57 +95,47 @@ class Evaluator(GPT):
         """
         self.prompt_open_ended += "\n Score the following responce: \n evidence: {0}, question: {1} and \n model response: {2}"
 
-        self.seed = seed
-        super().__init__(model, endpoint_url, **kwargs)
-
-    def evaluate_open_ended(
-        self, prompt, evidence: str, question: str, response: str
-    ) -> str:
-        prompt = prompt.format(evidence, question, response)
-        return self.generate_response(prompt)
-
-    def evaluate_output_batch(self, examples: list[str]) -> list[str]:
-        score_pattern = r"Score: (.+)"
-        reason_pattern = r"Reason: (.+)"
-
-        eval_examples = []
-        for example in examples:
-            try:
-                evidence_start = example.find("Evidence:")
-                question_start = example.find("Question:")
-                model_output_start = example.find("Model output:")
-
-                # Extract the parts based on the indices
-                evidence = example[evidence_start:question_start].strip()
-                question = example[question_start:model_output_start].strip()
-                model_output = example[model_output_start:].strip()
-
-                eval_example = self.evaluate_open_ended(
-                    self.prompt_open_ended, evidence, question, model_output
-                )
-                score = float(re.search(score_pattern, eval_example).group(1).strip())
-                reason = re.search(reason_pattern, eval_example).group(1).strip()
-                eval_example = EvalExample(
-                    evidence, question, model_output, score, reason
-                )
-                eval_examples.append(eval_example)
-
-                save_example(eval_example, args.output_file)
-
-            except Exception as e:
-                print("Error evaluating example.")
-                print(e)
-                return eval_examples
+        super().__init__(
+            model, endpoint_url, system_msg=system_msg, seed=seed, **kwargs
+        )
+
+    async def evaluate_open_ended(
+        self, evidence: str, question: str, response: str
+    ) -> EvalExample:
+        prompt = self.prompt_open_ended.format(evidence, question, response)
+        eval_output = await self.generate_response(prompt)
+        score = float(re.search(r"Score: (.+)", eval_output).group(1).strip())
+        reason = re.search(r"Reason: (.+)", eval_output).group(1).strip()
+        return EvalExample(evidence, question, response, score, reason)
+
+    async def evaluate_output_batch(
+        self, records: Iterable[dict], output_file: str
+    ) -> list[EvalExample | None]:
+        """See `output_scorer.Evaluator.evaluate_output_batch`."""
+
+        async def score(record: dict) -> list[EvalExample]:
+            example = await self.evaluate_open_ended(*parse_example(record))
+            return [replace(example, id=record["id"])]
+
+        stage = Stage(
+            "scoring", score, EvalExample, get_journal_path(output_file), output_file
+        )
+        items = iter_scoring_items(records, stage.journal, parse_example)
+        try:
+            results = await map_stage(stage, items, self.max_concurrency)
+        finally:
+            stage.close()
+        return [outputs[0] if outputs else None for outputs in results]
 
 
 def parser_args():
     parser = argparse.ArgumentParser(description="GPT Session")
-    parser.add_argument("--model", type=str, default="GPT4", help="The model to use.")
+    parser.add_argument("--model", type=str, default="gpt-4o", help="The model to use.")
     parser.add_argument("--endpoint_url", type=str, help="The endpoint url.")
     parser.add_argument(
         "--predictions_file",
         type=str,
-        help="The file containing the model predictions.",
+        help="The model predictions, JSONL or the legacy text format.",
     )
     parser.add_argument(
         "--output_file",
@@ -153,16 +144,68 @@ def parser_args():
         help="The output file to save the examples.",
     )
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=64,
+        help="Maximum number of scoring requests in flight",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the requests per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        type=float,
+        default=None,
+        help="Client-side limit of the tokens per minute, no limit by default",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default=None,
+        help="SQLite file caching the GPT responses across runs, no cache by default",
+    )
+    parser.add_argument(
+        "--cache_max_bytes",
+        type=int,
+        default=2**30,
+        help="Size above which the least recently used cache entries are evicted, "
+        "0 for no limit",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parser_args()
-    with open(args.predictions_file, "r") as f:
-        examples = f.read()
-        examples = examples.split("-------")
+    cache = (
+        ResponseCache(args.cache_path, args.cache_max_bytes or None)
+        if args.cache_path
+        else None
+    )
+    eval = Evaluator(
+        args.model,
+        args.endpoint_url,
+        args.seed,
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        cache=cache,
+    )
+
+    async def run():
+        async with eval:
+            return await eval.evaluate_output_batch(
+                read_predictions(args.predictions_file), args.output_file
+            )
 
-    eval = Evaluator(args.model, args.endpoint_url, args.seed)
-    eval_examples = eval.evaluate_output_batch(examples)
+    results = asyncio.run(run())
+    eval_examples = [example for example in results if example is not None]
+    print(f"Scored {len(eval_examples)} of {len(results)} examples")
     mean_score = np.mean([example.score for example in eval_examples])
     print(f"Mean score: {mean_score}")
+    print(eval.stats)
+    if cache is not None:
+        print(f"Cache: {cache.stats.to_dict()}")
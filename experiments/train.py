@@ -4,6 +4,7 @@ import logging
 import os
 import pathlib
 import re
+import time
 from functools import partial
 from itertools import chain
 from typing import Callable, Dict, List, Optional
@@ -27,17 +28,33 @@ from rich.theme import Theme
 from torch.nn import CrossEntropyLoss
 from transformers import AutoTokenizer
 from accelerate import Accelerator
+from accelerate.utils import gather_object
 
 from kblam.kb_encoder import KBEncoder
 from kblam.models.kblam_config import KBLaMConfig
 from kblam.models.llama3_model import KblamLlamaForCausalLM
 from kblam.models.phi3_model import KBLaMPhi3ForCausalLM
+from kblam.utils.checkpoint_utils import (
+    ENCODER_FILE_NAME,
+    KB_CONFIG_FILE_NAME,
+    LLM_TRAINABLE_FILE_NAME,
+    TRAINING_STATE_FILE_NAME,
+    AsyncCheckpointWriter,
+    get_rng_states,
+    load_trainable_state_dict,
+    set_rng_states,
+    snapshot_to_cpu,
+    trainable_state_dict,
+)
 from kblam.utils.data_utils import (
     augment_row,
     generate_multi_entity_qa,
+    get_augmented_questions,
     get_i_dont_know_ans,
 )
+from kblam.utils.dist_utils import broadcast_indices, is_distributed, sharded_encode
 from kblam.utils.train_utils import (
+    LengthBucketSampler,
     context_set_size_scheduler,
     get_kb_embd,
     setup_scheduler_and_optimizer,
@@ -84,7 +101,7 @@ parser.add_argument("--key_embd_src", type=str, default="key", choices=["key", "
 parser.add_argument("--use_data_aug", action="store_true", help="Randomly pick templates for the question")
 parser.add_argument("--use_lr_decay", action="store_true")
 parser.add_argument("--dataset_dir", type=str, default="synthetic_data")
-parser.add_argument("--model_dir_to_resume", type=str, default=None, help="Checkpoint directory to resume training")
+parser.add_argument("--model_dir_to_resume", type=str, default=None, help="Checkpoint directory (ending in _step_N) to resume training from")
 parser.add_argument("--hf_model_spec", type=str, default="meta-llama/Llama-3.2-1B-Instruct", choices=["meta-llama/Meta-Llama-3-8B", "microsoft/Phi-3-mini-4k-instruct", "meta-llama/Llama-3.2-1B-Instruct"])
 parser.add_argument("--hf_token", type=str,default=None,help="Huggingface token")
 parser.add_argument("--model_save_dir", type=str, default="output", help="Place to save the checkpoints")
@@ -101,6 +118,13 @@ parser.add_argument("--verbose", action="store_true", help="Set logging to debug
 parser.add_argument("--log_to_file", action="store_true", help="Log to file as well as stdout")
 parser.add_argument("--llm_type",type=str,default="llama3",choices=["llama3", "phi3"])
 parser.add_argument("--max_seq_len",type=int,default=None)
+parser.add_argument("--shard_kb_encoding", action="store_true", help="In multi-GPU runs, share one context set per accumulation step and split its encoding across the GPUs")
+parser.add_argument("--gradient_checkpointing", type=str, default="kb", choices=["none", "kb", "all"], help="Recompute no layer, only the layers attending over the KB, or every layer in backward")
+parser.add_argument("--length_bucketing", action="store_true", help="Batch QA pairs of similar tokenized length to reduce padding")
+parser.add_argument("--bucket_size", type=int, default=1000, help="Number of examples per length bucket")
+parser.add_argument("--max_tokens_per_batch", type=int, default=None, help="Token budget of a batch (padding included), B becomes the maximum batch size. Requires --length_bucketing")
+parser.add_argument("--save_period", type=int, default=3000, help="Number of steps between checkpoints")
+parser.add_argument("--max_checkpoints_to_keep", type=int, default=None, help="Only keep the most recent checkpoints, keep all if not set")
 # fmt: on
 
 
@@ -204,6 +228,7 @@ def get_batch(
     include_outlier=False,
     multi_entities=None,
     use_extended_qa=False,
+    sampler: Optional[LengthBucketSampler] = None,
 ):
     """
     dataset: List of dictionary, denoting the KB, used to extract QA pairs
@@ -212,13 +237,16 @@ def get_batch(
     B: Batchsize
     include_outlier : Create a batch of question without answer in the KB.
     multi_entities : Create a batch of question that involves more than one entities.
+    sampler: Sample a batch of QA with similar lengths instead of sampling uniformly.
     """
     labels = []
     if multi_entities is not None:
         assert not include_outlier
 
     if random_sample:
-        if multi_entities is not None:
+        if sampler is not None:
+            batch_indices = sampler.sample(_get_qa_kind(include_outlier, use_extended_qa), B, multi_entities)
+        elif multi_entities is not None:
             batch_indices = np.random.choice(len(dataset), (B, multi_entities), replace=False)
         else:
             batch_indices = np.random.choice(len(dataset), B, replace=False)
@@ -260,10 +288,50 @@ def get_batch(
         labels = label_func(input_ids, input_strs, tokenizer)
     if include_outlier:
         # Generate a new set of indices, such that the KB does not contain the entity where the question comes from
-        batch_indices = np.random.choice(len(dataset), B, replace=False)
+        batch_indices = np.random.choice(len(dataset), len(input_strs), replace=False)
     return input_ids, attention_masks, labels, batch_indices
 
 
+def _get_qa_kind(include_outlier: bool, use_extended_qa: bool) -> str:
+    """Map a step config to the QA lengths used by `LengthBucketSampler`. Multi entities QA use the standard ones."""
+    if use_extended_qa:
+        return "extended"
+    if include_outlier:
+        return "outlier"
+    return "qa"
+
+
+def get_qa_lengths(
+    qa_format_func: Callable[[str, str], str],
+    dataset: List[Dict],
+    tokenizer,
+    use_extended_qa: bool = False,
+    max_seq_len: int | None = None,
+    use_data_aug: bool = False,
+) -> Dict[str, np.ndarray]:
+    """
+    Tokenized length of each kind of QA in the dataset, clipped to `max_seq_len`, to set up a LengthBucketSampler.
+    With `use_data_aug` the question of a row is drawn from templates when it is batched (see `get_batch`), its
+    length is then the longest over the templates, an upper bound of the batched length.
+    """
+    questions = [get_augmented_questions(row) if use_data_aug else [row["Q"]] for row in dataset]
+    input_strs = {
+        "qa": [[qa_format_func(Q, row["A"]) for Q in Qs] for row, Qs in zip(dataset, questions)],
+        "outlier": [[qa_format_func(Q, get_i_dont_know_ans()) for Q in Qs] for Qs in questions],
+    }
+    if use_extended_qa:
+        input_strs["extended"] = [[qa_format_func(row["extended_Q"], row["extended_A"])] for row in dataset]
+    lengths = {}
+    for kind, row_strs in input_strs.items():
+        num_strs = np.array([len(strs) for strs in row_strs])
+        str_lengths = np.array([len(ids) for ids in tokenizer([s for strs in row_strs for s in strs])["input_ids"]])
+        # Longest string of each row
+        lengths[kind] = np.maximum.reduceat(str_lengths, np.cumsum(num_strs) - num_strs)
+        if max_seq_len is not None:
+            lengths[kind] = np.minimum(lengths[kind], max_seq_len)
+    return lengths
+
+
 def get_prefix_str(args):
     use_data_aug = args.use_data_aug
     sep_query_head = args.sep_query_head
@@ -441,11 +509,17 @@ class KBRetriever:
         dataset: List[Dict],
         key_embds: Optional[np.ndarray],
         value_embds: Optional[np.ndarray],
+        shard_context_set: bool = False,
     ):
+        """
+        shard_context_set: In distributed runs, every rank shares the same context set and only encodes its own shard
+            of it, the shards are then all-gathered. Otherwise each rank encodes its own full context set.
+        """
         self.encoder = encoder
         self.key_embds = key_embds
         self.value_embds = value_embds
         self.dataset = dataset
+        self.shard_context_set = shard_context_set
 
     def _use_cached_embd(self):
         if self.key_embds is not None and self.value_embds is not None:
@@ -453,31 +527,35 @@ class KBRetriever:
         else:
             return False
 
-    def get_key_embeddings(self, batch_indices, batch_size, step, kb_size):
+    def _encode(self, indices):
         if self._use_cached_embd():
-            train_set_key, train_set_val = get_kb_embd(
-                self.encoder,
-                batch_indices,
-                precomputed_embd=(self.key_embds, self.value_embds),
-            )
-        else:
-            train_set_key, train_set_val = get_kb_embd(self.encoder, batch_indices, kb_dict=self.dataset)
+            return get_kb_embd(self.encoder, indices, precomputed_embd=(self.key_embds, self.value_embds))
+        return get_kb_embd(self.encoder, indices, kb_dict=self.dataset)
+
+    def _get_context_set(self, step, kb_size):
+        if not (self.shard_context_set and is_distributed()):
+            context_set_size = context_set_size_scheduler(step, kb_size)
+            context_set_index = np.random.choice(len(self.dataset), context_set_size, replace=False)  # type: ignore
+            return self._encode(context_set_index)
+
+        context_set_index = None
+        if torch.distributed.get_rank() == 0:
+            # Every rank needs at least one KB entry to encode
+            context_set_size = max(context_set_size_scheduler(step, kb_size), torch.distributed.get_world_size())
+            context_set_index = np.random.choice(len(self.dataset), context_set_size, replace=False)  # type: ignore
+        device = self.encoder.device if hasattr(self.encoder, "device") else self.encoder.module.device
+        context_set_index = broadcast_indices(context_set_index, device)
+        return sharded_encode(self._encode, context_set_index)
+
+    def get_key_embeddings(self, batch_indices, batch_size, step, kb_size):
+        train_set_key, train_set_val = self._encode(batch_indices)
 
         if len(train_set_key.shape) == 2:
             # Add comment on why we need this line
             train_set_key = train_set_key.unsqueeze(0).transpose(0, 1)
             train_set_val = train_set_val.unsqueeze(0).transpose(0, 1)
 
-        context_set_size = context_set_size_scheduler(step, kb_size)
-        context_set_index = np.random.choice(len(self.dataset), context_set_size, replace=False)  # type: ignore
-        if self._use_cached_embd():
-            context_set_key, context_set_val = get_kb_embd(
-                self.encoder,
-                context_set_index,
-                precomputed_embd=(self.key_embds, self.value_embds),
-            )
-        else:
-            context_set_key, context_set_val = get_kb_embd(self.encoder, context_set_index, kb_dict=self.dataset)
+        context_set_key, context_set_val = self._get_context_set(step, kb_size)
         context_set_key = context_set_key.unsqueeze(0).expand(batch_size, *context_set_key.shape)
         context_set_val = context_set_val.unsqueeze(0).expand(batch_size, *context_set_val.shape)
         # context_set_val = torch.randn_like(context_set_val)
@@ -506,6 +584,8 @@ class Trainer:
         output_dir: str,
         sep_query_head: bool = False,
         max_seq_len: int | None = None,
+        max_checkpoints_to_keep: int | None = None,
+        gradient_checkpointing: str = "kb",
     ):
         self.accelerator = Accelerator()
         self.logger = logging.getLogger("training")
@@ -517,7 +597,8 @@ class Trainer:
         self.max_seq_len = max_seq_len
 
         self.model = llm_model
-        self.model.gradient_checkpointing_enable()
+        if gradient_checkpointing != "none":
+            self.model.gradient_checkpointing_enable(kb_layers_only=gradient_checkpointing == "kb")
 
         self.device = device if device is not None else self.accelerator.device
         self.kbretriever = kbretriever
@@ -525,6 +606,11 @@ class Trainer:
         self.use_lr_decay = use_lr_decay
         self.llm_savename = llm_savename
         self.output_path = pathlib.Path(output_dir)
+        self.checkpoint_writer = (
+            AsyncCheckpointWriter(self.output_path, max_to_keep=max_checkpoints_to_keep)
+            if self.accelerator.is_main_process
+            else None
+        )
 
         if isinstance(llm_model, KBLaMPhi3ForCausalLM):  # Phi3
             self._get_batch = partial(get_batch, _format_QA_phi3, _create_labels_for_phi3)
@@ -570,6 +656,7 @@ class Trainer:
         save_period: int = 2000,
         resumed_step: int = 0,
         kb_config: KBLaMConfig = None,
+        sampler: Optional[LengthBucketSampler] = None,
     ):
         train_losses = []
         start_step = resumed_step
@@ -581,6 +668,10 @@ class Trainer:
         accum_steps_per_gpu = max(1, grad_accum_steps // num_processes)
         effective_batch_size = batch_size * grad_accum_steps
 
+        if self.kbretriever.shard_context_set and grad_accum_steps % num_processes != 0:
+            # Every rank has to take part in the same number of context set all-gathers
+            raise ValueError("Sharded KB encoding requires gradient_accm_step to be divisible by the number of GPUs")
+
         if self.accelerator.is_main_process:
             self.logger.info(f"Training with {num_processes} GPUs")
             self.logger.info(f"Total accumulation steps: {grad_accum_steps}, Steps per GPU: {accum_steps_per_gpu}")
@@ -590,8 +681,10 @@ class Trainer:
         with create_custom_progress_bar(console=console, disable=not self.accelerator.is_main_process) as pbar:
             task = pbar.add_task("Training", total=self.num_steps, loss=100)
             for step in range(start_step, self.num_steps, 1):
+                step_start_time = time.perf_counter()
                 self.optim.zero_grad()
                 losses = []
+                num_tokens, num_padded_tokens = 0, 0
 
                 # Calculate which accumulation steps this GPU should process
                 process_rank = self.accelerator.process_index
@@ -614,6 +707,7 @@ class Trainer:
                         self.device,
                         B=batch_size,
                         random_sample=True,
+                        sampler=sampler,
                         **step_config,
                     )
 
@@ -626,6 +720,8 @@ class Trainer:
                         labels = labels[:, : self.max_seq_len]
                         if a_step == 0 and step % 10 == 0:
                             self.logger.info(f"TRUNCATED INPUT IDs SHAPE: {input_ids.shape}")
+                    num_tokens += attention_masks.sum().item()
+                    num_padded_tokens += attention_masks.numel()
 
                     kb_embedding = self.kbretriever.get_key_embeddings(
                         batch_indices, len(input_ids), step, self.kb_size
@@ -634,7 +730,6 @@ class Trainer:
                         input_ids=input_ids,
                         attention_mask=attention_masks,
                         kb_kvs=kb_embedding,
-                        output_attentions=True,
                         kb_config=kb_config,
                     )
                     logits = out["logits"]
@@ -691,60 +786,81 @@ class Trainer:
 
                 # Only log from main process
                 if self.accelerator.is_main_process:
-                    self.logger.info(f"step: {step}, loss: {avg_loss}")
-                    wandb.log({'train_loss': np.mean(losses)})
+                    step_time = time.perf_counter() - step_start_time
+                    pad_fraction = 1 - num_tokens / max(num_padded_tokens, 1)
+                    self.logger.info(
+                        f"step: {step}, loss: {avg_loss}, pad fraction: {pad_fraction:.3f}, "
+                        f"tokens/sec: {num_tokens / step_time:.1f}"
+                    )
+                    wandb.log(
+                        {
+                            'train_loss': np.mean(losses),
+                            'pad_fraction': pad_fraction,
+                            'tokens_per_sec': num_tokens / step_time,
+                        }
+                    )
                     train_losses.append(avg_loss)
                     pbar.update(task, advance=1, loss=avg_loss)
 
                 if (step % save_period) == 0 and (step != start_step):
-                    try:
-                        # Log memory usage before synchronization
-                        self.logger.info(
-                            f"Is main process: {self.accelerator.is_main_process}, GPU memory before save: {torch.cuda.memory_allocated()/1e9:.2f}GB / {torch.cuda.get_device_properties(0).total_memory/1e9:.2f}GB"
-                        )
-
-                        # Try to free up memory
-                        torch.cuda.empty_cache()
-
-                        # Synchronize before saving
-                        self.accelerator.wait_for_everyone()
-
-                        if self.accelerator.is_main_process:
-
-                            self.logger.info("Saving checkpoint...")
-                            self.logger.info("Making dirs...")
-                            # Save model - using proper directory creation
-                            model_ckpt_name = self.output_path / f"{self.llm_savename}_step_{step}"
-                            model_ckpt_name.mkdir(parents=True, exist_ok=True)
-
-                            # Also create encoder directory
-                            encoder_dir = self.output_path / f"{self.llm_savename}_step_{step}_encoder"
-                            encoder_dir.mkdir(parents=True, exist_ok=True)
-
-                            self.logger.info("Saving model...")
-                            # Unwrap and save model
-                            unwrapped_model = self.accelerator.unwrap_model(self.model)
-                            unwrapped_model.save_pretrained(
-                                model_ckpt_name,
-                                is_main_process=self.accelerator.is_main_process,
-                                save_function=self.accelerator.save,
-                            )
-
-                            self.logger.info("Saving encoder...")
-                            # Save encoder and config from main process
-                            encoder_ckpt_name = encoder_dir / "encoder.pt"
-                            torch.save(self.kbretriever.encoder.state_dict(), encoder_ckpt_name)
-
-                            self.logger.info("Saving config...")
-                            # Explicitly save config as JSON
-                            config_path = model_ckpt_name / "kb_config_explicit.json"
-                            with open(config_path, 'w') as f:
-                                f.write(kb_config.to_json_string())
-
-                    except Exception as e:
-                        self.logger.error(f"Error saving checkpoint: {e}")
-                        self.logger.error(f"Error details: {str(e)}")
-                        raise e
+                    self._save_checkpoint(step, kb_config)
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+
+    def _save_checkpoint(self, step: int, kb_config: KBLaMConfig):
+        """
+        Snapshot the trainable state to CPU and hand it to the background writer.
+        The base LLM is frozen so only the encoder and the tuned query heads are saved,
+        the rest of the weights are reloaded from the base model.
+        """
+        # Every process samples its own batches, keep one RNG state per process
+        rng_states = gather_object([get_rng_states()])
+        if not self.accelerator.is_main_process:
+            return
+        save_start = time.perf_counter()
+        unwrapped_model = self.accelerator.unwrap_model(self.model)
+        unwrapped_encoder = self.accelerator.unwrap_model(self.kbretriever.encoder)
+        files = snapshot_to_cpu(
+            {
+                ENCODER_FILE_NAME: unwrapped_encoder.state_dict(),
+                LLM_TRAINABLE_FILE_NAME: trainable_state_dict(unwrapped_model),
+                TRAINING_STATE_FILE_NAME: {
+                    "step": step,
+                    "optimizer": self.optim.state_dict(),
+                    "scheduler": self.scheduler.state_dict(),
+                    "rng_states": rng_states,
+                },
+            }
+        )
+        files[KB_CONFIG_FILE_NAME] = kb_config.to_json_string()
+        self.checkpoint_writer.save(f"{self.llm_savename}_step_{step}", files)
+        self.logger.info(f"Checkpoint snapshot for step {step} took {time.perf_counter() - save_start:.2f}s")
+
+    def load_checkpoint(self, checkpoint_dir: str) -> int:
+        """
+        Restore the state written by `_save_checkpoint` so that training continues exactly where it stopped:
+        the tuned query heads, the optimizer moments, the scheduler position and the RNG states
+        that drive batch and KB sampling. Returns the step to resume from.
+        """
+        checkpoint_path = pathlib.Path(checkpoint_dir)
+        load_trainable_state_dict(
+            self.accelerator.unwrap_model(self.model), checkpoint_path / LLM_TRAINABLE_FILE_NAME
+        )
+        training_state = torch.load(checkpoint_path / TRAINING_STATE_FILE_NAME, map_location="cpu", weights_only=False)
+        self.optim.load_state_dict(training_state["optimizer"])
+        self.scheduler.load_state_dict(training_state["scheduler"])
+
+        rng_states = training_state["rng_states"]
+        if len(rng_states) != self.accelerator.num_processes:
+            self.logger.warning(
+                f"Checkpoint was written by {len(rng_states)} processes but resuming with "
+                f"{self.accelerator.num_processes}, the data stream will not be identical"
+            )
+        set_rng_states(rng_states[self.accelerator.process_index % len(rng_states)])
+
+        self.logger.info(f"Resumed from {checkpoint_dir} at step {training_state['step']}")
+        return training_state["step"] + 1
 
 
 def main():
@@ -783,6 +899,9 @@ def main():
     if kb_size is not None and dynamic_kb_size is not None:
         raise ValueError("Can't specify kb_size and dynamic_kb_size. Use only one")
 
+    if args.max_tokens_per_batch is not None and not args.length_bucketing:
+        raise ValueError("max_tokens_per_batch requires length_bucketing")
+
     kb_size = kb_size if kb_size is not None else dynamic_kb_size
 
     gradient_accm_step = args.gradient_accm_step
@@ -819,6 +938,9 @@ def main():
                 'gradient_accm_step': gradient_accm_step,
                 "encoder_spec": encoder_spec,
                 "max_seq_len": max_seq_len,
+                "gradient_checkpointing": args.gradient_checkpointing,
+                "length_bucketing": args.length_bucketing,
+                "max_tokens_per_batch": args.max_tokens_per_batch,
             },
         )
 
@@ -862,12 +984,14 @@ def main():
     training_set = dataset[:N]
 
     # Set up the LLM
-    llm_model_spec = model_dir_to_resume if model_dir_to_resume else hf_model_spec
-
-    resumed_step = 0 if not model_dir_to_resume else int(model_dir_to_resume.split("_")[-1])
+    # Checkpoints only hold the trainable weights, the LLM always comes from the base model
+    llm_model_spec = hf_model_spec
 
     if llm_model_spec is None:
-        raise ValueError("Either supply model_dir_to_resume or hf_model_spec")
+        raise ValueError("Please supply hf_model_spec")
+
+    if model_dir_to_resume and not os.path.isfile(os.path.join(model_dir_to_resume, TRAINING_STATE_FILE_NAME)):
+        raise ValueError(f"{model_dir_to_resume} does not contain a {TRAINING_STATE_FILE_NAME} to resume from")
 
     if hf_token is None and args.llm_type == "llama3":
         raise ValueError("Please supply HuggingFace token(hf_token) when loading model Llama weights from HuggingFace")
@@ -880,6 +1004,16 @@ def main():
     )
     tokenizer.pad_token = tokenizer.eos_token
 
+    if args.length_bucketing:
+        qa_format_func = _format_QA_phi3 if args.llm_type == "phi3" else _format_QA_llama
+        sampler = LengthBucketSampler(
+            get_qa_lengths(qa_format_func, training_set, tokenizer, use_extended_qa, max_seq_len, use_data_aug),
+            args.bucket_size,
+            max_tokens=args.max_tokens_per_batch,
+        )
+    else:
+        sampler = None
+
     if args.llm_type == "llama3":
         model = KblamLlamaForCausalLM.from_pretrained(
             llm_model_spec,
@@ -917,8 +1051,8 @@ def main():
     )
 
     if model_dir_to_resume:
-        encoder.load_state_dict(torch.load(os.path.join(model_dir_to_resume, "encoder.pt")))
-        kb_config = KBLaMConfig.from_pretrained(os.path.join(model_dir_to_resume, "kb_config.json"))
+        encoder.load_state_dict(torch.load(os.path.join(model_dir_to_resume, ENCODER_FILE_NAME)))
+        kb_config = KBLaMConfig.from_pretrained(os.path.join(model_dir_to_resume, KB_CONFIG_FILE_NAME))
     else:
         kb_config = KBLaMConfig(
             sep_query_head=sep_query_head,
@@ -932,6 +1066,7 @@ def main():
         training_set,
         key_embds=key_embds,  # type: ignore
         value_embds=value_embds,  # type: ignore
+        shard_context_set=args.shard_kb_encoding,
     )
 
     logger.info("Model ready 🚀")
@@ -953,10 +1088,14 @@ def main():
         model_save_dir,
         sep_query_head=sep_query_head,
         max_seq_len=max_seq_len,
+        max_checkpoints_to_keep=args.max_checkpoints_to_keep,
+        gradient_checkpointing=args.gradient_checkpointing,
     )
 
     logger.info(f"Number of trainable parameters: {_get_parameter_count(encoder):,}")
 
+    resumed_step = trainer.load_checkpoint(model_dir_to_resume) if model_dir_to_resume else 0
+
     trainer.train(
         training_set,
         B,
@@ -965,9 +1104,10 @@ def main():
         use_data_aug=use_data_aug,
         multi_entities=multi_entities,
         use_extended_qa=use_extended_qa,
-        save_period=3000,
+        save_period=args.save_period,
         resumed_step=resumed_step,
         kb_config=kb_config,
+        sampler=sampler,
     )
 
 
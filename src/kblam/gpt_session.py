@@ -1,7 +1,12 @@
 import argparse
+import asyncio
+import functools
+import logging
 import os
 import sys
+import time
 from pathlib import Path
+from typing import Awaitable, Callable
 
 from azure.identity import (
     AuthenticationRecord,
@@ -9,10 +14,93 @@ from azure.identity import (
     TokenCachePersistenceOptions,
     get_bearer_token_provider,
 )
-from openai import AzureOpenAI
+from openai import (
+    APIConnectionError,
+    AsyncAzureOpenAI,
+    AzureOpenAI,
+    BadRequestError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from kblam.utils.cache_utils import ResponseCache, make_cache_key
+from kblam.utils.rate_limit_utils import (
+    RateLimiter,
+    RateLimitStats,
+    backoff_delay,
+    get_retry_after,
+)
+
+logger = logging.getLogger(__name__)
 
 valid_models = ["gpt-4o", "ada-embeddings", "text-embedding-3-large"]
 
+# Errors after which a request is retried, the others are raised right away
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+@functools.lru_cache
+def _get_tiktoken_encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    # Encoding of the ada and text-embedding-3 models
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def estimate_num_tokens(text: str) -> int:
+    """
+    Number of tokens of `text` for the embedding models, estimated from its length
+    (about 4 characters per token) when tiktoken is not installed.
+    """
+    encoding = _get_tiktoken_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def split_into_batches(
+    texts: list[str], batch_size: int, max_batch_tokens: int
+) -> list[list[str]]:
+    """
+    Splits the texts, in order, into batches of at most `batch_size` texts and
+    `max_batch_tokens` tokens. A text longer than `max_batch_tokens` is a batch alone.
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for text in texts:
+        num_tokens = estimate_num_tokens(text)
+        if batch and (
+            len(batch) == batch_size or batch_tokens + num_tokens > max_batch_tokens
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += num_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _get_chat_content(completion) -> str | None:
+    return completion.choices[0].message.content if completion else None
+
+
+def _get_embedding_from_response(response) -> list[float] | None:
+    return response.data[0].embedding if response else None
+
+
+def _get_embeddings_from_response(
+    response, num_texts: int
+) -> list[list[float]] | None:
+    if response is None:
+        return None
+    if len(response.data) != num_texts:
+        raise ValueError(
+            f"Got {len(response.data)} embeddings for a batch of {num_texts} texts"
+        )
+    return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
+
 
 class GPT:
     def __init__(
@@ -28,21 +116,35 @@ class GPT:
         frequency_penalty: int = 0,
         presence_penalty: int = 0,
         seed: int = None,
+        api_key: str | None = None,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        rate_limiter: RateLimiter | None = None,
+        backoff_base_s: float = 1.0,
+        max_backoff_s: float = 60.0,
+        cache: ResponseCache | None = None,
     ):
+        """
+        max_retries: Number of attempts of a request, failed attempts are retried after
+            a jittered exponential backoff or the delay in the retry-after header
+        api_key: Authenticate with an API key instead of Azure AD
+        requests_per_minute, tokens_per_minute: Client-side rate limits, None for none
+        rate_limiter: Limiter shared with other sessions, replaces the limits above
+        cache: Persistent cache of the responses and embeddings, keyed by the model,
+            the messages and the sampling parameters or by the model and the text
+        """
         if model_name not in valid_models:
             raise ValueError(
                 f"Invalid model: {model_name}. Valid models are: {valid_models}"
             )
 
-        token_provider = get_bearer_token_provider(
-            self._get_credential(), "https://cognitiveservices.azure.com/.default"
-        )
-
-        self.OA_client = AzureOpenAI(
-            azure_endpoint=endpoint_url,
-            api_version=api_version,
-            azure_ad_token_provider=token_provider,
+        self.OA_client = self._create_client(endpoint_url, api_version, api_key)
+        self.rate_limiter = rate_limiter or RateLimiter(
+            requests_per_minute, tokens_per_minute
         )
+        self.backoff_base_s = backoff_base_s
+        self.max_backoff_s = max_backoff_s
+        self.cache = cache
 
         self.max_retries = max_retries
         self.system_msg = system_msg
@@ -54,9 +156,37 @@ class GPT:
         self.presence_penalty = presence_penalty
         self.seed = seed
 
+    def _create_client(
+        self, endpoint_url: str, api_version: str, api_key: str | None
+    ) -> AzureOpenAI:
+        if api_key is not None:
+            return AzureOpenAI(
+                azure_endpoint=endpoint_url,
+                api_version=api_version,
+                api_key=api_key,
+                max_retries=0,
+            )
+        # The retries are done by `_request`
+        return AzureOpenAI(
+            azure_endpoint=endpoint_url,
+            api_version=api_version,
+            azure_ad_token_provider=self._get_token_provider(),
+            max_retries=0,
+        )
+
+    def _get_token_provider(self):
+        return get_bearer_token_provider(
+            self._get_credential(), "https://cognitiveservices.azure.com/.default"
+        )
+
     def set_seed(self, seed: int):
         self.seed = seed
 
+    @property
+    def stats(self) -> RateLimitStats:
+        """Throttling and retry statistics of the calls"""
+        return self.rate_limiter.stats
+
     def _get_credential(self, lib_name: str = "azure_openai") -> DeviceCodeCredential:
         """Retrieves a credential to be used for authentication in Azure"""
         if sys.platform.startswith("win"):
@@ -86,46 +216,180 @@ class GPT:
 
         return credential
 
+    def _get_chat_params(self) -> dict:
+        return dict(
+            model=self.model_name,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=self.top_p,
+            frequency_penalty=self.frequency_penalty,
+            presence_penalty=self.presence_penalty,
+            seed=self.seed if self.seed else None,
+        )
+
+    def _get_messages(self, prompt: str) -> list[dict]:
+        return [
+            {
+                "role": "system",
+                "content": self.system_msg,
+            },
+            {
+                "role": "user",
+                "content": prompt,
+            },
+        ]
+
+    def _get_cache_key(self, kind: str, **fields) -> str | None:
+        """Key of a request in the cache, None without cache"""
+        if self.cache is None:
+            return None
+        return make_cache_key(kind=kind, **fields)
+
+    def _get_chat_cache_key(self, messages: list[dict]) -> str | None:
+        return self._get_cache_key("chat", messages=messages, **self._get_chat_params())
+
+    def _get_embedding_cache_key(self, text: str) -> str | None:
+        return self._get_cache_key("embedding", model=self.model_name, input=text)
+
+    def _cache_get(self, key: str | None):
+        return self.cache.get(key) if key is not None else None
+
+    def _cache_put(self, key: str | None, value):
+        if key is not None and value is not None:
+            self.cache.put(key, value)
+
+    def _split_cached_embeddings(
+        self, texts: list[str]
+    ) -> tuple[list[str | None], list[list[float] | None], list[int]]:
+        """Cache keys and cached embeddings of the texts, indices of the missing ones"""
+        cache_keys = [self._get_embedding_cache_key(text) for text in texts]
+        embeddings = [self._cache_get(key) for key in cache_keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return cache_keys, embeddings, missing
+
+    def _merge_new_embeddings(
+        self,
+        cache_keys: list[str | None],
+        embeddings: list[list[float] | None],
+        missing: list[int],
+        new_embeddings: list[list[float] | None],
+    ) -> list[list[float] | None]:
+        """Fills the missing embeddings with the new ones, which are cached"""
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+            self._cache_put(cache_keys[i], embedding)
+        return embeddings
+
+    def _get_chat_request(self, messages: list[dict]) -> tuple[Callable, int]:
+        """The request creating a chat completion and its number of tokens"""
+        return (
+            lambda: self.OA_client.chat.completions.create(
+                messages=messages, **self._get_chat_params()
+            ),
+            self._count_chat_tokens(messages),
+        )
+
+    def _get_embedding_request(self, texts: str | list[str]) -> tuple[Callable, int]:
+        """The request embedding a text or a batch of texts and its number of tokens"""
+        num_tokens = sum(
+            estimate_num_tokens(text)
+            for text in ([texts] if isinstance(texts, str) else texts)
+        )
+        return (
+            lambda: self.OA_client.embeddings.create(
+                input=texts, model=self.model_name
+            ),
+            num_tokens,
+        )
+
+    def _count_chat_tokens(self, messages: list[dict]) -> int:
+        """Tokens counted against the quota: the prompt and the maximum completion"""
+        return (
+            sum(estimate_num_tokens(message["content"] or "") for message in messages)
+            + self.max_tokens
+        )
+
+    def _get_backoff(self, error: Exception, attempt: int) -> float:
+        response = getattr(error, "response", None)
+        retry_after = get_retry_after(getattr(response, "headers", None))
+        delay = backoff_delay(
+            attempt, self.backoff_base_s, self.max_backoff_s, retry_after=retry_after
+        )
+        if retry_after is not None:
+            # The other requests sharing the limiter wait for the server too
+            self.rate_limiter.pause(min(retry_after, self.max_backoff_s))
+        self.rate_limiter.record_retry(delay, isinstance(error, RateLimitError))
+        return delay
+
+    def _request(self, create: Callable[[], object], num_tokens: int):
+        """
+        Sends the request made by `create` within the rate limits, up to `max_retries`
+        times while it fails with a retryable error or an empty response. Raises the
+        last error if every attempt failed with one, returns None if they were empty.
+        """
+        for attempt in range(self.max_retries):
+            self.rate_limiter.acquire(num_tokens)
+            try:
+                response = create()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries - 1:
+                    self.rate_limiter.record_failure()
+                    raise
+                time.sleep(self._get_backoff(e, attempt))
+                continue
+            if response:
+                return response
+        self.rate_limiter.record_failure()
+        return None
+
     def api_call_chat(self, messages: list[dict]) -> str | None:
-        for _ in range(self.max_retries):
-            completion = self.OA_client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                top_p=self.top_p,
-                frequency_penalty=self.frequency_penalty,
-                presence_penalty=self.presence_penalty,
-                seed=self.seed if self.seed else None,
+        cache_key = self._get_chat_cache_key(messages)
+        content = self._cache_get(cache_key)
+        if content is None:
+            content = _get_chat_content(
+                self._request(*self._get_chat_request(messages))
             )
-            if completion:
-                return completion.choices[0].message.content
-        return None
+            self._cache_put(cache_key, content)
+        return content
 
     def _api_call_embedding(self, text: str) -> list[float] | None:
-        for _ in range(self.max_retries):
-            embedding = self.OA_client.embeddings.create(
-                input=text, model=self.model_name
+        cache_key = self._get_embedding_cache_key(text)
+        embedding = self._cache_get(cache_key)
+        if embedding is None:
+            embedding = _get_embedding_from_response(
+                self._request(*self._get_embedding_request(text))
             )
-            if embedding:
-                return embedding.data[0].embedding
-        return None
+            self._cache_put(cache_key, embedding)
+        return embedding
+
+    def _api_call_embeddings(self, texts: list[str]) -> list[list[float]] | None:
+        response = self._request(*self._get_embedding_request(texts))
+        return _get_embeddings_from_response(response, len(texts))
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float] | None]:
+        """
+        Embeddings of a batch sent as one request. A request rejected because of its
+        inputs is bisected until the texts causing the error are alone, their
+        embedding is None.
+        """
+        try:
+            embeddings = self._api_call_embeddings(texts)
+        except BadRequestError as e:
+            logger.warning("Error embedding a batch of %d texts: %s", len(texts), e)
+            embeddings = None
+        if embeddings is not None:
+            return embeddings
+        if len(texts) == 1:
+            return [None]
+        half = len(texts) // 2
+        return self._embed_batch(texts[:half]) + self._embed_batch(texts[half:])
 
     def generate_response(self, prompt: str) -> str | None:
         """
         Generate a response for the given prompt.
         This setup can be used for GPT4 models but not for embedding genneration.
         """
-        messages = [
-            {
-                "role": "system",
-                "content": self.system_msg,
-            },
-            {
-                "role": "user",
-                "content": prompt,
-            },
-        ]
+        messages = self._get_messages(prompt)
 
         response = self.api_call_chat(messages)
         return response
@@ -138,6 +402,173 @@ class GPT:
         embedding = self._api_call_embedding(text)
         return embedding
 
+    def generate_embeddings(
+        self, texts: list[str], batch_size: int = 256, max_batch_tokens: int = 100000
+    ) -> list[list[float] | None]:
+        """
+        Embeddings of the texts, in order, with one request per batch of at most
+        `batch_size` texts and `max_batch_tokens` tokens. See `_embed_batch` for the
+        texts that cannot be embedded. Only the texts missing from the cache are sent.
+        """
+        cache_keys, embeddings, missing = self._split_cached_embeddings(texts)
+        new_embeddings = []
+        for batch in split_into_batches(
+            [texts[i] for i in missing], batch_size, max_batch_tokens
+        ):
+            new_embeddings.extend(self._embed_batch(batch))
+        return self._merge_new_embeddings(
+            cache_keys, embeddings, missing, new_embeddings
+        )
+
+
+class AsyncGPT(GPT):
+    """
+    Asyncio version of `GPT`, the API calls are coroutines. At most `max_concurrency`
+    requests are in flight at once, they share the connection pool of a single client.
+    `gather_responses` and `gather_embeddings` run a batch of calls concurrently.
+    Use it within one event loop and close it with `await gpt.close()` or `async with`.
+    """
+
+    def __init__(self, *args, max_concurrency: int = 64, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _create_client(
+        self, endpoint_url: str, api_version: str, api_key: str | None
+    ) -> AsyncAzureOpenAI:
+        if api_key is not None:
+            return AsyncAzureOpenAI(
+                azure_endpoint=endpoint_url,
+                api_version=api_version,
+                api_key=api_key,
+                max_retries=0,
+            )
+        return AsyncAzureOpenAI(
+            azure_endpoint=endpoint_url,
+            api_version=api_version,
+            azure_ad_token_provider=self._get_token_provider(),
+            max_retries=0,
+        )
+
+    async def _request(self, create: Callable[[], Awaitable], num_tokens: int):
+        """
+        See `GPT._request`. The request takes a semaphore slot before reserving its
+        rate limit, so only the requests about to be sent hold reservations, and keeps
+        it while in flight.
+        """
+        for attempt in range(self.max_retries):
+            try:
+                async with self._semaphore:
+                    await self.rate_limiter.acquire_async(num_tokens)
+                    response = await create()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries - 1:
+                    self.rate_limiter.record_failure()
+                    raise
+                await asyncio.sleep(self._get_backoff(e, attempt))
+                continue
+            if response:
+                return response
+        self.rate_limiter.record_failure()
+        return None
+
+    async def api_call_chat(self, messages: list[dict]) -> str | None:
+        cache_key = self._get_chat_cache_key(messages)
+        content = self._cache_get(cache_key)
+        if content is None:
+            content = _get_chat_content(
+                await self._request(*self._get_chat_request(messages))
+            )
+            self._cache_put(cache_key, content)
+        return content
+
+    async def _api_call_embedding(self, text: str) -> list[float] | None:
+        cache_key = self._get_embedding_cache_key(text)
+        embedding = self._cache_get(cache_key)
+        if embedding is None:
+            embedding = _get_embedding_from_response(
+                await self._request(*self._get_embedding_request(text))
+            )
+            self._cache_put(cache_key, embedding)
+        return embedding
+
+    async def _api_call_embeddings(
+        self, texts: list[str]
+    ) -> list[list[float]] | None:
+        response = await self._request(*self._get_embedding_request(texts))
+        return _get_embeddings_from_response(response, len(texts))
+
+    async def _embed_batch(self, texts: list[str]) -> list[list[float] | None]:
+        try:
+            embeddings = await self._api_call_embeddings(texts)
+        except BadRequestError as e:
+            logger.warning("Error embedding a batch of %d texts: %s", len(texts), e)
+            embeddings = None
+        if embeddings is not None:
+            return embeddings
+        if len(texts) == 1:
+            return [None]
+        half = len(texts) // 2
+        first_half, second_half = await asyncio.gather(
+            self._embed_batch(texts[:half]), self._embed_batch(texts[half:])
+        )
+        return first_half + second_half
+
+    async def generate_response(self, prompt: str) -> str | None:
+        return await self.api_call_chat(self._get_messages(prompt))
+
+    async def generate_embedding(self, text: str) -> list[float] | None:
+        return await self._api_call_embedding(text)
+
+    async def gather_responses(
+        self, prompts: list[str], return_exceptions: bool = False
+    ) -> list[str | None]:
+        """
+        Responses to the prompts, in order. With `return_exceptions` the exception of
+        a failed prompt is returned in its place instead of being raised.
+        """
+        return await asyncio.gather(
+            *(self.generate_response(prompt) for prompt in prompts),
+            return_exceptions=return_exceptions,
+        )
+
+    async def gather_embeddings(
+        self, texts: list[str], return_exceptions: bool = False
+    ) -> list[list[float] | None]:
+        """Embeddings of the texts, in order, see `gather_responses`"""
+        return await asyncio.gather(
+            *(self.generate_embedding(text) for text in texts),
+            return_exceptions=return_exceptions,
+        )
+
+    async def generate_embeddings(
+        self, texts: list[str], batch_size: int = 256, max_batch_tokens: int = 100000
+    ) -> list[list[float] | None]:
+        """Embeddings of the texts, in order, the batches are sent concurrently"""
+        cache_keys, embeddings, missing = self._split_cached_embeddings(texts)
+        batch_embeddings = await asyncio.gather(
+            *(
+                self._embed_batch(batch)
+                for batch in split_into_batches(
+                    [texts[i] for i in missing], batch_size, max_batch_tokens
+                )
+            )
+        )
+        new_embeddings = [e for batch in batch_embeddings for e in batch]
+        return self._merge_new_embeddings(
+            cache_keys, embeddings, missing, new_embeddings
+        )
+
+    async def close(self):
+        await self.OA_client.close()
+
+    async def __aenter__(self) -> "AsyncGPT":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
 
 def parser_args():
     parser = argparse.ArgumentParser(description="GPT Session")
@@ -21,3 +21,7 @@ class KBLaMConfig(PretrainedConfig):
         self.sep_query_head = sep_query_head
         self.attn_implementation = attn_implementation
         super().__init__(**kwargs)
+
+    def get_kb_layer_indices(self, num_hidden_layers: int) -> list[int]:
+        """Indices of the layers attending over the KB"""
+        return list(range(0, num_hidden_layers, self.kb_layer_frequency))
@@ -0,0 +1,255 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Iterable, NamedTuple
+
+import numpy as np
+import torch
+
+# Events fired by the KBLaM attention layers, every hook is called as `hook(layer_idx, tensor, kb_len)`
+# attention_start: the input hidden states, before any projection
+# kb_logits: the pre-softmax scores of the queries on the KB tokens, (bsz, num_heads, q_len, kb_len)
+# pruned_indices: indices of the KB entries kept by dynamic sparsification, (bsz, top_k_kb)
+# attention_weights: the post-softmax attention weights, (bsz, num_heads, q_len, kb_len + seq_len)
+# attention_end: the attention output, after the output projection
+# kb_len is the number of KB tokens the layer attends over (0 for layers without KB), for pruned_indices it is the
+# number of KB entries before pruning.
+KB_HOOK_EVENTS = ("attention_start", "kb_logits", "pruned_indices", "attention_weights", "attention_end")
+
+KBHook = Callable[[int, torch.Tensor, int], None]
+
+
+class KBHookHandle:
+    def __init__(self, hooks: "KBAttentionHooks", event: str, hook_id: int):
+        self.hooks = hooks
+        self.event = event
+        self.hook_id = hook_id
+
+    def remove(self):
+        self.hooks._hooks[self.event].pop(self.hook_id, None)
+
+
+class KBAttentionHooks:
+    """
+    Registry of the hooks observing the KBLaM attention layers, shared by all the layers of a model.
+    The layers only check `event in hooks` before building a payload, so there is no cost when nothing is registered.
+    """
+
+    def __init__(self):
+        self._hooks: dict[str, dict[int, KBHook]] = {event: {} for event in KB_HOOK_EVENTS}
+        self._next_id = 0
+
+    def register(self, event: str, hook: KBHook) -> KBHookHandle:
+        if event not in self._hooks:
+            raise ValueError(f"Unknown event {event}, expected one of {KB_HOOK_EVENTS}")
+        self._hooks[event][self._next_id] = hook
+        self._next_id += 1
+        return KBHookHandle(self, event, self._next_id - 1)
+
+    def add_observer(self, observer) -> list[KBHookHandle]:
+        """Register every `on_{event}` method of `observer`."""
+        handles = [
+            self.register(event, getattr(observer, f"on_{event}"))
+            for event in KB_HOOK_EVENTS
+            if hasattr(observer, f"on_{event}")
+        ]
+        if not handles:
+            raise ValueError(f"{observer} does not define any of the on_{{event}} methods")
+        return handles
+
+    @contextmanager
+    def observe(self, *observers):
+        """Register the observers for the duration of the context."""
+        handles = [handle for observer in observers for handle in self.add_observer(observer)]
+        try:
+            yield observers
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def clear(self):
+        for hooks in self._hooks.values():
+            hooks.clear()
+
+    def __contains__(self, event: str) -> bool:
+        return bool(self._hooks[event])
+
+    def fire(self, event: str, layer_idx: int, tensor: torch.Tensor, kb_len: int):
+        for hook in list(self._hooks[event].values()):
+            hook(layer_idx, tensor, kb_len)
+
+
+class KBAttentionAccuracyObserver:
+    """
+    Keeps, for every layer attending over the KB, the attention weights on the KB tokens summed over heads and query
+    positions, i.e. a `(bsz, kb_len)` tensor that stays on device.
+    Like the `.npy` dumps it replaces, only prefill passes (q_len > 1) are recorded and a later pass overwrites
+    an earlier one.
+    """
+
+    def __init__(self):
+        self.kb_attention: dict[int, torch.Tensor] = {}
+        self.num_summed: dict[int, int] = {}
+
+    def on_attention_weights(self, layer_idx: int, attn_weights: torch.Tensor, kb_len: int):
+        _, num_heads, q_len, _ = attn_weights.shape
+        if kb_len == 0 or q_len <= 1:
+            return
+        self.kb_attention[layer_idx] = attn_weights.detach()[..., :kb_len].float().sum((1, 2))
+        self.num_summed[layer_idx] = num_heads * q_len
+
+    def reset(self):
+        self.kb_attention.clear()
+        self.num_summed.clear()
+
+    def accuracy(self, labels: torch.Tensor | Iterable[int], layers: Iterable[int] | None = None, topk: int = 5):
+        """
+        Retrieval accuracy of the KB attention summed over `layers` (all recorded layers by default).
+        labels: Index of the correct KB entry for every example in the batch
+
+        Returns a dictionary with the top-1 accuracy, the top-k accuracy and the confidence, i.e. the largest
+        softmax probability of the mean KB attention.
+        """
+        layers = sorted(self.kb_attention) if layers is None else [i for i in layers if i in self.kb_attention]
+        if not layers:
+            raise ValueError("No KB attention has been recorded for the requested layers")
+        kb_attention = sum(self.kb_attention[i] for i in layers)
+        labels = torch.as_tensor(labels, device=kb_attention.device)
+        acc = (kb_attention.argmax(-1) == labels).float().mean()
+        top_k_predictions = kb_attention.topk(min(topk, kb_attention.shape[-1]), dim=-1).indices
+        top_k_acc = (top_k_predictions == labels[:, None]).any(-1).float().mean()
+        mean_kb_attention = kb_attention / sum(self.num_summed[i] for i in layers)
+        confidence = torch.softmax(mean_kb_attention, -1).max()
+        return {"acc": acc.item(), "topk_acc": top_k_acc.item(), "confidence": confidence.item()}
+
+
+class KBTopK(NamedTuple):
+    indices: torch.Tensor
+    scores: torch.Tensor
+
+
+class KBAttentionScoreObserver:
+    """
+    Keeps, for every layer attending over the KB, the score of every KB entry: its attention weight averaged over
+    heads and query positions, a `(bsz, kb_len)` tensor. A later pass overwrites an earlier one, unless
+    `first_pass_only` is set, e.g. to keep the prefill pass of a generation. With dynamic sparsification only the
+    kept entries are scored, `topk` maps them back to their index in the whole KB.
+    """
+
+    def __init__(self, first_pass_only: bool = False):
+        self.first_pass_only = first_pass_only
+        self.kb_scores: dict[int, torch.Tensor] = {}
+        self.pruned_indices: dict[int, torch.Tensor] = {}
+
+    def _is_recorded(self, layer_idx: int) -> bool:
+        return self.first_pass_only and layer_idx in self.kb_scores
+
+    def on_pruned_indices(self, layer_idx: int, indices: torch.Tensor, kb_len: int):
+        if not self._is_recorded(layer_idx):
+            self.pruned_indices[layer_idx] = indices.detach()
+
+    def on_attention_weights(self, layer_idx: int, attn_weights: torch.Tensor, kb_len: int):
+        if kb_len == 0 or self._is_recorded(layer_idx):
+            return
+        self.kb_scores[layer_idx] = attn_weights.detach()[..., :kb_len].float().mean((1, 2))
+
+    def topk(self, k: int) -> dict[int, KBTopK]:
+        """The `k` best scored KB entries of every layer, as `(bsz, k)` indices and scores"""
+        results = {}
+        for layer_idx, scores in sorted(self.kb_scores.items()):
+            top = scores.topk(min(k, scores.shape[-1]), dim=-1)
+            indices = top.indices
+            if layer_idx in self.pruned_indices:
+                indices = self.pruned_indices[layer_idx].gather(-1, indices)
+            results[layer_idx] = KBTopK(indices, top.values)
+        return results
+
+
+class KBAttentionEntropyObserver:
+    """
+    Per layer statistics of how the attention is spread over the KB, averaged over every example, head and query
+    recorded: the attention mass put on the KB tokens, and the entropy (in nats) of the attention renormalized
+    over the KB tokens.
+    """
+
+    def __init__(self):
+        self._sums: dict[int, torch.Tensor] = {}
+        self._counts: dict[int, int] = defaultdict(int)
+
+    def on_attention_weights(self, layer_idx: int, attn_weights: torch.Tensor, kb_len: int):
+        if kb_len == 0:
+            return
+        kb_attention = attn_weights.detach()[..., :kb_len].float()
+        kb_mass = kb_attention.sum(-1)
+        kb_probs = kb_attention / kb_mass.unsqueeze(-1).clamp_min(1e-12)
+        entropy = -torch.special.xlogy(kb_probs, kb_probs).sum(-1)
+        sums = torch.stack([kb_mass.sum(), entropy.sum()])
+        self._sums[layer_idx] = self._sums[layer_idx] + sums if layer_idx in self._sums else sums
+        self._counts[layer_idx] += kb_mass.numel()
+
+    def reset(self):
+        self._sums.clear()
+        self._counts.clear()
+
+    def summary(self) -> dict[int, dict[str, float]]:
+        return {
+            layer_idx: {
+                "kb_mass": (sums[0] / self._counts[layer_idx]).item(),
+                "entropy": (sums[1] / self._counts[layer_idx]).item(),
+            }
+            for layer_idx, sums in sorted(self._sums.items())
+        }
+
+
+class KBAttentionLatencyObserver:
+    """
+    Wall clock time spent in the attention of every layer. On GPU the device is synchronized at the start and the
+    end of each attention call, which adds overhead, so use it for profiling only.
+    """
+
+    def __init__(self):
+        self.total_time: dict[int, float] = defaultdict(float)
+        self.num_calls: dict[int, int] = defaultdict(int)
+        self._start_time: dict[int, float] = {}
+
+    @staticmethod
+    def _sync(tensor: torch.Tensor):
+        if tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)
+
+    def on_attention_start(self, layer_idx: int, hidden_states: torch.Tensor, kb_len: int):
+        self._sync(hidden_states)
+        self._start_time[layer_idx] = time.perf_counter()
+
+    def on_attention_end(self, layer_idx: int, attn_output: torch.Tensor, kb_len: int):
+        self._sync(attn_output)
+        self.total_time[layer_idx] += time.perf_counter() - self._start_time.pop(layer_idx)
+        self.num_calls[layer_idx] += 1
+
+    def reset(self):
+        self.total_time.clear()
+        self.num_calls.clear()
+        self._start_time.clear()
+
+    def summary(self) -> dict[int, dict[str, float]]:
+        return {
+            layer_idx: {"total_s": total, "mean_ms": 1000 * total / self.num_calls[layer_idx]}
+            for layer_idx, total in sorted(self.total_time.items())
+        }
+
+
+class AttentionWeightsSaver:
+    """Dumps the full post-softmax attention weights of every prefill pass to `{save_dir}/{base_name}_{layer_idx}.npy`"""
+
+    def __init__(self, save_dir: str, base_name: str):
+        self.save_dir = save_dir
+        self.base_name = base_name
+
+    def on_attention_weights(self, layer_idx: int, attn_weights: torch.Tensor, kb_len: int):
+        if attn_weights.shape[2] <= 1:
+            return
+        np.save(
+            os.path.join(self.save_dir, f"{self.base_name}_{layer_idx}.npy"),
+            attn_weights.detach().to(torch.float32).cpu().numpy(),
+        )
@@ -23,7 +23,6 @@ Adapted from https://github.com/huggingface/transformers/blob/main/src/transform
 """
 
 import math
-import os
 import copy
 from typing import List, Optional, Tuple, Union
 
@@ -61,6 +60,7 @@ from transformers.utils import (
 )
 
 from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.kblam_hooks import KBAttentionHooks, KBAttentionScoreObserver, KBTopK
 
 logger = logging.get_logger(__name__)
 
@@ -102,6 +102,8 @@ class KblamLlamaAttention(nn.Module):
         self.q_proj_new = nn.Linear(
             self.hidden_size, self.num_heads * self.head_dim, bias=config.attention_bias
         )
+        # Shared by all the layers of the model, see `KblamLlamaForCausalLM.kb_hooks`
+        self.kb_hooks = KBAttentionHooks()
         self.k_proj = nn.Linear(
             self.hidden_size,
             self.num_key_value_heads * self.head_dim,
@@ -156,13 +158,22 @@ class KblamLlamaAttention(nn.Module):
             return kb_keys, kb_values, attn_weights
         with torch.autograd.no_grad():
             top_idx = attn_weights.sum((1, 2)).topk(min(kb_len, topk_size), -1)[1]
+            if "pruned_indices" in self.kb_hooks:
+                self.kb_hooks.fire("pruned_indices", self.layer_idx, top_idx, kb_len)
             # top_idx = attn_weights.sum(1).topk(topk_size, -1)[1]
+            # Keep the scores of the selected entries, in the same order as the keys
+            attn_weights = attn_weights.gather(
+                -1,
+                top_idx.view(batch_size, 1, 1, topk_size).expand(
+                    *attn_weights.shape[:-1], topk_size
+                ),
+            )
             top_idx = top_idx.view(batch_size, -1, topk_size, 1).expand(
                 batch_size, num_heads, topk_size, head_dim
             )
             kb_keys = kb_keys.gather(-2, top_idx)
             kb_values = kb_values.gather(-2, top_idx)
-        return kb_keys, kb_values, attn_weights[..., :topk_size]
+        return kb_keys, kb_values, attn_weights
 
     def forward(
         self,
@@ -175,19 +186,20 @@ class KblamLlamaAttention(nn.Module):
         cache_position: Optional[torch.LongTensor] = None,
         kb_kvs: Optional[tuple] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = True,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-        if save_attention_weights:
-            assert (
-                attention_save_loc is not None
-            ), "Please provide a location to save the attention weights"
-            assert (
-                attention_file_base_name is not None
-            ), "Please provide a base name for the attention weights"
         bsz, q_len, _ = hidden_states.size()
+        # The KB query head is only used by the layers that attend over the KB
+        use_kb = (
+            kb_kvs is not None and self.layer_idx % kb_config.kb_layer_frequency == 0
+        )
+        if "attention_start" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "attention_start",
+                self.layer_idx,
+                hidden_states,
+                kb_kvs[0].shape[-2] if use_kb else 0,
+            )
         if self.config.pretraining_tp > 1:
             key_value_slicing = (
                 self.num_key_value_heads * self.head_dim
@@ -218,16 +230,18 @@ class KblamLlamaAttention(nn.Module):
 
         else:
             query_states = self.q_proj(hidden_states)
-            query_states_2 = self.q_proj_new(hidden_states)
             key_states = self.k_proj(hidden_states)
             value_states = self.v_proj(hidden_states)
 
         query_states = query_states.view(
             bsz, q_len, self.num_heads, self.head_dim
         ).transpose(1, 2)
-        query_states_2 = query_states_2.view(
-            bsz, q_len, self.num_heads, self.head_dim
-        ).transpose(1, 2)
+        if use_kb:
+            query_states_2 = (
+                self.q_proj_new(hidden_states)
+                .view(bsz, q_len, self.num_heads, self.head_dim)
+                .transpose(1, 2)
+            )
         key_states = key_states.view(
             bsz, q_len, self.num_key_value_heads, self.head_dim
         ).transpose(1, 2)
@@ -351,23 +365,23 @@ class KblamLlamaAttention(nn.Module):
                         )
                     attn_weights = torch.concat([attn_weights_2, attn_weights], -1)
 
+        if use_kb and "kb_logits" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "kb_logits", self.layer_idx, attn_weights[..., :kb_len], kb_len
+            )
+
         if attention_mask is not None:  # no matter the length, we just slice it
             causal_mask = attention_mask[:, :, :, : key_states.shape[-2]]
             attn_weights = attn_weights + causal_mask
         # upcast attention to fp32
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32)
-        if not attn_weights.requires_grad:
-            # TODO: Make this function injectable
-            if save_attention_weights:
-                if q_len > 1:
-                    save_path = os.path.join(
-                        attention_save_loc,
-                        f"{attention_file_base_name}_{self.layer_idx}.npy",
-                    )
-                    np.save(
-                        save_path,
-                        attn_weights.to(torch.float32).cpu().detach().numpy(),
-                    )
+        if "attention_weights" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "attention_weights",
+                self.layer_idx,
+                attn_weights,
+                kb_len if use_kb else 0,
+            )
         attn_weights = attn_weights.to(query_states.dtype)
         attn_weights = nn.functional.dropout(
             attn_weights, p=self.attention_dropout, training=self.training
@@ -400,6 +414,11 @@ class KblamLlamaAttention(nn.Module):
         else:
             attn_output = self.o_proj(attn_output)
 
+        if "attention_end" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "attention_end", self.layer_idx, attn_output, kb_len if use_kb else 0
+            )
+
         if not output_attentions:
             attn_weights = None
 
@@ -439,9 +458,6 @@ class LlamaDecoderLayer(nn.Module):
         cache_position: Optional[torch.LongTensor] = None,
         kb_kvs: Optional[tuple] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = False,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
     ) -> Tuple[
         torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]
     ]:
@@ -474,9 +490,6 @@ class LlamaDecoderLayer(nn.Module):
             cache_position=cache_position,
             kb_kvs=kb_kvs,
             kb_config=kb_config,
-            save_attention_weights=save_attention_weights,
-            attention_save_loc=attention_save_loc,
-            attention_file_base_name=attention_file_base_name,
         )
         hidden_states = residual + hidden_states
 
@@ -524,7 +537,13 @@ class LlamaModel(LlamaPreTrainedModel):
             ]
         )
         self.norm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.kb_hooks = KBAttentionHooks()
+        for layer in self.layers:
+            layer.self_attn.kb_hooks = self.kb_hooks
         self.gradient_checkpointing = False
+        # Only checkpoint the layers attending over the KB,
+        # see `KblamLlamaForCausalLM.gradient_checkpointing_enable`
+        self.gradient_checkpointing_kb_layers_only = False
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -550,10 +569,14 @@ class LlamaModel(LlamaPreTrainedModel):
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = False,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
+        exit_after_layer: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
+        r"""
+        exit_after_layer (`int`, *optional*):
+            Only run the decoder layers up to this one (included), e.g. the last layer
+            attending over the KB when only the KB attention is needed. The final norm
+            is skipped when exiting early.
+        """
         output_attentions = (
             output_attentions
             if output_attentions is not None
@@ -574,7 +597,7 @@ class LlamaModel(LlamaPreTrainedModel):
                 "You cannot specify both input_ids and inputs_embeds at the same time, and must specify either one"
             )
 
-        if self.gradient_checkpointing and self.training and use_cache:
+        if self.gradient_checkpointing and torch.is_grad_enabled() and use_cache:
             logger.warning_once(
                 "`use_cache=True` is incompatible with gradient checkpointing. Setting `use_cache=False`."
             )
@@ -602,12 +625,14 @@ class LlamaModel(LlamaPreTrainedModel):
         if position_ids is None:
             position_ids = cache_position.unsqueeze(0)
 
+        # The KBLaM attention is always eager and needs the full causal mask to append
+        # the KB block to, even when the attention weights are not returned
         causal_mask = self._update_causal_mask(
             attention_mask,
             inputs_embeds,
             cache_position,
             past_key_values,
-            output_attentions,
+            output_attentions=True,
         )
 
         # embed positions
@@ -618,11 +643,23 @@ class LlamaModel(LlamaPreTrainedModel):
         all_self_attns = () if output_attentions else None
         next_decoder_cache = None
 
-        for decoder_layer in self.layers:
+        num_layers = (
+            len(self.layers) if exit_after_layer is None else exit_after_layer + 1
+        )
+        for layer_idx, decoder_layer in enumerate(self.layers[:num_layers]):
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
 
-            if self.gradient_checkpointing and self.training:
+            # The frozen base model is trained in eval mode,
+            # so check for grad mode rather than `self.training`
+            is_kb_layer = (
+                kb_kvs is not None and layer_idx % kb_config.kb_layer_frequency == 0
+            )
+            if (
+                self.gradient_checkpointing
+                and torch.is_grad_enabled()
+                and (is_kb_layer or not self.gradient_checkpointing_kb_layers_only)
+            ):
                 layer_outputs = self._gradient_checkpointing_func(
                     decoder_layer.__call__,
                     hidden_states,
@@ -634,9 +671,6 @@ class LlamaModel(LlamaPreTrainedModel):
                     cache_position,
                     kb_kvs,
                     kb_config,
-                    save_attention_weights,
-                    attention_save_loc,
-                    attention_file_base_name,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -649,9 +683,6 @@ class LlamaModel(LlamaPreTrainedModel):
                     cache_position=cache_position,
                     kb_kvs=kb_kvs,
                     kb_config=kb_config,
-                    save_attention_weights=save_attention_weights,
-                    attention_save_loc=attention_save_loc,
-                    attention_file_base_name=attention_file_base_name,
                 )
 
             hidden_states = layer_outputs[0]
@@ -662,7 +693,8 @@ class LlamaModel(LlamaPreTrainedModel):
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
 
-        hidden_states = self.norm(hidden_states)
+        if num_layers == len(self.layers):
+            hidden_states = self.norm(hidden_states)
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
@@ -842,6 +874,67 @@ class KblamLlamaForCausalLM(LlamaPreTrainedModel):
         self.generation_config.pad_token_id = tokenizer.pad_token_id
         self.generation_config.eos_token_id = tokenizer.eos_token_id
 
+    def gradient_checkpointing_enable(
+        self, gradient_checkpointing_kwargs=None, kb_layers_only: bool = False
+    ):
+        """
+        kb_layers_only: Only recompute the layers that attend over the KB tokens in
+            backward. These hold the largest activations and the trainable query heads,
+            the frozen layers in between keep their activations.
+        """
+        if gradient_checkpointing_kwargs is None:
+            # The KB is passed as a tuple of tensors,
+            # the reentrant implementation would not propagate gradients to it
+            gradient_checkpointing_kwargs = {"use_reentrant": False}
+        super().gradient_checkpointing_enable(gradient_checkpointing_kwargs)
+        self.model.gradient_checkpointing_kb_layers_only = kb_layers_only
+
+    @property
+    def kb_hooks(self) -> KBAttentionHooks:
+        """Registry of the hooks observing the KB attention layers, see `kblam_hooks`"""
+        return self.model.kb_hooks
+
+    @torch.no_grad()
+    def score_kb(
+        self,
+        input_ids: torch.LongTensor,
+        kb_kvs: tuple,
+        kb_config: KBLaMConfig,
+        attention_mask: Optional[torch.Tensor] = None,
+        topk: int = 5,
+    ) -> dict[int, KBTopK]:
+        """
+        Scores the KB entries against the questions `input_ids` (left padded) with a
+        single prefill pass, which stops after the last layer attending over the KB.
+        Nothing is generated and `lm_head` is never run.
+
+        Returns, for every layer attending over the KB, the `topk` best scored KB
+        entries of every question as `(bsz, topk)` indices and scores. The score of an
+        entry is its attention weight averaged over heads and query tokens, over the
+        whole KB: dynamic sparsification is disabled.
+        """
+        if kb_config.dynamic_sparsify:
+            kb_config = copy.copy(kb_config)
+            kb_config.dynamic_sparsify = False
+        position_ids = None
+        if attention_mask is not None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+        score_observer = KBAttentionScoreObserver()
+        with self.kb_hooks.observe(score_observer):
+            self(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=False,
+                kb_kvs=kb_kvs,
+                kb_config=kb_config,
+                exit_after_layer=kb_config.get_kb_layer_indices(
+                    self.config.num_hidden_layers
+                )[-1],
+            )
+        return score_observer.topk(topk)
+
     def load_query_head(self, ckpt_dir):
         learned_query_heads = torch.load(ckpt_dir)
         assert len(learned_query_heads) == self.model.config.num_hidden_layers
@@ -870,9 +963,7 @@ class KblamLlamaForCausalLM(LlamaPreTrainedModel):
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = False,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
+        exit_after_layer: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -880,6 +971,9 @@ class KblamLlamaForCausalLM(LlamaPreTrainedModel):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            exit_after_layer (`int`, *optional*):
+                Stop after this decoder layer, for uses that only need the (KB) attention of the first layers, e.g.
+                retrieval. `lm_head` is skipped and the output has no logits.
 
         Returns:
 
@@ -928,11 +1022,20 @@ class KblamLlamaForCausalLM(LlamaPreTrainedModel):
             cache_position=cache_position,
             kb_kvs=kb_kvs,
             kb_config=kb_config,
-            save_attention_weights=save_attention_weights,
-            attention_save_loc=attention_save_loc,
-            attention_file_base_name=attention_file_base_name,
+            exit_after_layer=exit_after_layer,
         )
 
+        if exit_after_layer is not None:
+            if labels is not None:
+                raise ValueError("The loss cannot be computed with `exit_after_layer`")
+            if not return_dict:
+                return outputs
+            return CausalLMOutputWithPast(
+                past_key_values=outputs.past_key_values,
+                hidden_states=outputs.hidden_states,
+                attentions=outputs.attentions,
+            )
+
         hidden_states = outputs[0]
         if self.config.pretraining_tp > 1:
             lm_head_slices = self.lm_head.weight.split(
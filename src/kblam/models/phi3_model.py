@@ -17,7 +17,6 @@
 
 import copy
 import math
-import os
 import warnings
 from typing import List, Optional, Tuple, Union
 
@@ -47,6 +46,7 @@ from transformers.utils import (
 )
 
 from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.kblam_hooks import KBAttentionHooks, KBAttentionScoreObserver, KBTopK
 
 logger = logging.get_logger(__name__)
 
@@ -315,6 +315,8 @@ class KBLaMPhi3Attention(nn.Module):
         self.q_proj_new = nn.Linear(
             self.hidden_size, self.num_heads * self.head_dim, bias=config.attention_bias
         )
+        # Shared by all the layers of the model, see `KBLaMPhi3ForCausalLM.kb_hooks`
+        self.kb_hooks = KBAttentionHooks()
         self._init_rope()
 
     def _init_rope(self):
@@ -343,23 +345,24 @@ class KBLaMPhi3Attention(nn.Module):
         use_cache: bool = False,
         kb_kvs: Optional[tuple] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = False,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-        if save_attention_weights:
-            assert (
-                attention_save_loc is not None
-            ), "Please provide a location to save the attention weights"
-            assert (
-                attention_file_base_name is not None
-            ), "Please provide a base name for the attention weights"
 
         logger.warning_once(
             "You are not running the flash-attention implementation, expect numerical differences."
         )
 
         bsz, q_len, _ = hidden_states.size()
+        # The KB query head is only used by the layers that attend over the KB
+        use_kb = (
+            kb_kvs is not None and self.layer_idx % kb_config.kb_layer_frequency == 0
+        )
+        if "attention_start" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "attention_start",
+                self.layer_idx,
+                hidden_states,
+                kb_kvs[0].shape[-2] if use_kb else 0,
+            )
 
         qkv = self.qkv_proj(hidden_states)
         query_pos = self.num_heads * self.head_dim
@@ -368,14 +371,16 @@ class KBLaMPhi3Attention(nn.Module):
             ..., query_pos : query_pos + self.num_key_value_heads * self.head_dim
         ]
         value_states = qkv[..., query_pos + self.num_key_value_heads * self.head_dim :]
-        query_states_2 = self.q_proj_new(hidden_states)
 
         query_states = query_states.view(
             bsz, q_len, self.num_heads, self.head_dim
         ).transpose(1, 2)
-        query_states_2 = query_states_2.view(
-            bsz, q_len, self.num_heads, self.head_dim
-        ).transpose(1, 2)
+        if use_kb:
+            query_states_2 = (
+                self.q_proj_new(hidden_states)
+                .view(bsz, q_len, self.num_heads, self.head_dim)
+                .transpose(1, 2)
+            )
         key_states = key_states.view(
             bsz, q_len, self.num_key_value_heads, self.head_dim
         ).transpose(1, 2)
@@ -498,6 +503,11 @@ class KBLaMPhi3Attention(nn.Module):
                         )
                     attn_weights = torch.concat([attn_weights_2, attn_weights], -1)
 
+        if use_kb and "kb_logits" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "kb_logits", self.layer_idx, attn_weights[..., :kb_len], kb_len
+            )
+
         if attention_mask is not None:
             attn_weights = attn_weights + attention_mask
 
@@ -506,17 +516,13 @@ class KBLaMPhi3Attention(nn.Module):
             attn_weights, dim=-1, dtype=torch.float32
         ).to(value_states.dtype)
 
-        # Code to save attention info
-        if not attn_weights.requires_grad:
-            if save_attention_weights:
-                if q_len > 1:
-                    np.save(
-                        os.path.join(
-                            attention_save_loc,
-                            f"{attention_file_base_name}_{self.layer_idx}.npy",
-                        ),
-                        attn_weights.to(torch.float32).cpu().detach().numpy(),
-                    )
+        if "attention_weights" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "attention_weights",
+                self.layer_idx,
+                attn_weights,
+                kb_len if use_kb else 0,
+            )
 
         attn_weights = nn.functional.dropout(
             attn_weights, p=self.attention_dropout, training=self.training
@@ -535,6 +541,11 @@ class KBLaMPhi3Attention(nn.Module):
 
         attn_output = self.o_proj(attn_output)
 
+        if "attention_end" in self.kb_hooks:
+            self.kb_hooks.fire(
+                "attention_end", self.layer_idx, attn_output, kb_len if use_kb else 0
+            )
+
         if not output_attentions:
             attn_weights = None
 
@@ -575,9 +586,6 @@ class Phi3DecoderLayer(nn.Module):
         use_cache: Optional[bool] = False,
         kb_kvs: Optional[tuple] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = False,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
         **kwargs,
     ) -> Tuple[
         torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]
@@ -618,9 +626,6 @@ class Phi3DecoderLayer(nn.Module):
             use_cache=use_cache,
             kb_kvs=kb_kvs,
             kb_config=kb_config,
-            save_attention_weights=save_attention_weights,
-            attention_save_loc=attention_save_loc,
-            attention_file_base_name=attention_file_base_name,
         )
 
         hidden_states = residual + self.resid_attn_dropout(attn_outputs)
@@ -785,8 +790,14 @@ class Phi3Model(Phi3PreTrainedModel):
         )
         self._attn_implementation = config._attn_implementation
         self.norm = Phi3RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.kb_hooks = KBAttentionHooks()
+        for layer in self.layers:
+            layer.self_attn.kb_hooks = self.kb_hooks
 
         self.gradient_checkpointing = False
+        # Only checkpoint the layers attending over the KB,
+        # see `KBLaMPhi3ForCausalLM.gradient_checkpointing_enable`
+        self.gradient_checkpointing_kb_layers_only = False
         # Initialize weights and apply final processing
         self.post_init()
 
@@ -810,10 +821,14 @@ class Phi3Model(Phi3PreTrainedModel):
         return_dict: Optional[bool] = None,
         kb_kvs: Optional[tuple] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = False,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
+        exit_after_layer: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
+        r"""
+        exit_after_layer (`int`, *optional*):
+            Only run the decoder layers up to this one (included), e.g. the last layer
+            attending over the KB when only the KB attention is needed. The final norm
+            is skipped when exiting early.
+        """
         output_attentions = (
             output_attentions
             if output_attentions is not None
@@ -844,7 +859,7 @@ class Phi3Model(Phi3PreTrainedModel):
 
         past_key_values_length = 0
 
-        if self.gradient_checkpointing and self.training:
+        if self.gradient_checkpointing and torch.is_grad_enabled():
             if use_cache:
                 logger.warning_once(
                     "`use_cache=True` is incompatible with gradient checkpointing. Setting `use_cache=False`..."
@@ -909,11 +924,23 @@ class Phi3Model(Phi3PreTrainedModel):
         all_self_attns = () if output_attentions else None
         next_decoder_cache = None
 
-        for decoder_layer in self.layers:
+        num_layers = (
+            len(self.layers) if exit_after_layer is None else exit_after_layer + 1
+        )
+        for layer_idx, decoder_layer in enumerate(self.layers[:num_layers]):
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
 
-            if self.gradient_checkpointing and self.training:
+            # The frozen base model is trained in eval mode,
+            # so check for grad mode rather than `self.training`
+            is_kb_layer = (
+                kb_kvs is not None and layer_idx % kb_config.kb_layer_frequency == 0
+            )
+            if (
+                self.gradient_checkpointing
+                and torch.is_grad_enabled()
+                and (is_kb_layer or not self.gradient_checkpointing_kb_layers_only)
+            ):
                 layer_outputs = self._gradient_checkpointing_func(
                     decoder_layer.__call__,
                     hidden_states,
@@ -924,9 +951,6 @@ class Phi3Model(Phi3PreTrainedModel):
                     use_cache,
                     kb_kvs,
                     kb_config,
-                    save_attention_weights,
-                    attention_save_loc,
-                    attention_file_base_name,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -938,9 +962,6 @@ class Phi3Model(Phi3PreTrainedModel):
                     use_cache=use_cache,
                     kb_kvs=kb_kvs,
                     kb_config=kb_config,
-                    save_attention_weights=save_attention_weights,
-                    attention_save_loc=attention_save_loc,
-                    attention_file_base_name=attention_file_base_name,
                 )
 
             hidden_states = layer_outputs[0]
@@ -951,7 +972,8 @@ class Phi3Model(Phi3PreTrainedModel):
             if output_attentions:
                 all_self_attns += (layer_outputs[1],)
 
-        hidden_states = self.norm(hidden_states)
+        if num_layers == len(self.layers):
+            hidden_states = self.norm(hidden_states)
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
@@ -1015,6 +1037,67 @@ class KBLaMPhi3ForCausalLM(Phi3PreTrainedModel):
     def get_decoder(self):
         return self.model
 
+    def gradient_checkpointing_enable(
+        self, gradient_checkpointing_kwargs=None, kb_layers_only: bool = False
+    ):
+        """
+        kb_layers_only: Only recompute the layers that attend over the KB tokens in
+            backward. These hold the largest activations and the trainable query heads,
+            the frozen layers in between keep their activations.
+        """
+        if gradient_checkpointing_kwargs is None:
+            # The KB is passed as a tuple of tensors,
+            # the reentrant implementation would not propagate gradients to it
+            gradient_checkpointing_kwargs = {"use_reentrant": False}
+        super().gradient_checkpointing_enable(gradient_checkpointing_kwargs)
+        self.model.gradient_checkpointing_kb_layers_only = kb_layers_only
+
+    @property
+    def kb_hooks(self) -> KBAttentionHooks:
+        """Registry of the hooks observing the KB attention layers, see `kblam_hooks`"""
+        return self.model.kb_hooks
+
+    @torch.no_grad()
+    def score_kb(
+        self,
+        input_ids: torch.LongTensor,
+        kb_kvs: tuple,
+        kb_config: KBLaMConfig,
+        attention_mask: Optional[torch.Tensor] = None,
+        topk: int = 5,
+    ) -> dict[int, KBTopK]:
+        """
+        Scores the KB entries against the questions `input_ids` (left padded) with a
+        single prefill pass, which stops after the last layer attending over the KB.
+        Nothing is generated and `lm_head` is never run.
+
+        Returns, for every layer attending over the KB, the `topk` best scored KB
+        entries of every question as `(bsz, topk)` indices and scores. The score of an
+        entry is its attention weight averaged over heads and query tokens, over the
+        whole KB: dynamic sparsification is disabled.
+        """
+        if kb_config.dynamic_sparsify:
+            kb_config = copy.copy(kb_config)
+            kb_config.dynamic_sparsify = False
+        position_ids = None
+        if attention_mask is not None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+        score_observer = KBAttentionScoreObserver()
+        with self.kb_hooks.observe(score_observer):
+            self(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=False,
+                kb_kvs=kb_kvs,
+                kb_config=kb_config,
+                exit_after_layer=kb_config.get_kb_layer_indices(
+                    self.config.num_hidden_layers
+                )[-1],
+            )
+        return score_observer.topk(topk)
+
     def load_query_head(self, ckpt_dir):
         learned_query_heads = torch.load(ckpt_dir)
         assert len(learned_query_heads) == self.model.config.num_hidden_layers
@@ -1042,9 +1125,7 @@ class KBLaMPhi3ForCausalLM(Phi3PreTrainedModel):
         return_dict: Optional[bool] = None,
         kb_kvs: Optional[tuple] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        save_attention_weights: bool = False,
-        attention_save_loc: Optional[str] = None,
-        attention_file_base_name: Optional[str] = None,
+        exit_after_layer: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1052,6 +1133,9 @@ class KBLaMPhi3ForCausalLM(Phi3PreTrainedModel):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            exit_after_layer (`int`, *optional*):
+                Stop after this decoder layer, for uses that only need the (KB) attention of the first layers, e.g.
+                retrieval. `lm_head` is skipped and the output has no logits.
 
         Returns:
 
@@ -1099,11 +1183,20 @@ class KBLaMPhi3ForCausalLM(Phi3PreTrainedModel):
             return_dict=return_dict,
             kb_kvs=kb_kvs,
             kb_config=kb_config,
-            save_attention_weights=save_attention_weights,
-            attention_save_loc=attention_save_loc,
-            attention_file_base_name=attention_file_base_name,
+            exit_after_layer=exit_after_layer,
         )
 
+        if exit_after_layer is not None:
+            if labels is not None:
+                raise ValueError("The loss cannot be computed with `exit_after_layer`")
+            if not return_dict:
+                return outputs
+            return CausalLMOutputWithPast(
+                past_key_values=outputs.past_key_values,
+                hidden_states=outputs.hidden_states,
+                attentions=outputs.attentions,
+            )
+
         hidden_states = outputs[0]
         logits = self.lm_head(hidden_states)
         logits = logits.float()
@@ -1142,9 +1235,6 @@ class KBLaMPhi3ForCausalLM(Phi3PreTrainedModel):
         inputs_embeds=None,
         kb_kvs: Optional[tuple] = None,
         kb_config: Optional[KBLaMConfig] = None,
-        # save_attention_weights: bool = False,
-        # attention_save_loc: Optional[str] = None,
-        # attention_file_base_name: Optional[str] = None,
         **kwargs,
     ):
         if past_key_values is not None:
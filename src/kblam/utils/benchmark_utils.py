@@ -0,0 +1,74 @@
+import re
+import statistics
+import time
+from typing import Callable
+
+import torch
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device: torch.device):
+    """Starts a new peak memory measurement, see `peak_memory`"""
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        # Resets the peak resident set size of the process (Linux only)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _read_process_status(field: str) -> int | None:
+    """Memory field of /proc/self/status in bytes"""
+    try:
+        with open("/proc/self/status") as f:
+            match = re.search(rf"{field}:\s+(\d+) kB", f.read())
+    except OSError:
+        return None
+    return int(match.group(1)) * 1024 if match else None
+
+
+def memory_in_use(device: torch.device) -> int | None:
+    """
+    Memory in bytes currently allocated by torch on CUDA, the resident set size of the process on CPU.
+    None when it cannot be measured, e.g. on CPU without /proc.
+    """
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device)
+    return _read_process_status("VmRSS")
+
+
+def peak_memory(device: torch.device) -> int | None:
+    """Peak of `memory_in_use` in bytes since the last `reset_peak_memory`"""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return _read_process_status("VmHWM")
+
+
+def time_func(
+    func: Callable[..., object],
+    device: torch.device,
+    repeats: int = 3,
+    warmup: int = 1,
+    setup: Callable[[], tuple] = tuple,
+) -> float:
+    """
+    Median wall-clock time in seconds of `repeats` calls of `func`, after `warmup` calls. `func` is called with the
+    arguments returned by `setup`, which is not timed.
+    """
+    durations = []
+    for i in range(warmup + repeats):
+        args = setup()
+        synchronize(device)
+        start_time = time.perf_counter()
+        func(*args)
+        synchronize(device)
+        if i >= warmup:
+            durations.append(time.perf_counter() - start_time)
+    return statistics.median(durations)
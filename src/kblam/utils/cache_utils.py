@@ -0,0 +1,111 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+
+def make_cache_key(**fields) -> str:
+    """Content address of a request, the SHA-256 of its fields serialized as JSON"""
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "hit_rate": self.hit_rate}
+
+
+def _is_embedding(value) -> bool:
+    return isinstance(value, list) and len(value) > 0 and all(type(x) is float for x in value)
+
+
+def _encode(value) -> str | bytes:
+    """Embeddings (lists of floats) are stored as float64 blobs, 8 bytes a value instead of about 20 as JSON text"""
+    if _is_embedding(value):
+        return array("d", value).tobytes()
+    return json.dumps(value)
+
+
+def _decode(data: str | bytes):
+    if isinstance(data, bytes):
+        embedding = array("d")
+        embedding.frombytes(data)
+        return embedding.tolist()
+    return json.loads(data)
+
+
+class ResponseCache:
+    """
+    Persistent cache of JSON-serializable values in a SQLite database, keyed by `make_cache_key`. When the values
+    take more than `max_bytes` (None for no limit), the least recently used ones are evicted. Safe to share between
+    threads, several processes can use the same file. The size of the values is counted at open and updated with
+    the writes of this process, so with several writers the cache can exceed `max_bytes` until it is reopened.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int | None = 2**30):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self.total_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def get(self, key: str):
+        """The cached value, None if there is none"""
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self._connection.execute("UPDATE cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.stats.hits += 1
+        return _decode(row[0])
+
+    def put(self, key: str, value):
+        data = _encode(value)
+        with self._lock:
+            replaced = self._connection.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self.total_bytes += len(data) - (replaced[0] if replaced else 0)
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM cache ORDER BY last_used"):
+            keys.append(key)
+            self.total_bytes -= size
+            if self.total_bytes <= self.max_bytes:
+                break
+        self._connection.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in keys])
+        self.stats.evictions += len(keys)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
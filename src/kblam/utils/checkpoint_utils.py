@@ -0,0 +1,159 @@
+import logging
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import torch
+
+logger = logging.getLogger("training")
+
+ENCODER_FILE_NAME = "encoder.pt"
+LLM_TRAINABLE_FILE_NAME = "llm_trainable.pt"
+TRAINING_STATE_FILE_NAME = "training_state.pt"
+KB_CONFIG_FILE_NAME = "kb_config.json"
+
+
+def trainable_state_dict(module: torch.nn.Module) -> dict[str, torch.Tensor]:
+    """Return only the parameters of `module` that require grad, keyed by their state dict name."""
+    if hasattr(module, "module"):
+        # Unwrap DistributedDataParallel
+        module = module.module
+    return {name: param for name, param in module.named_parameters() if param.requires_grad}
+
+
+def load_trainable_state_dict(module: torch.nn.Module, path: str | os.PathLike) -> None:
+    """Load a state dict produced by `trainable_state_dict` into a model that already holds the frozen weights."""
+    state_dict = torch.load(path, map_location="cpu")
+    result = module.load_state_dict(state_dict, strict=False)
+    if result.unexpected_keys:
+        raise KeyError(f"Unexpected keys in {path}: {result.unexpected_keys}")
+
+
+def snapshot_to_cpu(obj: Any) -> Any:
+    """Recursively copy every tensor in `obj` to CPU memory so that training can keep mutating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [snapshot_to_cpu(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_states() -> dict[str, Any]:
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: dict[str, Any]) -> None:
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def get_checkpoint_step(path: str | os.PathLike) -> int:
+    """Checkpoints are saved as `{name}_step_{step}`, recover the step from the directory name."""
+    match = re.search(r"_step_(\d+)$", str(Path(path).name))
+    if match is None:
+        raise ValueError(f"Cannot parse the training step from checkpoint name {path}")
+    return int(match.group(1))
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints from a background thread.
+
+    `save` expects a state that has already been snapshotted to CPU (see `snapshot_to_cpu`), so the training loop
+    only pays for the device-to-host copy. Each checkpoint is written into a temporary directory which is renamed
+    into place once every file is on disk, so a crash never leaves a half written checkpoint behind.
+    At most one checkpoint is pending at a time; if the writer is still busy `save` blocks until it is done.
+    """
+
+    def __init__(self, output_dir: str | os.PathLike, max_to_keep: Optional[int] = None):
+        self.output_dir = Path(output_dir)
+        self.max_to_keep = max_to_keep
+        self._queue: queue.Queue = queue.Queue(maxsize=1)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def save(self, name: str, files: dict[str, Any]) -> None:
+        """
+        name: Name of the checkpoint directory, e.g. `{llm_savename}_step_{step}`
+        files: Mapping from file name to the object to write. Strings are written as text, everything else with
+            `torch.save`.
+        """
+        self._raise_if_failed()
+        self._queue.put((name, files))
+
+    def wait(self) -> None:
+        """Block until every pending checkpoint is on disk."""
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self) -> None:
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("Background checkpoint writer failed") from self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+                self._apply_retention(item[0])
+            except BaseException as e:  # noqa: B036
+                logger.error(f"Error saving checkpoint: {e}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, name: str, files: dict[str, Any]):
+        final_dir = self.output_dir / name
+        tmp_dir = self.output_dir / f".{name}.tmp"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+        for file_name, obj in files.items():
+            if isinstance(obj, str):
+                (tmp_dir / file_name).write_text(obj)
+            else:
+                torch.save(obj, tmp_dir / file_name)
+        if final_dir.exists():
+            shutil.rmtree(final_dir)
+        os.replace(tmp_dir, final_dir)
+        logger.info(f"Checkpoint written to {final_dir}")
+
+    def _apply_retention(self, name: str):
+        if self.max_to_keep is None:
+            return
+        prefix = re.sub(r"_step_\d+$", "", name)
+        checkpoints = sorted(
+            (p for p in self.output_dir.iterdir() if p.is_dir() and re.fullmatch(rf"{re.escape(prefix)}_step_\d+", p.name)),
+            key=get_checkpoint_step,
+        )
+        for old_checkpoint in checkpoints[: max(0, len(checkpoints) - self.max_to_keep)]:
+            shutil.rmtree(old_checkpoint)
+            logger.info(f"Removed old checkpoint {old_checkpoint}")
@@ -53,30 +53,40 @@ def get_i_dont_know_ans():
     return "I am sorry I cannot find relevant information in the KB."
 
 
+QUESTION_TEMPLATES = [
+    "What {} does {} have?",
+    "What is the {} of {}?",
+    "Tell me about the {} of {}.",
+    "Can you let me know the {} of {}?",
+    "Can you inform me about the {} of {}?",
+    "Describe the {} of {}.",
+    "What details can you share about the {} of {}?",
+    "What kind of {} does {} have?",
+    "Provide details on the {} of {}.",
+    "What features does the {} of {} include?",
+    "Can you elaborate on the {} of {}?",
+    "How would you describe the {} of {}?",
+    "What can you tell me about the {} characteristics of {}?",
+    "Can you explain the {} of {}?",
+    "What insights can you provide about the {} of {}?",
+    "What should I know about the {} of {}?",
+]
+
+
+def get_augmented_questions(row: dict[str, str]) -> list[str]:
+    """Every question of an entity from the pre-defined templates."""
+    return [
+        template.format(row["description_type"], row["name"])
+        for template in QUESTION_TEMPLATES
+    ]
+
+
 def augment_row(row: dict[str, str]) -> list[dict[str, str]]:
     """Augment an entity with questions from pre-defined templates."""
-    templates = [
-        "What {} does {} have?",
-        "What is the {} of {}?",
-        "Tell me about the {} of {}.",
-        "Can you let me know the {} of {}?",
-        "Can you inform me about the {} of {}?",
-        "Describe the {} of {}.",
-        "What details can you share about the {} of {}?",
-        "What kind of {} does {} have?",
-        "Provide details on the {} of {}.",
-        "What features does the {} of {} include?",
-        "Can you elaborate on the {} of {}?",
-        "How would you describe the {} of {}?",
-        "What can you tell me about the {} characteristics of {}?",
-        "Can you explain the {} of {}?",
-        "What insights can you provide about the {} of {}?",
-        "What should I know about the {} of {}?",
-    ]
     dtype = row["description_type"]
     name = row["name"]
-    tid = np.random.randint(0, len(templates))
-    return templates[tid].format(dtype, name)
+    tid = np.random.randint(0, len(QUESTION_TEMPLATES))
+    return QUESTION_TEMPLATES[tid].format(dtype, name)
 
 
 def generate_multi_entity_qa(
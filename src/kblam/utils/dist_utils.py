@@ -0,0 +1,80 @@
+from typing import Callable
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_shard_sizes(n: int, world_size: int) -> list[int]:
+    """Split `n` rows into `world_size` contiguous shards, the first `n % world_size` shards get one extra row."""
+    return [n // world_size + (rank < n % world_size) for rank in range(world_size)]
+
+
+class _AllGatherWithGrad(torch.autograd.Function):
+    """
+    Concatenates the shard of every rank along the first dimension.
+    In backward, the gradients every rank computed w.r.t. the gathered tensor are summed and each rank gets back the
+    slice of its own shard. Together with the gradient averaging of DDP this matches the gradient of the mean loss.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor: torch.Tensor, shard_sizes: list[int]) -> torch.Tensor:
+        ctx.rank = dist.get_rank()
+        ctx.shard_sizes = shard_sizes
+        # all_gather needs tensors of the same shape on every rank, pad to the largest shard
+        padded = tensor.new_zeros((max(shard_sizes), *tensor.shape[1:]))
+        padded[: tensor.shape[0]] = tensor
+        gathered = [torch.empty_like(padded) for _ in shard_sizes]
+        dist.all_gather(gathered, padded)
+        return torch.cat([shard[:size] for shard, size in zip(gathered, shard_sizes)])
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        grad_output = grad_output.contiguous().clone()
+        dist.all_reduce(grad_output)
+        start = sum(ctx.shard_sizes[: ctx.rank])
+        return grad_output[start : start + ctx.shard_sizes[ctx.rank]], None
+
+
+def all_gather_with_grad(tensor: torch.Tensor, shard_sizes: list[int]) -> torch.Tensor:
+    """
+    tensor: The local shard, of shape (shard_sizes[rank], ...)
+    shard_sizes: Number of rows held by each rank
+    """
+    if tensor.shape[0] != shard_sizes[dist.get_rank()]:
+        raise ValueError(f"Expected a shard of {shard_sizes[dist.get_rank()]} rows, got {tensor.shape[0]}")
+    return _AllGatherWithGrad.apply(tensor, shard_sizes)
+
+
+def broadcast_indices(indices: np.ndarray | None, device: torch.device | str) -> np.ndarray:
+    """Share the indices sampled on rank 0 with every rank. `indices` is only read on rank 0."""
+    size = torch.tensor([len(indices) if dist.get_rank() == 0 else 0], device=device)
+    dist.broadcast(size, src=0)
+    indices_tensor = (
+        torch.as_tensor(indices, dtype=torch.long, device=device)
+        if dist.get_rank() == 0
+        else torch.empty(size.item(), dtype=torch.long, device=device)
+    )
+    dist.broadcast(indices_tensor, src=0)
+    return indices_tensor.cpu().numpy()
+
+
+def sharded_encode(
+    encode_func: Callable[[np.ndarray], tuple[torch.Tensor, torch.Tensor]],
+    indices: np.ndarray,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Encode the KB entries `indices` (identical on every rank) by splitting them across the ranks: each rank encodes
+    its own shard with `encode_func`, the key and value embeddings are then all-gathered with gradient support.
+    """
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    if len(indices) < world_size:
+        raise ValueError(f"Cannot shard {len(indices)} KB entries across {world_size} ranks")
+    shard_sizes = get_shard_sizes(len(indices), world_size)
+    start = sum(shard_sizes[:rank])
+    key_embds, value_embds = encode_func(indices[start : start + shard_sizes[rank]])
+    return all_gather_with_grad(key_embds, shard_sizes), all_gather_with_grad(value_embds, shard_sizes)
@@ -1,12 +1,14 @@
+import copy
 from typing import Optional
 
 import numpy as np
 import torch
 import transformers
+from transformers.cache_utils import DynamicCache
 
-from KBLaM.src.kblam.models.kblam_config import KBLaMConfig
-from KBLaM.src.kblam.models.llama3_model import KblamLlamaForCausalLM
-from KBLaM.src.kblam.models.phi3_model import KBLaMPhi3ForCausalLM
+from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.llama3_model import KblamLlamaForCausalLM
+from kblam.models.phi3_model import KBLaMPhi3ForCausalLM
 
 instruction_prompts = """
 Please answer questions based on the given text with format: "The {property} of {name} is {description}"
@@ -69,28 +71,95 @@ model_prune_format_mapping = {
 }
 
 
+def _get_question_format(model: KBLaMPhi3ForCausalLM | KblamLlamaForCausalLM):
+    for m in model_question_format_mapping:
+        if isinstance(model, m):
+            return model_question_format_mapping[m]
+    raise ValueError(f"No question format for {type(model).__name__}")
+
+
+class PromptPrefixCache:
+    """
+    KV cache of a prompt prefix shared by many questions, e.g. the instruction and
+    the KB as text of the in-context learning baseline. The prefix is prefilled once,
+    each question then starts from a copy of the cache and only prefills its own tokens.
+    """
+
+    def __init__(
+        self,
+        tokenizer: transformers.PreTrainedTokenizer,
+        model: KBLaMPhi3ForCausalLM | KblamLlamaForCausalLM,
+        prefix: str,
+        kb_config: Optional[KBLaMConfig] = None,
+    ):
+        self.prefix = prefix
+        # The formatted prompt is the chat template header followed by the prefix
+        sentinel = "\x00"
+        prefix_str = _get_question_format(model)(prefix + sentinel).split(sentinel)[0]
+        self.input_ids = tokenizer(prefix_str, return_tensors="pt")["input_ids"].to(
+            model.device
+        )
+        with torch.autograd.no_grad():
+            outputs = model(
+                input_ids=self.input_ids,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                kb_config=kb_config,
+            )
+        self.past_key_values = outputs["past_key_values"]
+
+    def get_cache(self, input_ids: torch.Tensor) -> DynamicCache:
+        """
+        Copy of the cache for the prompt `input_ids` (batch of one), cropped to the
+        tokens it shares with the prefix: the tokenizer can merge the last tokens of
+        the prefix with the question. At least one token is left to prefill.
+        """
+        num_tokens = min(self.input_ids.shape[1], input_ids.shape[1] - 1)
+        mismatch = (self.input_ids[0, :num_tokens] != input_ids[0, :num_tokens]).nonzero()
+        num_shared_tokens = mismatch[0].item() if len(mismatch) else num_tokens
+        past_key_values = copy.deepcopy(self.past_key_values)
+        past_key_values.crop(num_shared_tokens)
+        return past_key_values
+
+
 def answer_question(
     tokenizer: transformers.PreTrainedTokenizer,
     model: KBLaMPhi3ForCausalLM | KblamLlamaForCausalLM,
     Q: str,
     kb=None,
     kb_config: Optional[KBLaMConfig] = None,
+    topk_size: int = -1,
+    prefix_cache: Optional[PromptPrefixCache] = None,
 ):
-    for m in model_question_format_mapping:
-        if isinstance(model, m):
-            input_str = model_question_format_mapping[m](Q)
+    """
+    topk_size: Only attend over the `topk_size` most relevant KB entries (dynamic
+        sparsification), -1 for all
+    prefix_cache: Cache of a prefix of `Q`, only the rest of the prompt is prefilled
+    """
+    if kb is not None and topk_size > 0:
+        kb_config = copy.copy(kb_config)
+        kb_config.dynamic_sparsify = True
+        kb_config.top_k_kb = topk_size
+    input_str = _get_question_format(model)(Q)
     tokenizer_output = tokenizer(input_str, return_tensors="pt", padding=True).to(
-        "cuda"
+        model.device
     )
     input_ids, attention_masks = (
         tokenizer_output["input_ids"],
         tokenizer_output["attention_mask"],
     )
 
+    past_key_values = None
+    if prefix_cache is not None:
+        if not Q.startswith(prefix_cache.prefix):
+            raise ValueError("The question does not start with the cached prefix")
+        past_key_values = prefix_cache.get_cache(input_ids)
+
     with torch.autograd.no_grad():
         outputs = model.generate(
             input_ids=input_ids,
             attention_mask=attention_masks,
+            past_key_values=past_key_values,
             kb_kvs=kb,
             max_new_tokens=150,
             tokenizer=tokenizer,
@@ -0,0 +1,110 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Sequence
+
+import numpy as np
+
+ROUGE_TYPES = ("rouge1", "rouge2", "rougeL", "rougeLsum")
+
+# Scores a batch of (predictions, references), returns a dictionary of per-example scores
+BatchScoreFunc = Callable[[list[str], list[str]], dict[str, Sequence[float]]]
+
+
+class StreamingRouge:
+    """
+    ROUGE F-measures computed as the predictions arrive, only running sums are kept.
+    Same scorer as `evaluate.load("rouge")`, `compute` returns the mean F-measure over the examples, which is what
+    the bootstrap aggregation of `evaluate` estimates.
+    """
+
+    def __init__(self, rouge_types: Sequence[str] = ROUGE_TYPES, use_stemmer: bool = False):
+        self.rouge_types = tuple(rouge_types)
+        self.use_stemmer = use_stemmer
+        self._scorer = None
+        self._sums = dict.fromkeys(self.rouge_types, 0.0)
+        self.count = 0
+
+    def add(self, prediction: str, reference: str):
+        if self._scorer is None:
+            from rouge_score import rouge_scorer
+
+            self._scorer = rouge_scorer.RougeScorer(rouge_types=list(self.rouge_types), use_stemmer=self.use_stemmer)
+        scores = self._scorer.score(reference, prediction)
+        for rouge_type in self.rouge_types:
+            self._sums[rouge_type] += scores[rouge_type].fmeasure
+        self.count += 1
+
+    def compute(self) -> dict[str, float]:
+        if self.count == 0:
+            raise ValueError("No prediction has been added")
+        return {rouge_type: total / self.count for rouge_type, total in self._sums.items()}
+
+
+class BackgroundBatchScorer:
+    """
+    Scores (prediction, reference) pairs in batches of `batch_size` on background threads, so that scoring overlaps
+    with generation. `compute` scores the last partial batch, waits for every batch and returns the mean of each
+    score, the per-example scores are kept in `scores` in the order the pairs were added.
+    """
+
+    def __init__(self, score_func: BatchScoreFunc, batch_size: int = 64, num_workers: int = 1):
+        self.score_func = score_func
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._futures: list[Future] = []
+        self._predictions: list[str] = []
+        self._references: list[str] = []
+        self.scores: dict[str, list[float]] = {}
+
+    def add(self, prediction: str, reference: str):
+        self._predictions.append(prediction)
+        self._references.append(reference)
+        if len(self._predictions) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        if self._predictions:
+            self._futures.append(self._executor.submit(self.score_func, self._predictions, self._references))
+            self._predictions, self._references = [], []
+
+    def compute(self) -> dict[str, float]:
+        self._submit()
+        for future in self._futures:
+            for name, batch_scores in future.result().items():
+                self.scores.setdefault(name, []).extend(float(score) for score in batch_scores)
+        self._futures.clear()
+        if not self.scores:
+            raise ValueError("No prediction has been added")
+        return {name: float(np.mean(scores)) for name, scores in self.scores.items()}
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class BERTScoreFunc:
+    """
+    Batch score function computing BERTScore like `evaluate.load("bertscore")`. The model is only loaded by the
+    first batch, on the scoring thread, and shared by all the workers of a `BackgroundBatchScorer`.
+    """
+
+    def __init__(self, model_type: str = "microsoft/deberta-xlarge-mnli", lang: str = "en", device: str | None = None):
+        self.model_type = model_type
+        self.lang = lang
+        self.device = device
+        self._scorer = None
+        self._lock = threading.Lock()
+
+    def __call__(self, predictions: list[str], references: list[str]) -> dict[str, Sequence[float]]:
+        with self._lock:
+            if self._scorer is None:
+                from bert_score import BERTScorer
+
+                self._scorer = BERTScorer(model_type=self.model_type, lang=self.lang, device=self.device)
+        precision, recall, f1 = self._scorer.score(predictions, references, batch_size=len(predictions))
+        return {"precision": precision.tolist(), "recall": recall.tolist(), "f1": f1.tolist()}
+
+
+def background_bert_score(
+    model_type: str = "microsoft/deberta-xlarge-mnli", batch_size: int = 64, num_workers: int = 1
+) -> BackgroundBatchScorer:
+    return BackgroundBatchScorer(BERTScoreFunc(model_type=model_type), batch_size=batch_size, num_workers=num_workers)
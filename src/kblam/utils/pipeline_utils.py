@@ -0,0 +1,264 @@
+import asyncio
+import inspect
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+Item = tuple[str, Any]
+
+
+class ProgressJournal:
+    """
+    Append-only JSONL record of the items a stage has processed, one line per item with its key and outputs. Lines
+    are flushed and synced as they are written, a line cut by a crash is dropped when the journal is reopened.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.records: dict[str, list[dict]] = {}
+        if self.path.exists():
+            self._load()
+        self._file = open(self.path, "a")
+
+    def _load(self):
+        valid_lines = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith("\n"):
+                    break
+                self.records[record["key"]] = record["outputs"]
+                valid_lines.append(line)
+        with open(self.path, "w") as f:
+            f.writelines(valid_lines)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, key: str) -> list[dict] | None:
+        return self.records.get(key)
+
+    def record(self, key: str, outputs: list[dict]):
+        self.records[key] = outputs
+        self._file.write(json.dumps({"key": key, "outputs": outputs}) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+@dataclass
+class StageStats:
+    processed: int = 0
+    resumed: int = 0
+    failed: int = 0
+
+    def to_dict(self, duration_s: float | None = None) -> dict:
+        """The counters, and the number of items processed per second over `duration_s` if given"""
+        stats = asdict(self)
+        if duration_s:
+            stats["items_per_s"] = self.processed / duration_s
+        return stats
+
+
+class Stage:
+    """
+    Step of a streaming pipeline: `func` maps an item to a list of outputs (dataclasses such as `Entity` or
+    `DataPoint`) or to a coroutine of them, the outputs are written to `output_file` as JSON lines as soon as they are
+    produced. The items are keyed, the i-th output of the item `key` gets the key `key/i`.
+
+    Every processed item is recorded in a `ProgressJournal`, so a new run replays the recorded outputs without
+    calling `func` and resumes exactly after the last processed item. An item whose `func` raises is not recorded
+    and is retried by the next run.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], list],
+        output_type: type,
+        journal_path: str | Path,
+        output_file: str | Path | None = None,
+    ):
+        self.name = name
+        self.func = func
+        self.output_type = output_type
+        self.stats = StageStats()
+        self.output_file = Path(output_file) if output_file is not None else None
+        journal_path = Path(journal_path)
+        if self.output_file is not None and self.output_file.exists() and not journal_path.exists():
+            raise FileExistsError(
+                f"{self.output_file} was not written by a journaled run, remove it to regenerate the {name} stage"
+            )
+        self.journal = ProgressJournal(journal_path)
+        self._output = None
+        if self.output_file is not None:
+            # The journal is the reference, drop the outputs written after the last recorded item
+            self.output_file.parent.mkdir(parents=True, exist_ok=True)
+            self._output = open(self.output_file, "w")
+            for outputs in self.journal.records.values():
+                self._write(outputs)
+
+    def _write(self, outputs: list[dict]):
+        if self._output is None:
+            return
+        for output in outputs:
+            self._output.write(json.dumps(output) + "\n")
+        self._output.flush()
+
+    def _resume(self, key: str) -> list[Item] | None:
+        outputs = self.journal.get(key)
+        if outputs is None:
+            return None
+        self.stats.resumed += 1
+        return self._to_items(key, outputs)
+
+    def _record(self, key: str, outputs: list) -> list[Item]:
+        outputs = [output.__dict__ for output in outputs]
+        self._write(outputs)
+        self.journal.record(key, outputs)
+        self.stats.processed += 1
+        return self._to_items(key, outputs)
+
+    def _fail(self, key: str, error: Exception) -> list[Item]:
+        print(f"Error in the {self.name} stage for item {key}.")
+        print(error)
+        self.stats.failed += 1
+        return []
+
+    def _to_items(self, key: str, outputs: list[dict]) -> list[Item]:
+        return [(f"{key}/{i}", self.output_type(**output)) for i, output in enumerate(outputs)]
+
+    def process(self, key: str, item) -> list[Item]:
+        """Outputs of one item, replayed from the journal if the item was already processed"""
+        items = self._resume(key)
+        if items is not None:
+            return items
+        try:
+            outputs = self.func(item)
+        except Exception as e:
+            return self._fail(key, e)
+        return self._record(key, outputs)
+
+    async def aprocess(self, key: str, item) -> list[Item]:
+        """`process` for a `func` that may return a coroutine"""
+        items = self._resume(key)
+        if items is not None:
+            return items
+        try:
+            outputs = self.func(item)
+            if inspect.isawaitable(outputs):
+                outputs = await outputs
+        except Exception as e:
+            return self._fail(key, e)
+        return self._record(key, outputs)
+
+    def __call__(self, items: Iterable[Item]) -> Iterator[Item]:
+        for key, item in items:
+            yield from self.process(key, item)
+
+    def close(self):
+        self.journal.close()
+        if self._output is not None:
+            self._output.close()
+
+
+@dataclass
+class PipelineNode:
+    """
+    A stage of a pipeline, fed with the outputs of the `upstream` stage, of each of the `upstream` stages if it is a
+    tuple, or with the input items if None
+    """
+
+    stage: Stage
+    upstream: str | tuple[str, ...] | None = None
+    num_workers: int = 1
+
+    @property
+    def upstreams(self) -> tuple[str | None, ...]:
+        return self.upstream if isinstance(self.upstream, tuple) else (self.upstream,)
+
+
+async def run_pipeline(items: Iterable[Item], nodes: list[PipelineNode], queue_size: int = 64) -> float:
+    """
+    Runs a DAG of stages concurrently: every output of a stage is sent to all the stages downstream of it, a stage
+    with several upstream stages gets the outputs of each of them. An item flows through the pipeline without
+    waiting for the other items. Each stage has `num_workers` workers taking items from a queue of at most
+    `queue_size` items, a worker waits while a downstream queue is full. This backpressure bounds the number of
+    items in flight whatever the relative speeds of the stages. Returns the duration in seconds.
+    """
+    queues = {node.stage.name: asyncio.Queue(queue_size) for node in nodes}
+    downstream: dict[str | None, list[PipelineNode]] = {None: [], **{node.stage.name: [] for node in nodes}}
+    for node in nodes:
+        for upstream in node.upstreams:
+            if upstream not in downstream:
+                raise ValueError(f"Unknown upstream stage {upstream} of stage {node.stage.name}")
+            downstream[upstream].append(node)
+    remaining_workers = {node.stage.name: node.num_workers for node in nodes}
+    remaining_upstreams = {node.stage.name: len(node.upstreams) for node in nodes}
+
+    async def send(source: str | None, entry: Item | None):
+        for node in downstream[source]:
+            name = node.stage.name
+            if entry is not None:
+                await queues[name].put(entry)
+                continue
+            # None tells one worker to stop, once every upstream stage is done
+            remaining_upstreams[name] -= 1
+            if remaining_upstreams[name] == 0:
+                for _ in range(node.num_workers):
+                    await queues[name].put(None)
+
+    async def feed():
+        for entry in items:
+            await send(None, entry)
+        await send(None, None)
+
+    async def work(node: PipelineNode):
+        name = node.stage.name
+        while (entry := await queues[name].get()) is not None:
+            for output in await node.stage.aprocess(*entry):
+                await send(name, output)
+        remaining_workers[name] -= 1
+        if remaining_workers[name] == 0:
+            await send(name, None)
+
+    start_time = time.perf_counter()
+    tasks = [asyncio.ensure_future(feed())]
+    tasks += [asyncio.ensure_future(work(node)) for node in nodes for _ in range(node.num_workers)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return time.perf_counter() - start_time
+
+
+async def map_stage(stage: Stage, items: Iterable[Item], num_workers: int = 64) -> list[list | None]:
+    """
+    Runs a single stage on the items with `num_workers` concurrent workers, see `run_pipeline`. Returns the outputs of
+    each item in the order of the items, replayed from the journal for the items of a previous run, None for the
+    items that failed.
+    """
+    keys = []
+
+    def record_keys():
+        for key, item in items:
+            keys.append(key)
+            yield key, item
+
+    await run_pipeline(record_keys(), [PipelineNode(stage, num_workers=num_workers)], queue_size=num_workers)
+    results = [stage.journal.get(key) for key in keys]
+    return [None if outputs is None else [stage.output_type(**output) for output in outputs] for outputs in results]
@@ -0,0 +1,78 @@
+import json
+from pathlib import Path
+from typing import Iterator
+
+# Fields of the "-------" separated text files written by earlier versions of eval.py and of the open-ended
+# prediction files, and the record keys they map to
+LEGACY_FIELDS = {
+    "Evidence:": "evidence",
+    "Question:": "question",
+    "Model output:": "prediction",
+    "True answer:": "reference",
+}
+LEGACY_SEPARATOR = "-------"
+
+
+class PredictionWriter:
+    """
+    Writes prediction records as JSON lines as they are produced, e.g.
+    {"id": 0, "question": ..., "prediction": ..., "reference": ..., "kb_ids": [...], "latency_s": ..., "kb_topk": {...}}
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "w")
+        self.num_records = 0
+
+    def write(self, record: dict):
+        self._file.write(json.dumps({"id": self.num_records, **record}) + "\n")
+        self._file.flush()
+        self.num_records += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "PredictionWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parse_legacy_prediction(text: str) -> dict:
+    """Record of a prediction in the text format, each field starts with its label"""
+    starts = sorted((text.find(label), label) for label in LEGACY_FIELDS if label in text)
+    record = {}
+    for (start, label), (end, _) in zip(starts, starts[1:] + [(len(text), None)]):
+        record[LEGACY_FIELDS[label]] = text[start + len(label) : end].strip()
+    return record
+
+
+def _iter_legacy_predictions(path: str | Path) -> Iterator[dict]:
+    lines = []
+    with open(path) as f:
+        for line in f:
+            if line.strip() != LEGACY_SEPARATOR:
+                lines.append(line)
+                continue
+            if "".join(lines).strip():
+                yield parse_legacy_prediction("".join(lines))
+            lines = []
+    if "".join(lines).strip():
+        yield parse_legacy_prediction("".join(lines))
+
+
+def read_predictions(path: str | Path) -> Iterator[dict]:
+    """
+    Lazily reads the prediction records of a `.jsonl` file written by `PredictionWriter`, or of a text file in the
+    legacy "-------" separated format. A record without id gets its position in the file.
+    """
+    if Path(path).suffix == ".jsonl":
+        with open(path) as f:
+            records = (json.loads(line) for line in f if line.strip())
+            for i, record in enumerate(records):
+                yield {"id": i, **record}
+    else:
+        for i, record in enumerate(_iter_legacy_predictions(path)):
+            yield {"id": i, **record}
@@ -0,0 +1,143 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+
+@dataclass
+class RateLimitStats:
+    requests: int = 0
+    # Requests delayed by the client-side limiter and total delay
+    throttled_requests: int = 0
+    throttled_s: float = 0.0
+    # Failed attempts that were retried, those rejected by the server with a 429 and the total backoff
+    retries: int = 0
+    rate_limit_errors: int = 0
+    backoff_s: float = 0.0
+    # Calls that failed after all their retries
+    failures: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class TokenBucket:
+    """
+    Bucket refilled with `rate_per_minute` units per minute, holding at most `burst_s` seconds worth of units.
+    A reservation is always granted and can overdraw the bucket, the caller waits until the debt is repaid.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_s: float = 10.0, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(self.rate * burst_s, 1.0)
+        self.clock = clock
+        self.level = self.capacity
+        self.updated_at = clock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` units, returns the number of seconds to wait before using them"""
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+
+class RateLimiter:
+    """
+    Client-side limit of the requests per minute and tokens per minute (None for no limit), shared by threads and
+    coroutines. When the server asks to retry after a delay, `pause` holds back every request sharing the limiter,
+    not only the rejected one. Also keeps the `RateLimitStats` of the calls it limits.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        burst_s: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute, burst_s, clock) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute, burst_s, clock) if tokens_per_minute else None
+        self.clock = clock
+        self.stats = RateLimitStats()
+        self._lock = threading.Lock()
+        # No request is sent before this time of the clock
+        self._not_before = clock()
+
+    def pause(self, delay_s: float):
+        """Delays every request reserved in the next `delay_s` seconds until then, e.g. after a retry-after"""
+        with self._lock:
+            self._not_before = max(self._not_before, self.clock() + delay_s)
+
+    def reserve(self, num_tokens: int = 0) -> float:
+        """Reserves a request of `num_tokens` tokens, returns the number of seconds to wait before sending it"""
+        with self._lock:
+            wait_s = max(0.0, self._not_before - self.clock())
+            if self.request_bucket is not None:
+                wait_s = max(wait_s, self.request_bucket.reserve(1))
+            if self.token_bucket is not None:
+                wait_s = max(wait_s, self.token_bucket.reserve(num_tokens))
+            self.stats.requests += 1
+            if wait_s > 0:
+                self.stats.throttled_requests += 1
+                self.stats.throttled_s += wait_s
+        return wait_s
+
+    def acquire(self, num_tokens: int = 0):
+        wait_s = self.reserve(num_tokens)
+        if wait_s > 0:
+            time.sleep(wait_s)
+
+    async def acquire_async(self, num_tokens: int = 0):
+        wait_s = self.reserve(num_tokens)
+        if wait_s > 0:
+            await asyncio.sleep(wait_s)
+
+    def record_retry(self, backoff_s: float, rate_limited: bool):
+        with self._lock:
+            self.stats.retries += 1
+            self.stats.rate_limit_errors += int(rate_limited)
+            self.stats.backoff_s += backoff_s
+
+    def record_failure(self):
+        with self._lock:
+            self.stats.failures += 1
+
+
+def get_retry_after(headers) -> float | None:
+    """Seconds to wait from the retry-after-ms or retry-after (seconds or HTTP date) headers of a response"""
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+    except ValueError:
+        pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def backoff_delay(
+    attempt: int, base_s: float = 1.0, max_s: float = 60.0, retry_after: float | None = None
+) -> float:
+    """
+    Seconds to wait before retry number `attempt` (from 0): the delay asked by the server if any, plus up to 10%
+    jitter, otherwise exponential backoff with full jitter, uniform in [0, min(max_s, base_s * 2**attempt)].
+    """
+    if retry_after is not None:
+        return min(max_s, retry_after * (1 + 0.1 * random.random()))
+    return random.uniform(0, min(max_s, base_s * 2**attempt))
@@ -191,3 +191,48 @@ def setup_scheduler_and_optimizer(model_parapmeters: ParamsT, lr: float, max_ite
 
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optim, max_iter, eta_min=lr * 0.01)  # type: ignore
     return scheduler, optim
+
+
+class LengthBucketSampler:
+    """
+    Samples batches of examples with a similar tokenized length to cut down on padding.
+
+    For every kind of QA the examples are sorted by length and split into buckets of `bucket_size` consecutive
+    examples. A batch is drawn from a single, uniformly chosen bucket, so every example is still sampled with
+    (roughly) the same probability. If `max_tokens` is set the batch size adapts to the bucket, such that
+    `batch_size * longest_example` fits in the budget and `B` becomes an upper bound.
+    """
+
+    def __init__(self, lengths: dict[str, np.ndarray], bucket_size: int, max_tokens: int | None = None):
+        """
+        lengths: Tokenized length of every example, for each kind of QA, e.g. {"qa": ..., "extended": ...}
+        bucket_size: Number of examples in a bucket, should be at least `B * multi_entities`
+        max_tokens: Optional token budget of a batch, padding included
+        """
+        self.lengths = {kind: np.asarray(length) for kind, length in lengths.items()}
+        self.max_tokens = max_tokens
+        self.buckets = {}
+        for kind, length in self.lengths.items():
+            # Break ties randomly so examples of the same length do not always share a bucket
+            order = np.lexsort((np.random.permutation(len(length)), length))
+            buckets = [order[i : i + bucket_size] for i in range(0, len(order), bucket_size)]
+            if len(buckets) > 1 and len(buckets[-1]) < bucket_size:
+                buckets[-2] = np.concatenate([buckets[-2], buckets.pop()])
+            self.buckets[kind] = buckets
+
+    def sample(self, kind: str, B: int, multi_entities: int | None = None) -> np.ndarray:
+        """Return `B` indices, or a `(B, multi_entities)` array of indices, drawn from one bucket."""
+        buckets = self.buckets[kind]
+        bucket = buckets[np.random.randint(len(buckets))]
+        group_size = 1 if multi_entities is None else multi_entities
+        B = min(B, len(bucket) // group_size)
+        batch_indices = np.random.choice(bucket, B * group_size, replace=False)
+        row_lengths = self.lengths[kind][batch_indices]
+        if multi_entities is not None:
+            # A multi entities QA concatenates the QA of each entity, its length is at most the sum
+            batch_indices = batch_indices.reshape(B, multi_entities)
+            row_lengths = row_lengths.reshape(B, multi_entities).sum(-1)
+        if self.max_tokens is not None:
+            padded_tokens = np.maximum.accumulate(row_lengths) * np.arange(1, B + 1)
+            batch_indices = batch_indices[: max(1, int((padded_tokens <= self.max_tokens).sum()))]
+        return batch_indices
@@ -0,0 +1,38 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "experiments"))
+from benchmark import expand_grid, run_benchmark  # noqa: E402
+
+
+def test_expand_grid_measures_each_configuration_once():
+    configs = expand_grid(["llama3"], ["kb", "icl", "zeroshot"], [10, 100], [1], [3], [-1, 5])
+    # kb: 2 KB sizes x 2 top-k, icl: 2 KB sizes, zeroshot: no KB
+    assert len(configs) == 7
+    assert [c["kb_size"] for c in configs if c["eval_mode"] == "zeroshot"] == [0]
+    assert all(c["top_k_kb"] == -1 for c in configs if c["eval_mode"] != "kb")
+
+
+def test_run_benchmark_on_cpu():
+    configs = expand_grid(["llama3", "phi3"], ["kb", "icl", "zeroshot"], [10, 1000], [2], [2], [-1, 5])
+    results = run_benchmark(
+        configs, hidden_size=32, num_layers=4, max_icl_tokens=512, num_decode_tokens=2, repeats=1
+    )
+    assert len(results) == len(configs)
+
+    skipped = [r for r in results if "skipped" in r]
+    # The 1000 entries do not fit in the ICL prompt, Phi-3 has no dynamic sparsification
+    assert sorted((r["llm_type"], r["eval_mode"], r["kb_size"], r["top_k_kb"]) for r in skipped) == [
+        ("llama3", "icl", 1000, -1),
+        ("phi3", "icl", 1000, -1),
+        ("phi3", "kb", 10, 5),
+        ("phi3", "kb", 1000, 5),
+    ]
+    for result in results:
+        if "skipped" in result:
+            continue
+        assert result["prefill_latency_s"] > 0 and result["decode_latency_per_token_s"] > 0
+        assert result["prefill_tokens_per_s"] > 0 and result["decode_tokens_per_s"] > 0
+        assert result["peak_memory_bytes"] is None or result["peak_memory_bytes"] > 0
+    icl_result = next(r for r in results if r["eval_mode"] == "icl" and "skipped" not in r)
+    assert icl_result["prompt_len"] > next(r for r in results if r["eval_mode"] == "zeroshot")["prompt_len"]
@@ -0,0 +1,59 @@
+import time
+
+from kblam.utils.cache_utils import ResponseCache, make_cache_key
+
+
+def test_cache_key_depends_on_every_field():
+    messages = [{"role": "user", "content": "hello"}]
+    key = make_cache_key(kind="chat", model="gpt-4o", messages=messages, temperature=1.0, seed=None)
+    assert key == make_cache_key(seed=None, temperature=1.0, messages=messages, model="gpt-4o", kind="chat")
+    assert key != make_cache_key(kind="chat", model="gpt-4o", messages=messages, temperature=0.5, seed=None)
+    assert key != make_cache_key(kind="chat", model="gpt-4o", messages=messages, temperature=1.0, seed=1)
+
+
+def test_cache_persists_and_counts_hits(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.sqlite")
+    assert cache.get("a") is None
+    cache.put("a", "response")
+    cache.put("b", [0.5, 1.5])
+    assert cache.get("a") == "response"
+    cache.close()
+
+    cache = ResponseCache(tmp_path / "cache.sqlite")
+    assert len(cache) == 2
+    assert cache.get("b") == [0.5, 1.5]
+    assert cache.get("c") is None
+    assert cache.stats.to_dict() == {"hits": 1, "misses": 1, "evictions": 0, "hit_rate": 0.5}
+
+
+def test_cache_evicts_the_least_recently_used(tmp_path):
+    # Each value takes 12 bytes as JSON, the cache holds 3 of them
+    cache = ResponseCache(tmp_path / "cache.sqlite", max_bytes=36)
+    for key in ["a", "b", "c"]:
+        cache.put(key, f"value of {key}")
+        time.sleep(0.01)
+    assert cache.get("a") == "value of a"
+    time.sleep(0.01)
+    cache.put("d", "value of d")
+
+    assert len(cache) == 3
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in ["a", "c", "d"])
+    assert cache.stats.evictions == 1
+    assert cache.total_bytes == 36
+
+    # Replacing a value counts its new size only, the total is restored at open
+    cache.put("a", "value of a, longer")
+    assert cache.total_bytes == 20 + 12
+    cache.close()
+    assert ResponseCache(tmp_path / "cache.sqlite", max_bytes=36).total_bytes == 32
+
+
+def test_embeddings_are_stored_as_float64_blobs(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.sqlite")
+    embedding = [0.1 * i for i in range(3072)]
+    cache.put("embedding", embedding)
+    cache.put("ints", [1, 2])
+    assert cache.total_bytes == 8 * 3072 + len("[1, 2]")
+    assert cache.get("embedding") == embedding
+    assert cache.get("ints") == [1, 2]
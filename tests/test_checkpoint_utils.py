@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+
+from kblam.utils.checkpoint_utils import (
+    AsyncCheckpointWriter,
+    get_rng_states,
+    load_trainable_state_dict,
+    set_rng_states,
+    snapshot_to_cpu,
+    trainable_state_dict,
+)
+
+
+def test_async_checkpoint_writer(tmp_path):
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 2))
+    model[0].requires_grad_(False)
+
+    state = trainable_state_dict(model)
+    assert set(state.keys()) == {"1.weight", "1.bias"}
+
+    writer = AsyncCheckpointWriter(tmp_path, max_to_keep=2)
+    for step in [100, 200, 300]:
+        snapshot = snapshot_to_cpu({"trainable.pt": state})
+        snapshot["config.json"] = "{}"
+        writer.save(f"run_step_{step}", snapshot)
+        # The snapshot must not change when training keeps updating the weights
+        with torch.no_grad():
+            model[1].weight.add_(1.0)
+    writer.close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["run_step_200", "run_step_300"]
+
+    restored = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 2))
+    load_trainable_state_dict(restored, tmp_path / "run_step_300" / "trainable.pt")
+    assert torch.allclose(restored[1].weight, model[1].weight - 1.0)
+
+
+def test_rng_states_continue_the_same_stream():
+    np.random.seed(0)
+    torch.manual_seed(0)
+    np.random.choice(100, 10, replace=False)
+    states = get_rng_states()
+    expected = (np.random.choice(100, 10, replace=False), torch.rand(3))
+
+    np.random.seed(1)
+    torch.manual_seed(1)
+    set_rng_states(states)
+    resumed = (np.random.choice(100, 10, replace=False), torch.rand(3))
+
+    assert (expected[0] == resumed[0]).all()
+    assert torch.equal(expected[1], resumed[1])
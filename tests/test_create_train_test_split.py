@@ -0,0 +1,84 @@
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "dataset_generation"))
+from create_train_test_split import create_train_test_split, get_test_mask  # noqa: E402
+
+
+def _write_data(tmp_path, num_entities, jsonl):
+    rows = [
+        {"name": f"entity {i}", "description_type": t, "description": f"{t} {i}"}
+        for i in range(num_entities)
+        for t in ["description", "objectives", "purpose"]
+    ]
+    data_path = tmp_path / ("data.jsonl" if jsonl else "data.json")
+    with open(data_path, "w") as f:
+        if jsonl:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+        else:
+            json.dump(rows, f, indent=2)
+    # The first column is the row index
+    embeddings = np.arange(len(rows) * 4, dtype=np.float64).reshape(len(rows), 4) / 4
+    np.save(tmp_path / "key.npy", embeddings)
+    np.save(tmp_path / "value.npy", -embeddings)
+    return str(data_path), str(tmp_path / "key.npy"), str(tmp_path / "value.npy")
+
+
+def _load_rows(path):
+    with open(path) as f:
+        return json.load(f) if path.suffix == ".json" else [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("jsonl", [False, True])
+def test_index_split(tmp_path, jsonl):
+    data_path, key_path, value_path = _write_data(tmp_path, 10, jsonl)
+    create_train_test_split(data_path, key_path, value_path, 21, tmp_path / "split", chunk_size=4)
+
+    data_name = Path(data_path).name
+    train_rows = _load_rows(tmp_path / "split" / f"train_{data_name}")
+    test_rows = _load_rows(tmp_path / "split" / f"test_{data_name}")
+    assert train_rows + test_rows == _load_rows(Path(data_path))
+    assert len(train_rows) == 21
+    train_keys = np.load(tmp_path / "split" / "train_key.npy")
+    assert train_keys.dtype == np.float32
+    np.testing.assert_array_equal(train_keys, np.load(key_path)[:21])
+    np.testing.assert_array_equal(np.load(tmp_path / "split" / "test_value.npy"), np.load(value_path)[21:])
+
+
+@pytest.mark.parametrize("split", ["random", "entity"])
+def test_random_splits_keep_rows_and_embeddings_aligned(tmp_path, split):
+    data_path, key_path, value_path = _write_data(tmp_path, 20, jsonl=True)
+    create_train_test_split(
+        data_path, key_path, value_path, None, tmp_path / "split", split, test_fraction=0.25, chunk_size=4
+    )
+
+    for subset in ["train", "test"]:
+        rows = _load_rows(tmp_path / "split" / f"{subset}_data.jsonl")
+        keys = np.load(tmp_path / "split" / f"{subset}_key.npy")
+        values = np.load(tmp_path / "split" / f"{subset}_value.npy")
+        # The embeddings of a row follow it
+        np.testing.assert_array_equal(values, -keys)
+        all_rows = _load_rows(Path(data_path))
+        assert rows == [all_rows[i] for i in keys[:, 0].astype(int)]
+    test_names = [row["name"] for row in _load_rows(tmp_path / "split" / "test_data.jsonl")]
+    train_names = {row["name"] for row in _load_rows(tmp_path / "split" / "train_data.jsonl")}
+    assert len(test_names) == 15
+    if split == "entity":
+        assert not train_names & set(test_names)
+
+
+def test_entity_split_mask():
+    names = ["a"] * 3 + ["b"] * 3 + ["c"] * 2 + ["d"] * 2
+    for seed in range(5):
+        is_test = get_test_mask(names, "entity", test_fraction=0.3, seed=seed)
+        test_names = {name for name, t in zip(names, is_test) if t}
+        assert all(is_test[i] == (name in test_names) for i, name in enumerate(names))
+        assert 3 <= is_test.sum() <= 5
+    assert not get_test_mask(names, "entity", test_fraction=0.0).any()
+    assert get_test_mask(names, "random", test_fraction=1.0).all()
+    with pytest.raises(ValueError):
+        get_test_mask(names, "random")
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from kblam.utils.dist_utils import broadcast_indices, get_shard_sizes, sharded_encode
+
+NUM_ENTRIES = 7
+
+
+def _get_encoder_and_loss_weights(world_size):
+    torch.manual_seed(0)
+    base_embds = torch.randn(NUM_ENTRIES + 3, 8)
+    encoder = torch.nn.ModuleDict({"key": torch.nn.Linear(8, 4), "value": torch.nn.Linear(8, 4)})
+    loss_weights = torch.randn(world_size, 2, NUM_ENTRIES, 4)
+    return base_embds, encoder, loss_weights
+
+
+def _encode(encoder, base_embds, indices):
+    indices = torch.as_tensor(indices)
+    return encoder["key"](base_embds[indices]), encoder["value"](base_embds[indices])
+
+
+def _run_sharded_encode(rank, world_size, init_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    try:
+        base_embds, encoder, loss_weights = _get_encoder_and_loss_weights(world_size)
+        indices = broadcast_indices(np.arange(NUM_ENTRIES) + 2 if rank == 0 else None, "cpu")
+        assert indices.tolist() == list(range(2, NUM_ENTRIES + 2))
+
+        key_embds, value_embds = sharded_encode(lambda idx: _encode(encoder, base_embds, idx), indices)
+        loss = (key_embds * loss_weights[rank, 0]).sum() + (value_embds * loss_weights[rank, 1]).sum()
+        loss.backward()
+        # Average the gradients over the ranks like DDP does
+        for param in encoder.parameters():
+            dist.all_reduce(param.grad)
+            param.grad /= world_size
+
+        # Reference: every rank encodes the whole context set on its own
+        _, ref_encoder, _ = _get_encoder_and_loss_weights(world_size)
+        ref_key_embds, ref_value_embds = _encode(ref_encoder, base_embds, indices)
+        ref_loss = sum(
+            (ref_key_embds * loss_weights[r, 0]).sum() + (ref_value_embds * loss_weights[r, 1]).sum()
+            for r in range(world_size)
+        )
+        (ref_loss / world_size).backward()
+
+        assert torch.allclose(key_embds, ref_key_embds)
+        assert torch.allclose(value_embds, ref_value_embds)
+        for param, ref_param in zip(encoder.parameters(), ref_encoder.parameters()):
+            assert torch.allclose(param.grad, ref_param.grad, atol=1e-5)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_get_shard_sizes():
+    assert get_shard_sizes(7, 3) == [3, 2, 2]
+    assert get_shard_sizes(8, 4) == [2, 2, 2, 2]
+
+
+@pytest.mark.parametrize("world_size", [2, 3, 4])
+def test_sharded_encode(tmp_path, world_size):
+    mp.spawn(_run_sharded_encode, args=(world_size, tmp_path / "init"), nprocs=world_size)
@@ -0,0 +1,156 @@
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from kblam.kb_encoder import KBEncoder
+from kblam.utils.prediction_utils import read_predictions
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "experiments"))
+from eval_runner import ResultStore, expand_matrix, get_job_name, run_matrix  # noqa: E402
+
+NUM_LAYERS = 4
+HIDDEN_SIZE = 32
+KB_LAYER_FREQUENCY = 2
+NUM_ENTITIES = 12
+
+
+def _make_dataset():
+    return [
+        {
+            "name": f"entity {i}",
+            "description_type": "color",
+            "description": f"shade number {i}",
+            "key_string": f"the color of entity {i}",
+            "Q": f"What is the color of entity {i}?",
+            "A": f"The color of entity {i} is shade number {i}.",
+        }
+        for i in range(NUM_ENTITIES)
+    ]
+
+
+@pytest.fixture(scope="module")
+def model_spec(tmp_path_factory):
+    """A tiny random Llama with a byte level tokenizer, an encoder and a dataset with precomputed embeddings"""
+    root = tmp_path_factory.mktemp("tiny_eval")
+    dataset = _make_dataset()
+    (root / "data").mkdir()
+    json.dump(dataset, open(root / "data" / "test.json", "w"))
+    rng = np.random.default_rng(0)
+    np.save(root / "data" / "keys.npy", rng.standard_normal((NUM_ENTITIES, 1536)).astype("float32"))
+    np.save(root / "data" / "values.npy", rng.standard_normal((NUM_ENTITIES, 1536)).astype("float32"))
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300, initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), special_tokens=["<|eot_id|>"]
+    )
+    tokenizer.train_from_iterator([row["Q"] + " " + row["A"] for row in dataset], trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|eot_id|>")
+    tokenizer.save_pretrained(root / "llm")
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=HIDDEN_SIZE,
+        intermediate_size=64,
+        num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+    )
+    # The KB encoder outputs bfloat16 embeddings
+    LlamaForCausalLM(config).to(torch.bfloat16).save_pretrained(root / "llm")
+
+    encoder = KBEncoder(
+        encoder_name="OAI",
+        projector_type="linear",
+        endpoint_url="",
+        out_dim=HIDDEN_SIZE * (NUM_LAYERS // KB_LAYER_FREQUENCY + 1),
+        device="cpu",
+    )
+    torch.save(encoder.state_dict(), root / "encoder.pt")
+    return {
+        "llm_type": "llama3",
+        "llm_base_dir": str(root / "llm"),
+        "model_dir": str(root / "llm"),
+        "encoder_dir": str(root / "encoder.pt"),
+        "encoder_spec": "OAI",
+        "kb_layer_frequency": KB_LAYER_FREQUENCY,
+        "dataset_dir": str(root / "data"),
+        "test_dataset": "test.json",
+        "precomputed_embed_keys_path": str(root / "data" / "keys.npy"),
+        "precomputed_embed_values_path": str(root / "data" / "values.npy"),
+    }
+
+
+def test_expand_matrix():
+    jobs = expand_matrix({"seed": [1, 2], "eval_mode": ["kb", "icl", "zeroshot"]})
+    assert len(jobs) == 6
+    assert len({get_job_name("generation", job) for job in jobs}) == 6
+    assert all(job["kb_size"] == 250 for job in jobs)
+    with pytest.raises(ValueError):
+        expand_matrix({"sed": [1]})
+
+
+def test_run_matrix_on_cpu(tmp_path, model_spec):
+    spec = {
+        "command": "generation",
+        "bert_score": False,
+        "model": model_spec,
+        "matrix": {"eval_mode": ["kb", "icl"], "kb_size": [3], "topk_size": [-1, 2]},
+    }
+    done, failed = run_matrix(spec, tmp_path, devices=["cpu"], num_workers=2)
+    assert failed == []
+    assert len(done) == 4
+
+    records = [json.loads(line) for line in open(tmp_path / "results.jsonl")]
+    assert sorted(record["name"] for record in records) == sorted(done)
+    assert all(0 <= record["scores"]["rougeL"] <= 1 for record in records)
+    # Each worker loaded the model once and ran several evaluations
+    assert len({record["scores"]["worker_pid"] for record in records}) <= 2
+    for name in done:
+        predictions = list(read_predictions(tmp_path / f"{name}.jsonl"))
+        assert len(predictions) == 3
+        assert all(len(prediction["kb_ids"]) == 1 and prediction["latency_s"] > 0 for prediction in predictions)
+        # The attention scores over the KB are recorded in the kb mode only
+        assert all(bool(prediction["kb_topk"]) == ("eval_mode_kb" in name) for prediction in predictions)
+
+    # The evaluations already in the store are skipped
+    spec["matrix"]["eval_mode"].append("zeroshot")
+    done, failed = run_matrix(spec, tmp_path, devices=["cpu"], num_workers=2)
+    assert failed == [] and len(done) == 2
+    assert len(ResultStore(tmp_path / "results.jsonl").names) == 6
+
+
+def test_eval_retrieval_accuracy_ignores_dynamic_sparsify(model_spec):
+    from eval import eval_retrieval_accuracy
+
+    from kblam.models.kblam_config import KBLaMConfig
+    from kblam.models.llama3_model import KblamLlamaForCausalLM
+
+    tokenizer = PreTrainedTokenizerFast.from_pretrained(model_spec["llm_base_dir"], padding_side="left")
+    tokenizer.pad_token = "^"
+    model = KblamLlamaForCausalLM.from_pretrained(model_spec["llm_base_dir"]).eval()
+    kb_dim = HIDDEN_SIZE * (NUM_LAYERS // KB_LAYER_FREQUENCY + 1)
+    torch.manual_seed(0)
+    kb_kvs = tuple(torch.randn(NUM_ENTITIES, kb_dim, dtype=torch.bfloat16) for _ in range(2))
+    questions = [row["Q"] for row in _make_dataset()]
+    labels = np.arange(NUM_ENTITIES)
+
+    def evaluate(**kwargs):
+        kb_config = KBLaMConfig(kb_layer_frequency=KB_LAYER_FREQUENCY, **kwargs)
+        return eval_retrieval_accuracy(tokenizer, model, questions, labels, kb_kvs, kb_config, micro_batch_size=5)
+
+    expected = evaluate()
+    sparsified = evaluate(dynamic_sparsify=True, top_k_kb=2)
+    assert [layer_acc["idx"] for layer_acc in sparsified] == [layer_acc["idx"] for layer_acc in expected]
+    for layer_acc, expected_acc in zip(sparsified, expected):
+        assert layer_acc["acc"] == expected_acc["acc"]
+        assert layer_acc["top5acc"] == expected_acc["top5acc"]
+        assert layer_acc["confidence"] == pytest.approx(expected_acc["confidence"])
@@ -0,0 +1,61 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, Phi3Config, Phi3ForCausalLM, PreTrainedTokenizerFast
+
+from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.llama3_model import KblamLlamaForCausalLM
+from kblam.models.phi3_model import KBLaMPhi3ForCausalLM
+from kblam.utils.eval_utils import PromptPrefixCache, answer_question, instruction_prompts
+
+PROMPT_STRS = "".join(f"the color of entity {i} is shade number {i}; " for i in range(5))
+QUESTIONS = ["What is the color of entity 3?", "What is the color of entity 0?"]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300, initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), special_tokens=["<|eot_id|>"]
+    )
+    tokenizer.train_from_iterator([instruction_prompts, PROMPT_STRS] + QUESTIONS, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|eot_id|>", pad_token="<|eot_id|>")
+
+
+@pytest.fixture(scope="module", params=["llama3", "phi3"])
+def model(request, tokenizer, tmp_path_factory):
+    torch.manual_seed(0)
+    config_kwargs = dict(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model_dir = tmp_path_factory.mktemp(request.param)
+    if request.param == "llama3":
+        LlamaForCausalLM(LlamaConfig(**config_kwargs)).save_pretrained(model_dir)
+        return KblamLlamaForCausalLM.from_pretrained(model_dir).eval()
+    Phi3ForCausalLM(Phi3Config(attention_bias=False, **config_kwargs)).save_pretrained(model_dir)
+    return KBLaMPhi3ForCausalLM.from_pretrained(model_dir).eval()
+
+
+def test_prefix_cache_gives_the_same_answers(tokenizer, model):
+    prefix = instruction_prompts + PROMPT_STRS
+    kb_config = KBLaMConfig()
+    prefix_cache = PromptPrefixCache(tokenizer, model, prefix, kb_config)
+    assert prefix_cache.past_key_values.get_seq_length() == prefix_cache.input_ids.shape[1]
+
+    for Q in QUESTIONS:
+        expected = answer_question(tokenizer, model, prefix + Q, kb_config=kb_config)
+        output = answer_question(tokenizer, model, prefix + Q, kb_config=kb_config, prefix_cache=prefix_cache)
+        assert output == expected
+    # Each question starts from a copy, the cached prefix is unchanged
+    assert prefix_cache.past_key_values.get_seq_length() == prefix_cache.input_ids.shape[1]
+
+    with pytest.raises(ValueError):
+        answer_question(tokenizer, model, QUESTIONS[0], kb_config=kb_config, prefix_cache=prefix_cache)
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "dataset_generation"))
+from gen_synthetic_data import AsyncSyntheticDataGenerator, build_pipeline, run_generation  # noqa: E402
+
+LLM_DELAY_S = 0.01
+
+
+class FakeLLMGenerator(AsyncSyntheticDataGenerator):
+    """
+    Deterministic answers after a fixed delay instead of API calls, the instruction "broken" gets invalid JSON, and
+    so does the related person of instruction 4 with `fail_related_person`
+    """
+
+    def __init__(self, num_instructions, fail_related_person=False):
+        super().__init__("gpt-4o", "http://127.0.0.1:1", api_key="test")
+        self.num_instructions = num_instructions
+        self.fail_related_person = fail_related_person
+        self.num_calls = self.in_flight = self.max_in_flight = 0
+
+    def get_instructions(self):
+        return [f"instruction {i}" for i in range(self.num_instructions - 1)] + ["broken"]
+
+    async def api_call_chat(self, messages):
+        self.num_calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(LLM_DELAY_S)
+        self.in_flight -= 1
+        prompt = messages[-1]["content"]
+        if prompt.startswith("Generate an extended Q"):
+            return "Q: " + prompt.split("Q: ")[1].split("\n")[0] + " Why?\nA: Because."
+        if prompt.startswith("Perturb"):
+            return "perturbed " + prompt.split("name ")[1].split(".")[0]
+        if prompt.startswith("Generate a person name"):
+            if self.fail_related_person and "instruction 4 " in prompt:
+                return "not JSON"
+            name = "person of " + prompt.split("entity ")[1].split(" with")[0]
+        elif len(messages) == 2:
+            return "a name for " + prompt
+        elif messages[1]["content"] == "broken":
+            return "not JSON"
+        else:
+            name = messages[2]["content"].removeprefix("a name for ")
+        return json.dumps({"name": name, "description": "desc", "objectives": "obj", "purpose": "purpose"})
+
+
+def _generate(tmp_path, num_workers, fail_related_person=True):
+    data_generator = FakeLLMGenerator(num_instructions=10, fail_related_person=fail_related_person)
+    file_names = ["raw.json", "QA.json", "perturbed.json", "augmented.json"]
+    nodes = build_pipeline(data_generator, str(tmp_path), *file_names, num_workers=num_workers)
+    duration_s = asyncio.run(run_generation(data_generator, nodes, queue_size=4))
+    return data_generator, {node.stage.name: node.stage.stats.to_dict(duration_s) for node in nodes}
+
+
+def _read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_generation_pipeline_is_concurrent_and_resumable(tmp_path):
+    data_generator, serial_stats = _generate(tmp_path / "serial", num_workers=1)
+    # 9 valid entities: 2 calls per entity, 1 per related person, 2 per QA pair, and 2 calls for the broken one. The
+    # entity whose related person failed still gets its QA pairs
+    assert data_generator.num_calls == 9 * (2 + 1 + 3 * 2) + 8 * 3 * 2 + 2
+    assert serial_stats["entities"]["failed"] == serial_stats["related_person"]["failed"] == 1
+
+    # With one worker per stage, the requests of the stages still overlap
+    assert 1 < data_generator.max_in_flight <= len(serial_stats)
+    concurrent_generator, stats = _generate(tmp_path / "concurrent", num_workers=8)
+    assert 8 <= concurrent_generator.max_in_flight <= 8 * len(stats)
+
+    # Same outputs, in another order
+    for file_name in ["raw.json", "QA.json", "perturbed.json", "augmented.json"]:
+        serial_outputs = _read_jsonl(tmp_path / "serial" / file_name)
+        outputs = _read_jsonl(tmp_path / "concurrent" / file_name)
+        assert len(outputs) == {"raw.json": 17}.get(file_name, 51)
+        assert sorted(map(json.dumps, outputs)) == sorted(map(json.dumps, serial_outputs))
+    augmented = _read_jsonl(tmp_path / "concurrent" / "augmented.json")
+    assert all(data["extended_Q"] == data["Q"] + " Why?" for data in augmented)
+    assert {data["Q"] for data in _read_jsonl(tmp_path / "concurrent" / "perturbed.json")} == {
+        f"perturbed {data['name']}" for data in augmented
+    }
+
+    # Everything is replayed from the journals, only the broken instruction and the failed related person are
+    # retried, the related person then gets its QA pairs
+    data_generator, stats = _generate(tmp_path / "concurrent", num_workers=8, fail_related_person=False)
+    assert data_generator.num_calls == 2 + 1 + 3 * 2
+    assert stats["related_person"]["processed"] == 1
+    assert stats["augmentation"]["resumed"] == 51 and stats["augmentation"]["processed"] == 3
+    assert len(_read_jsonl(tmp_path / "concurrent" / "raw.json")) == 18
+    assert len(_read_jsonl(tmp_path / "concurrent" / "augmented.json")) == 54
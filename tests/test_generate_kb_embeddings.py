@@ -0,0 +1,65 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "dataset_generation"))
+from generate_kb_embeddings import embed_dataset  # noqa: E402
+
+
+def _write_dataset(path, num_rows):
+    with open(path, "w") as f:
+        for i in range(num_rows):
+            data = {"name": f"entity {i}", "description_type": "purpose", "description": f"purpose {i}"}
+            f.write(json.dumps({**data, "key_string": f"the purpose of entity {i}"}) + "\n")
+
+
+def _text_embedding(text):
+    # A deterministic embedding from the text
+    return [float(len(text)), float(text.split()[-1]), float(text.startswith("the"))]
+
+
+class FakeEncoder:
+    def __init__(self, fail_at_call=None):
+        self.calls = []
+        self.fail_at_call = fail_at_call
+
+    async def __call__(self, texts):
+        self.calls.append(len(texts))
+        if len(self.calls) == self.fail_at_call:
+            raise ConnectionError("Interrupted")
+        return np.array([_text_embedding(text) for text in texts], dtype=np.float32)
+
+
+def _embed(tmp_path, encoder):
+    dataset_path = str(tmp_path / "data.json")
+    asyncio.run(embed_dataset(dataset_path, encoder, str(tmp_path / "key.npy"), str(tmp_path / "value.npy"), 10))
+
+
+def test_embed_dataset_streams_and_resumes(tmp_path):
+    _write_dataset(tmp_path / "data.json", 25)
+
+    encoder = FakeEncoder(fail_at_call=3)
+    with pytest.raises(ConnectionError):
+        _embed(tmp_path, encoder)
+    # Keys and values are encoded in one call per chunk of 10 data points
+    assert encoder.calls == [20, 20, 10]
+
+    encoder = FakeEncoder()
+    _embed(tmp_path, encoder)
+    # Only the last chunk is encoded again
+    assert encoder.calls == [10]
+
+    key_embeds = np.load(tmp_path / "key.npy")
+    value_embeds = np.load(tmp_path / "value.npy")
+    assert key_embeds.dtype == np.float32 and key_embeds.shape == value_embeds.shape == (25, 3)
+    np.testing.assert_array_equal(key_embeds, [_text_embedding(f"the purpose of entity {i}") for i in range(25)])
+    np.testing.assert_array_equal(value_embeds, [_text_embedding(f"purpose {i}") for i in range(25)])
+
+    # The resumption is refused if the dataset changed
+    _write_dataset(tmp_path / "data.json", 30)
+    with pytest.raises(ValueError):
+        _embed(tmp_path, FakeEncoder())
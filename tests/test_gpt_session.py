@@ -0,0 +1,260 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from openai import RateLimitError
+
+from kblam.gpt_session import GPT, AsyncGPT, split_into_batches
+from kblam.utils.cache_utils import ResponseCache
+from kblam.utils.rate_limit_utils import RateLimiter
+
+RESPONSE_DELAY_S = 0.05
+RETRY_AFTER_S = 0.2
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible chat completions and embeddings, the chat echoes the user message and the embedding of a
+    text is [length, number of spaces]. A batch of embeddings with a text containing "bad" is rejected. The first
+    `server.num_rate_limited` requests are rejected with a 429 and a retry-after header."""
+
+    protocol_version = "HTTP/1.1"  # Keep-alive connections
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.connections.add(self.client_address)
+            server.num_requests += 1
+        received_at = time.monotonic()
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(RESPONSE_DELAY_S)
+        status = 200
+        with server.lock:
+            rate_limited = server.num_rate_limited > 0
+            server.num_rate_limited -= int(rate_limited)
+        if rate_limited:
+            with server.lock:
+                server.in_flight -= 1
+                server.responses.append((time.monotonic(), 429))
+            data = json.dumps({"error": {"message": "Rate limit", "type": "rate_limit", "code": "429"}}).encode()
+            self.send_response(429)
+            self.send_header("Retry-After", str(RETRY_AFTER_S))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if self.path.split("?")[0].endswith("/chat/completions"):
+            response = {
+                "id": "chatcmpl-0",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "echo: " + body["messages"][-1]["content"]},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+        elif self.path.split("?")[0].endswith("/embeddings"):
+            texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+            with server.lock:
+                server.batch_sizes.append(len(texts))
+            response = {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": [float(len(text)), float(text.count(" "))]}
+                    for i, text in enumerate(texts)
+                ],
+                "model": body["model"],
+                "usage": {"prompt_tokens": 1, "total_tokens": 1},
+            }
+            if any("bad" in text for text in texts):
+                response = {"error": {"message": "Invalid input", "type": "invalid_request_error", "code": None}}
+                status = 400
+        else:
+            response = {"error": {"message": "Not found", "type": "not_found", "code": None}}
+            status = 404
+        data = json.dumps(response).encode()
+        with server.lock:
+            server.in_flight -= 1
+            server.responses.append((received_at, status))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def mock_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockOpenAIHandler)
+    server.lock = threading.Lock()
+    server.in_flight = server.max_in_flight = server.num_requests = server.num_rate_limited = 0
+    server.connections = set()
+    server.batch_sizes = []
+    # Time a rate limited response was sent or another request was received, and status of each response
+    server.responses = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _make_gpt(server, model_name, max_concurrency):
+    return AsyncGPT(
+        model_name,
+        f"http://127.0.0.1:{server.server_address[1]}",
+        api_key="test",
+        max_concurrency=max_concurrency,
+    )
+
+
+def test_gather_responses_runs_concurrently(mock_server):
+    prompts = [f"prompt {i}" for i in range(40)]
+
+    async def run():
+        async with _make_gpt(mock_server, "gpt-4o", max_concurrency=8) as gpt:
+            return await gpt.gather_responses(prompts)
+
+    responses = asyncio.run(run())
+    assert responses == [f"echo: {prompt}" for prompt in prompts]
+    assert mock_server.num_requests == len(prompts)
+    # Several requests at once, bounded by the semaphore
+    assert 1 < mock_server.max_in_flight <= 8
+    # The connections are reused
+    assert len(mock_server.connections) <= 8
+
+
+def test_gather_embeddings_keeps_the_order(mock_server):
+    texts = ["a", "b c", "d e f", "the color of entity 1"] * 5
+
+    async def run():
+        async with _make_gpt(mock_server, "text-embedding-3-large", max_concurrency=4) as gpt:
+            return await gpt.gather_embeddings(texts)
+
+    embeddings = asyncio.run(run())
+    assert embeddings == [[float(len(text)), float(text.count(" "))] for text in texts]
+    assert mock_server.max_in_flight <= 4
+
+
+def _expected_embedding(text):
+    return None if "bad" in text else [float(len(text)), float(text.count(" "))]
+
+
+def test_split_into_batches():
+    texts = ["a" * 40, "b" * 40, "c" * 400, "d", "e", "f"]
+    batches = split_into_batches(texts, batch_size=2, max_batch_tokens=50)
+    assert [text for batch in batches for text in batch] == texts
+    # The long text is alone, the batches have at most 2 texts
+    assert [len(batch) for batch in batches] == [2, 1, 2, 1]
+
+
+def test_generate_embeddings_batches_and_bisects(mock_server):
+    texts = [f"text number {i}" for i in range(10)]
+    texts[6] = "a bad text"
+    gpt = GPT("text-embedding-3-large", f"http://127.0.0.1:{mock_server.server_address[1]}", api_key="test")
+    embeddings = gpt.generate_embeddings(texts, batch_size=4)
+    assert embeddings == [_expected_embedding(text) for text in texts]
+    # [0:4], [4:8] is rejected and bisected to isolate the bad text, [8:10]
+    assert mock_server.batch_sizes == [4, 4, 2, 2, 1, 1, 2]
+
+
+def test_async_generate_embeddings(mock_server):
+    texts = [f"text number {i}" for i in range(50)] + ["bad"]
+
+    async def run():
+        async with _make_gpt(mock_server, "text-embedding-3-large", max_concurrency=4) as gpt:
+            return await gpt.generate_embeddings(texts, batch_size=8)
+
+    assert asyncio.run(run()) == [_expected_embedding(text) for text in texts]
+    assert max(mock_server.batch_sizes) == 8
+    assert 1 < mock_server.max_in_flight <= 4
+
+
+def test_rate_limited_requests_are_retried_after_the_delay(mock_server):
+    gpt = GPT("gpt-4o", f"http://127.0.0.1:{mock_server.server_address[1]}", api_key="test", max_retries=3)
+    mock_server.num_rate_limited = 2
+    start_time = time.perf_counter()
+    assert gpt.generate_response("hello") == "echo: hello"
+    assert time.perf_counter() - start_time >= 2 * RETRY_AFTER_S
+    assert gpt.stats.retries == gpt.stats.rate_limit_errors == 2
+    assert gpt.stats.backoff_s >= 2 * RETRY_AFTER_S
+    assert gpt.stats.failures == 0
+
+    # Every attempt is rate limited
+    mock_server.num_rate_limited = 3
+    with pytest.raises(RateLimitError):
+        gpt.generate_response("hello")
+    assert gpt.stats.failures == 1
+    assert gpt.stats.requests == 6
+
+
+def test_async_requests_within_the_rate_limit(mock_server):
+    # 600 requests per minute with a burst of 1 request: one request every 0.1s
+    async def run():
+        async with AsyncGPT(
+            "gpt-4o",
+            f"http://127.0.0.1:{mock_server.server_address[1]}",
+            api_key="test",
+            rate_limiter=RateLimiter(requests_per_minute=600, burst_s=0.1),
+        ) as gpt:
+            start_time = time.perf_counter()
+            responses = await gpt.gather_responses([f"prompt {i}" for i in range(6)])
+            return gpt.stats, responses, time.perf_counter() - start_time
+
+    stats, responses, duration = asyncio.run(run())
+    assert len(responses) == 6
+    assert duration >= 0.5
+    assert stats.throttled_requests == 5
+
+
+def test_cached_responses_and_embeddings(mock_server, tmp_path):
+    endpoint_url = f"http://127.0.0.1:{mock_server.server_address[1]}"
+    gpt = GPT("gpt-4o", endpoint_url, api_key="test", cache=ResponseCache(tmp_path / "cache.sqlite"))
+    assert gpt.generate_response("hello") == "echo: hello"
+    assert gpt.generate_response("hello") == "echo: hello"
+    assert mock_server.num_requests == 1
+    # Another seed is another request
+    gpt.set_seed(1)
+    gpt.generate_response("hello")
+    assert mock_server.num_requests == 2
+
+    # The cache persists, only the texts missing from it are sent
+    gpt = GPT("text-embedding-3-large", endpoint_url, api_key="test", cache=ResponseCache(tmp_path / "cache.sqlite"))
+    assert gpt.generate_embedding("a b") == [3.0, 1.0]
+    texts = ["a b", "c", "bad", "d e f"]
+    assert gpt.generate_embeddings(texts) == [_expected_embedding(text) for text in texts]
+    # The 3 misses, bisected around the bad text
+    assert mock_server.batch_sizes == [1, 3, 1, 2, 1, 1]
+    # The failed embedding is not cached, it is the only one sent again
+    assert gpt.generate_embeddings(texts) == [_expected_embedding(text) for text in texts]
+    assert mock_server.batch_sizes == [1, 3, 1, 2, 1, 1, 1]
+    assert gpt.cache.stats.hits == 1 + 3
+
+
+def test_retry_after_pauses_the_other_requests(mock_server):
+    mock_server.num_rate_limited = 1
+
+    async def run():
+        async with _make_gpt(mock_server, "gpt-4o", max_concurrency=1) as gpt:
+            return gpt.stats, await gpt.gather_responses([f"prompt {i}" for i in range(4)])
+
+    stats, responses = asyncio.run(run())
+    assert responses == [f"echo: prompt {i}" for i in range(4)]
+    assert stats.rate_limit_errors == 1
+    # The requests waiting for a slot were not sent before the delay asked by the server
+    (rejected_at, _), *accepted = mock_server.responses
+    assert len(accepted) == 4
+    assert all(received_at - rejected_at >= RETRY_AFTER_S for received_at, _ in accepted)
@@ -0,0 +1,96 @@
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.kblam_hooks import (
+    KBAttentionAccuracyObserver,
+    KBAttentionEntropyObserver,
+    KBAttentionLatencyObserver,
+    KBAttentionScoreObserver,
+)
+from kblam.models.llama3_model import KblamLlamaForCausalLM
+
+NUM_LAYERS = 4
+KB_LAYER_FREQUENCY = 2
+KB_SIZE = 5
+
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory):
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+    )
+    model_dir = tmp_path_factory.mktemp("tiny_llama")
+    LlamaForCausalLM(config).save_pretrained(model_dir)
+    return KblamLlamaForCausalLM.from_pretrained(model_dir).eval()
+
+
+def _forward(model):
+    torch.manual_seed(1)
+    kb_dim = model.config.hidden_size * (NUM_LAYERS // KB_LAYER_FREQUENCY + 1)
+    kb_kvs = (torch.randn(KB_SIZE, kb_dim), torch.randn(KB_SIZE, kb_dim))
+    input_ids = torch.randint(0, 100, (2, 6))
+    kb_config = KBLaMConfig(kb_layer_frequency=KB_LAYER_FREQUENCY, kb_scale_factor=KB_SIZE)
+    with torch.no_grad():
+        return model(input_ids=input_ids, kb_kvs=kb_kvs, kb_config=kb_config).logits
+
+
+def test_observers_do_not_change_the_outputs(model):
+    reference = _forward(model)
+    accuracy, entropy, latency = (
+        KBAttentionAccuracyObserver(),
+        KBAttentionEntropyObserver(),
+        KBAttentionLatencyObserver(),
+    )
+    with model.kb_hooks.observe(accuracy, entropy, latency):
+        logits = _forward(model)
+    assert torch.equal(logits, reference)
+
+    kb_layers = list(range(0, NUM_LAYERS, KB_LAYER_FREQUENCY))
+    assert sorted(accuracy.kb_attention) == kb_layers
+    assert accuracy.kb_attention[0].shape == (2, KB_SIZE)
+    assert 0 <= accuracy.accuracy([0, 1])["acc"] <= 1
+
+    summary = entropy.summary()
+    assert sorted(summary) == kb_layers
+    assert 0 < summary[0]["kb_mass"] < 1
+    assert 0 < summary[0]["entropy"] <= torch.log(torch.tensor(KB_SIZE)).item() + 1e-5
+
+    # The latency is recorded for every layer, with or without KB
+    assert sorted(latency.summary()) == list(range(NUM_LAYERS))
+
+
+def test_hooks_are_removed(model):
+    events = []
+    handle = model.kb_hooks.register("kb_logits", lambda layer_idx, logits, kb_len: events.append((layer_idx, kb_len)))
+    _forward(model)
+    assert events == [(layer_idx, KB_SIZE) for layer_idx in range(0, NUM_LAYERS, KB_LAYER_FREQUENCY)]
+
+    handle.remove()
+    _forward(model)
+    assert len(events) == NUM_LAYERS // KB_LAYER_FREQUENCY
+    assert "kb_logits" not in model.kb_hooks
+
+    with pytest.raises(ValueError):
+        model.kb_hooks.register("unknown_event", print)
+
+
+def test_score_observer_keeps_the_first_pass_and_maps_pruned_entries():
+    observer = KBAttentionScoreObserver(first_pass_only=True)
+    # 2 of the KB entries kept by sparsification, the second gets most of the attention
+    observer.on_pruned_indices(0, torch.tensor([[4, 1]]), KB_SIZE)
+    observer.on_attention_weights(0, torch.tensor([[[[0.2, 0.7, 0.1]]]]), 2)
+    # A decoding step does not overwrite the prefill pass
+    observer.on_pruned_indices(0, torch.tensor([[0, 2]]), KB_SIZE)
+    observer.on_attention_weights(0, torch.tensor([[[[0.9, 0.0, 0.1]]]]), 2)
+
+    top = observer.topk(1)[0]
+    assert top.indices.tolist() == [[1]]
+    assert top.scores.tolist() == [[pytest.approx(0.7)]]
@@ -0,0 +1,141 @@
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, Phi3Config, Phi3ForCausalLM
+
+from kblam.models.kblam_config import KBLaMConfig
+from kblam.models.kblam_hooks import (
+    KBAttentionAccuracyObserver,
+    KBAttentionEntropyObserver,
+    KBAttentionLatencyObserver,
+    KBAttentionScoreObserver,
+)
+from kblam.models.llama3_model import KblamLlamaForCausalLM
+from kblam.models.phi3_model import KBLaMPhi3ForCausalLM
+
+NUM_LAYERS = 5
+HIDDEN_SIZE = 32
+KB_LAYER_FREQUENCY = 2
+KB_SIZE = 7
+
+
+@pytest.fixture(scope="module", params=["llama3", "phi3"])
+def model(request, tmp_path_factory):
+    torch.manual_seed(0)
+    config_kwargs = dict(
+        vocab_size=100,
+        hidden_size=HIDDEN_SIZE,
+        intermediate_size=64,
+        num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        pad_token_id=0,
+    )
+    model_dir = tmp_path_factory.mktemp(request.param)
+    if request.param == "llama3":
+        LlamaForCausalLM(LlamaConfig(**config_kwargs)).save_pretrained(model_dir)
+        return KblamLlamaForCausalLM.from_pretrained(model_dir).eval()
+    Phi3ForCausalLM(Phi3Config(attention_bias=False, **config_kwargs)).save_pretrained(model_dir)
+    return KBLaMPhi3ForCausalLM.from_pretrained(model_dir).eval()
+
+
+@pytest.fixture
+def inputs():
+    torch.manual_seed(1)
+    kb_dim = HIDDEN_SIZE * (NUM_LAYERS // KB_LAYER_FREQUENCY + 1)
+    kb_kvs = (torch.randn(KB_SIZE, kb_dim), torch.randn(KB_SIZE, kb_dim))
+    input_ids = torch.randint(1, 100, (3, 6))
+    # Left padding
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, :2] = 0
+    input_ids[1, :2] = 0
+    kb_config = KBLaMConfig(kb_layer_frequency=KB_LAYER_FREQUENCY, kb_scale_factor=KB_SIZE, top_k_kb=3)
+    return input_ids, attention_mask, kb_kvs, kb_config
+
+
+def test_score_kb_matches_the_full_forward(model, inputs):
+    input_ids, attention_mask, kb_kvs, kb_config = inputs
+    kb_layers = kb_config.get_kb_layer_indices(NUM_LAYERS)
+
+    score_observer = KBAttentionScoreObserver()
+    position_ids = (attention_mask.cumsum(-1) - 1).masked_fill(attention_mask == 0, 1)
+    with torch.no_grad(), model.kb_hooks.observe(score_observer):
+        model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            kb_kvs=kb_kvs,
+            kb_config=kb_config,
+        )
+    expected = score_observer.topk(3)
+
+    latency_observer = KBAttentionLatencyObserver()
+    kb_config.dynamic_sparsify = True
+    with model.kb_hooks.observe(latency_observer):
+        results = model.score_kb(input_ids, kb_kvs, kb_config, attention_mask=attention_mask, topk=3)
+    # The layers after the last KB layer are skipped
+    assert sorted(latency_observer.summary()) == list(range(kb_layers[-1] + 1))
+    # The whole KB is scored even with dynamic sparsification
+    assert kb_config.dynamic_sparsify
+
+    assert sorted(results) == kb_layers
+    for layer_idx in kb_layers:
+        assert results[layer_idx].indices.shape == (3, 3)
+        assert torch.equal(results[layer_idx].indices, expected[layer_idx].indices)
+        assert torch.allclose(results[layer_idx].scores, expected[layer_idx].scores)
+
+
+@pytest.mark.parametrize("exit_after_layer", [0, 2, 4])
+def test_early_exit_keeps_the_attention_statistics(model, inputs, exit_after_layer):
+    input_ids, attention_mask, kb_kvs, kb_config = inputs
+
+    def run(**kwargs):
+        accuracy_observer, entropy_observer = KBAttentionAccuracyObserver(), KBAttentionEntropyObserver()
+        with torch.no_grad(), model.kb_hooks.observe(accuracy_observer, entropy_observer):
+            outputs = model(
+                input_ids=input_ids, attention_mask=attention_mask, kb_kvs=kb_kvs, kb_config=kb_config, **kwargs
+            )
+        return outputs, accuracy_observer.kb_attention, entropy_observer.summary()
+
+    full_outputs, full_kb_attention, full_entropy = run()
+    outputs, kb_attention, entropy = run(exit_after_layer=exit_after_layer)
+
+    assert full_outputs.logits is not None
+    assert outputs.logits is None
+    kb_layers = [i for i in kb_config.get_kb_layer_indices(NUM_LAYERS) if i <= exit_after_layer]
+    assert sorted(kb_attention) == sorted(entropy) == kb_layers
+    for layer_idx in kb_layers:
+        assert torch.equal(kb_attention[layer_idx], full_kb_attention[layer_idx])
+        assert entropy[layer_idx] == full_entropy[layer_idx]
+
+
+def test_dynamic_sparsify_attends_over_the_selected_entries(model, inputs):
+    if isinstance(model, KBLaMPhi3ForCausalLM):
+        pytest.skip("Dynamic sparsification is only implemented for Llama")
+    input_ids, attention_mask, (kb_keys, kb_values), kb_config = inputs
+    kb_config.sep_query_head = True
+
+    def first_layer_output(kb_kvs, kb_config):
+        events = {}
+
+        def record(event):
+            return lambda layer_idx, tensor, kb_len: events.setdefault(event, tensor)
+
+        handles = [model.kb_hooks.register(event, record(event)) for event in ["pruned_indices", "attention_end"]]
+        with torch.no_grad():
+            model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                kb_kvs=kb_kvs,
+                kb_config=kb_config,
+                exit_after_layer=0,
+            )
+        for handle in handles:
+            handle.remove()
+        return events
+
+    sparse_config = KBLaMConfig(**{**kb_config.to_dict(), "dynamic_sparsify": True, "top_k_kb": 3})
+    events = first_layer_output((kb_keys, kb_values), sparse_config)
+    # Attending over the whole KB restricted to the selected entries gives the same output
+    top_idx = events["pruned_indices"]
+    reference = first_layer_output((kb_keys[top_idx], kb_values[top_idx]), kb_config)
+    assert torch.allclose(events["attention_end"], reference["attention_end"], atol=1e-6)
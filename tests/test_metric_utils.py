@@ -0,0 +1,40 @@
+import threading
+
+import numpy as np
+import pytest
+from rouge_score import rouge_scorer
+
+from kblam.utils.metric_utils import ROUGE_TYPES, BackgroundBatchScorer, StreamingRouge
+
+PREDICTIONS = ["the color of the apple is red", "a small dog", "the size of the house is large", "blue"]
+REFERENCES = ["the apple is red", "a big dog barking", "the house is large", "the sky is blue"]
+
+
+def test_streaming_rouge_matches_the_mean_f_measure():
+    rouge = StreamingRouge()
+    for prediction, reference in zip(PREDICTIONS, REFERENCES):
+        rouge.add(prediction, reference)
+
+    scorer = rouge_scorer.RougeScorer(rouge_types=list(ROUGE_TYPES))
+    scores = [scorer.score(reference, prediction) for prediction, reference in zip(PREDICTIONS, REFERENCES)]
+    expected = {rouge_type: np.mean([score[rouge_type].fmeasure for score in scores]) for rouge_type in ROUGE_TYPES}
+    assert rouge.compute() == pytest.approx(expected)
+
+
+def test_background_batch_scorer_keeps_the_order():
+    scoring_threads = set()
+
+    def score_func(predictions, references):
+        scoring_threads.add(threading.get_ident())
+        return {"len_diff": [len(p) - len(r) for p, r in zip(predictions, references)]}
+
+    scorer = BackgroundBatchScorer(score_func, batch_size=3, num_workers=2)
+    for prediction, reference in zip(PREDICTIONS * 2, REFERENCES * 2):
+        scorer.add(prediction, reference)
+    results = scorer.compute()
+    scorer.close()
+
+    expected = [len(p) - len(r) for p, r in zip(PREDICTIONS * 2, REFERENCES * 2)]
+    assert scorer.scores["len_diff"] == expected
+    assert results["len_diff"] == pytest.approx(np.mean(expected))
+    assert threading.get_ident() not in scoring_threads
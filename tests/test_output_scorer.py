@@ -0,0 +1,106 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "experiments"))
+import output_scorer  # noqa: E402
+import output_scorer_open_ended  # noqa: E402
+
+from kblam.utils.prediction_utils import PredictionWriter, read_predictions  # noqa: E402
+
+LLM_DELAY_S = 0.02
+
+
+class FakeJudgeMixin:
+    """Deterministic judge answers after a fixed delay instead of API calls, counts the requests in flight"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("gpt-4o", "http://127.0.0.1:1", api_key="test", **kwargs)
+        self.num_calls = self.in_flight = self.max_in_flight = 0
+
+    async def generate_response(self, prompt):
+        self.num_calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(LLM_DELAY_S)
+        self.in_flight -= 1
+        return self.judge(prompt)
+
+
+class FakeEvaluator(FakeJudgeMixin, output_scorer.Evaluator):
+    def judge(self, prompt):
+        prediction = prompt.split("model prediction: ")[-1].split("true answer: ")[0]
+        # The score is the digit of the prediction, a prediction without digit gets an invalid score
+        return next((c for c in prediction if c.isdigit()), "no score")
+
+
+class FakeOpenEndedEvaluator(FakeJudgeMixin, output_scorer_open_ended.Evaluator):
+    def judge(self, prompt):
+        return "Score: 4\nReason: Grounded." if "broken" not in prompt else "I cannot score this."
+
+
+def _score(evaluator, records, output_file):
+    async def run():
+        async with evaluator:
+            return await evaluator.evaluate_output_batch(records, str(output_file))
+
+    return asyncio.run(run())
+
+
+def test_scoring_is_concurrent_ordered_and_resumable(tmp_path):
+    # A prediction file in the legacy text format
+    answers = [f"answer {i % 10}" if i != 7 else "no digit" for i in range(40)]
+    with open(tmp_path / "predictions.txt", "w") as f:
+        for i, answer in enumerate(answers):
+            f.write(f"Model output: {answer}\nTrue answer: answer {i % 10}\n-------\n")
+
+    evaluator = FakeEvaluator(max_concurrency=8)
+    # The system message and seed of the evaluator are not reset by GPT
+    assert evaluator.system_msg.startswith("You are an AI system that evaluates")
+    assert evaluator.seed == 42
+    results = _score(evaluator, read_predictions(tmp_path / "predictions.txt"), tmp_path / "scores.json")
+    assert 1 < evaluator.max_in_flight <= 8
+    # In the order of the examples, the failed example does not stop the others
+    assert results[7] is None
+    assert [r.score for i, r in enumerate(results) if i != 7] == [i % 10 for i in range(40) if i != 7]
+    assert results[3].text == "answer 3" and results[3].true_answer == "answer 3"
+    with open(tmp_path / "scores.json") as f:
+        rows = [json.loads(line) for line in f]
+    # The rows are in completion order, their id joins them back to the predictions
+    assert sorted(row["id"] for row in rows) == [i for i in range(40) if i != 7]
+    assert all(row["score"] == row["id"] % 10 for row in rows)
+
+    # The same predictions as JSONL records, only the failed example is scored again
+    with PredictionWriter(tmp_path / "predictions.jsonl") as writer:
+        for i in range(40):
+            answer = f"answer {i % 10}"
+            writer.write({"question": f"question {i}", "prediction": answer, "reference": answer})
+    evaluator = FakeEvaluator(max_concurrency=8)
+    results = _score(evaluator, read_predictions(tmp_path / "predictions.jsonl"), tmp_path / "scores.json")
+    assert evaluator.num_calls == 1
+    assert [r.score for r in results] == [i % 10 for i in range(40)]
+    with open(tmp_path / "scores.json") as f:
+        assert len(f.readlines()) == 40
+
+    # Regenerated predictions are not given the stale scores of the previous ones
+    with PredictionWriter(tmp_path / "predictions.jsonl") as writer:
+        for i in range(40):
+            writer.write({"question": f"question {i}", "prediction": "answer 1", "reference": "answer 1"})
+    with pytest.raises(ValueError):
+        _score(FakeEvaluator(), read_predictions(tmp_path / "predictions.jsonl"), tmp_path / "scores.json")
+
+
+def test_open_ended_scoring_tolerates_failures(tmp_path):
+    records = [
+        {"id": i, "evidence": f"evidence {i}", "question": f"question {i}", "prediction": f"response {i}"}
+        for i in range(6)
+    ]
+    records[2]["prediction"] = "broken"
+    evaluator = FakeOpenEndedEvaluator(max_concurrency=4)
+    results = _score(evaluator, iter(records), tmp_path / "scores.json")
+    assert [r is None for r in results] == [False, False, True, False, False, False]
+    expected = output_scorer_open_ended.EvalExample("evidence 5", "question 5", "response 5", 4.0, "Grounded.", id=5)
+    assert results[5] == expected
@@ -0,0 +1,143 @@
+import asyncio
+import json
+
+import pytest
+
+from kblam.utils.data_utils import DataPoint, Entity
+from kblam.utils.pipeline_utils import PipelineNode, ProgressJournal, Stage, run_pipeline
+
+
+def test_journal_drops_a_truncated_line(tmp_path):
+    journal = ProgressJournal(tmp_path / "journal.jsonl")
+    journal.record("0", [{"a": 1}])
+    journal.record("1", [])
+    journal.close()
+    with open(tmp_path / "journal.jsonl", "a") as f:
+        f.write('{"key": "2", "outp')
+
+    journal = ProgressJournal(tmp_path / "journal.jsonl")
+    assert len(journal) == 2 and "1" in journal and "2" not in journal
+    journal.record("2", [{"a": 2}])
+    journal.close()
+    with open(tmp_path / "journal.jsonl") as f:
+        assert [json.loads(line)["key"] for line in f] == ["0", "1", "2"]
+
+
+def _make_stages(tmp_path, calls, fail_on=None):
+    def make_entity(name):
+        calls.append(name)
+        if name == fail_on:
+            raise ValueError("Malformed response")
+        return [Entity(name=name, description=f"{name} desc", objectives="obj", purpose="purpose")]
+
+    def make_datapoints(entity):
+        return [
+            DataPoint(name=entity.name, description_type=t, description=getattr(entity, t))
+            for t in ["objectives", "purpose"]
+        ]
+
+    journal_dir = tmp_path / "journals"
+    entity_stage = Stage("entities", make_entity, Entity, journal_dir / "entities.jsonl", tmp_path / "raw.json")
+    QA_stage = Stage("QA", make_datapoints, DataPoint, journal_dir / "QA.jsonl", tmp_path / "QA.json")
+    return entity_stage, QA_stage
+
+
+def test_stage_resumes_after_the_last_processed_item(tmp_path):
+    names = [(str(i), f"entity {i}") for i in range(4)]
+    calls = []
+    entity_stage, QA_stage = _make_stages(tmp_path, calls, fail_on="entity 2")
+    outputs = QA_stage(entity_stage(names))
+    # Streaming, the first datapoints are out before the other entities are generated
+    assert next(outputs)[0] == "0/0/0"
+    assert calls == ["entity 0"]
+    assert [key for key, _ in outputs] == ["0/0/1", "1/0/0", "1/0/1", "3/0/0", "3/0/1"]
+    assert entity_stage.stats.failed == 1
+    entity_stage.close()
+    QA_stage.close()
+    # A crash after an output was written but before it was journaled
+    with open(tmp_path / "raw.json", "a") as f:
+        f.write('{"name": "entity 2"')
+
+    calls.clear()
+    entity_stage, QA_stage = _make_stages(tmp_path, calls)
+    outputs = list(QA_stage(entity_stage(names)))
+    entity_stage.close()
+    QA_stage.close()
+    # Only the failed entity is generated again
+    assert calls == ["entity 2"]
+    assert entity_stage.stats.resumed == 3 and QA_stage.stats.resumed == 3
+    assert [key for key, _ in outputs] == [f"{i}/0/{j}" for i in range(4) for j in range(2)]
+    assert outputs[0][1] == DataPoint(name="entity 0", description_type="objectives", description="obj")
+    with open(tmp_path / "raw.json") as f:
+        assert [json.loads(line)["name"] for line in f] == ["entity 0", "entity 1", "entity 3", "entity 2"]
+    with open(tmp_path / "QA.json") as f:
+        assert len(f.readlines()) == 8
+
+
+def test_stage_does_not_overwrite_an_unjournaled_output(tmp_path):
+    (tmp_path / "raw.json").write_text("{}\n")
+    with pytest.raises(FileExistsError):
+        _make_stages(tmp_path, [])
+
+
+def test_run_pipeline_applies_backpressure(tmp_path):
+    num_yielded = 0
+    max_ahead = 0
+
+    def items():
+        nonlocal num_yielded
+        for i in range(50):
+            num_yielded += 1
+            yield str(i), f"entity {i}"
+
+    async def make_entity(name):
+        nonlocal max_ahead
+        max_ahead = max(max_ahead, num_yielded - entity_stage.stats.processed)
+        await asyncio.sleep(0.001)
+        return [Entity(name=name, description="desc", objectives="obj", purpose="purpose")]
+
+    async def slow_datapoint(entity):
+        await asyncio.sleep(0.005)
+        return [DataPoint(name=entity.name, description_type="purpose", description=entity.purpose)]
+
+    entity_stage = Stage("entities", make_entity, Entity, tmp_path / "entities.jsonl")
+    QA_stage = Stage("QA", slow_datapoint, DataPoint, tmp_path / "QA.jsonl", tmp_path / "QA.json")
+    nodes = [PipelineNode(entity_stage, num_workers=2), PipelineNode(QA_stage, "entities", num_workers=2)]
+    duration_s = asyncio.run(run_pipeline(items(), nodes, queue_size=3))
+    entity_stage.close()
+    QA_stage.close()
+
+    assert QA_stage.stats.processed == 50
+    # The fast stage never runs ahead of the slow one by more than the queues and workers hold
+    assert max_ahead <= 2 * (3 + 2) + 1
+    assert QA_stage.stats.to_dict(duration_s)["items_per_s"] > 0
+    with pytest.raises(ValueError):
+        asyncio.run(run_pipeline(items(), [PipelineNode(QA_stage, "unknown")]))
+
+
+def test_run_pipeline_merges_several_upstream_stages(tmp_path):
+    async def make_entity(name):
+        if name == "entity 3":
+            raise ValueError("Invalid entity")
+        return [Entity(name=name, description="desc", objectives="obj", purpose="purpose")]
+
+    async def make_related(entity):
+        if entity.name == "entity 1":
+            raise ValueError("No related entity")
+        return [Entity(name=f"related to {entity.name}", description="desc", objectives="obj", purpose="purpose")]
+
+    def to_datapoint(entity):
+        return [DataPoint(name=entity.name, description_type="purpose", description=entity.purpose)]
+
+    nodes = [
+        PipelineNode(Stage("entities", make_entity, Entity, tmp_path / "entities.jsonl"), num_workers=2),
+        PipelineNode(Stage("related", make_related, Entity, tmp_path / "related.jsonl"), "entities", num_workers=2),
+        PipelineNode(Stage("QA", to_datapoint, DataPoint, tmp_path / "QA.jsonl"), ("entities", "related")),
+    ]
+    asyncio.run(run_pipeline(((str(i), f"entity {i}") for i in range(5)), nodes, queue_size=2))
+    for node in nodes:
+        node.stage.close()
+
+    # The entity without related entity still gets its datapoint
+    names = sorted(data["name"] for outputs in nodes[-1].stage.journal.records.values() for data in outputs)
+    assert names == sorted([f"entity {i}" for i in [0, 1, 2, 4]] + [f"related to entity {i}" for i in [0, 2, 4]])
@@ -0,0 +1,33 @@
+from kblam.utils.prediction_utils import PredictionWriter, parse_legacy_prediction, read_predictions
+
+
+def test_predictions_round_trip(tmp_path):
+    records = [
+        {"question": f"question {i}", "prediction": f"answer {i}\nover two lines", "reference": "", "kb_ids": [i]}
+        for i in range(3)
+    ]
+    with PredictionWriter(tmp_path / "predictions.jsonl") as writer:
+        for record in records:
+            writer.write(record)
+    assert writer.num_records == 3
+
+    predictions = read_predictions(tmp_path / "predictions.jsonl")
+    # Read lazily
+    assert next(predictions) == {"id": 0, **records[0]}
+    assert list(predictions) == [{"id": i, **record} for i, record in enumerate(records) if i > 0]
+
+
+def test_legacy_predictions(tmp_path):
+    assert parse_legacy_prediction("Evidence: e\nQuestion: q\nModel output: a\n") == {
+        "evidence": "e",
+        "question": "q",
+        "prediction": "a",
+    }
+    # The separator only ends a prediction on a line of its own
+    with open(tmp_path / "predictions.txt", "w") as f:
+        f.write("Model output: a ------- b\nTrue answer: a\n-------\n")
+        f.write("Model output: c\nTrue answer: d\n-------\n\n")
+    assert list(read_predictions(tmp_path / "predictions.txt")) == [
+        {"id": 0, "prediction": "a ------- b", "reference": "a"},
+        {"id": 1, "prediction": "c", "reference": "d"},
+    ]
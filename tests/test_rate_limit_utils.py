@@ -0,0 +1,64 @@
+import email.utils
+import time
+
+import pytest
+
+from kblam.utils.rate_limit_utils import RateLimiter, backoff_delay, get_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_spaces_the_requests():
+    clock = FakeClock()
+    # 60 requests and 600 tokens per minute, bursts of 2 seconds
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600, burst_s=2, clock=clock)
+    assert [limiter.reserve(0) for _ in range(4)] == pytest.approx([0, 0, 1, 2])
+
+    clock.now = 10.0
+    # The token bucket holds 20 tokens, 30 more are repaid at 10 tokens per second
+    assert limiter.reserve(50) == pytest.approx(3)
+    assert limiter.stats.requests == 5
+    assert limiter.stats.throttled_requests == 3
+    assert limiter.stats.throttled_s == pytest.approx(6)
+
+
+def test_rate_limiter_without_limits():
+    limiter = RateLimiter()
+    assert all(limiter.reserve(10**6) == 0 for _ in range(100))
+
+
+def test_rate_limiter_pause():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock)
+    limiter.pause(5)
+    # A shorter pause does not end the longer one
+    limiter.pause(1)
+    assert limiter.reserve() == pytest.approx(5)
+    clock.now = 4.0
+    assert limiter.reserve() == pytest.approx(1)
+    clock.now = 6.0
+    assert limiter.reserve() == 0
+
+
+def test_retry_after_headers():
+    assert get_retry_after({"retry-after-ms": "1500", "retry-after": "3"}) == 1.5
+    assert get_retry_after({"retry-after": "3"}) == 3
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 < get_retry_after({"retry-after": date}) <= 30
+    assert get_retry_after({"retry-after": "soon"}) is None
+    assert get_retry_after({}) is None
+    assert get_retry_after(None) is None
+
+
+def test_backoff_delay():
+    delays = [backoff_delay(attempt, base_s=1, max_s=10) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 10 for delay in delays)
+    assert max(backoff_delay(0, base_s=1) for _ in range(20)) <= 1
+    assert 2 <= backoff_delay(0, retry_after=2) <= 2.2
+    assert backoff_delay(0, max_s=5, retry_after=100) == 5
@@ -0,0 +1,26 @@
+import numpy as np
+
+from kblam.utils.train_utils import LengthBucketSampler
+
+
+def test_length_bucket_sampler():
+    np.random.seed(0)
+    lengths = {"qa": np.random.randint(10, 500, size=1000)}
+    sampler = LengthBucketSampler(lengths, bucket_size=100)
+    assert sorted(np.concatenate(sampler.buckets["qa"]).tolist()) == list(range(1000))
+
+    for _ in range(20):
+        batch_indices = sampler.sample("qa", 10)
+        assert batch_indices.shape == (10,)
+        assert len(set(batch_indices.tolist())) == 10
+        # A bucket only spans a tenth of the sorted lengths
+        assert np.ptp(lengths["qa"][batch_indices]) < 150
+
+    batch_indices = sampler.sample("qa", 10, multi_entities=2)
+    assert batch_indices.shape == (10, 2)
+
+    budget_sampler = LengthBucketSampler(lengths, bucket_size=100, max_tokens=1000)
+    for _ in range(20):
+        batch_indices = budget_sampler.sample("qa", 10)
+        longest = lengths["qa"][batch_indices].max()
+        assert len(batch_indices) == 1 or len(batch_indices) * longest <= 1000